@@ -0,0 +1,151 @@
+import os
+import sys
+import csv
+import json
+import time
+import argparse
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from cpp_interactive import ChinesePostmanInteractive
+
+
+SUMMARY_FIELDS = ['name', 'status', 'fetch_s', 'solve_s', 'write_s', 'total_s', 'nodes', 'edges',
+				  'route_m', 'roads_m', 'deadhead_m', 'error']
+
+
+def parse_args(args=None):
+	# Parse arguments from user
+
+	parser = argparse.ArgumentParser(description='Solve the Chinese Postman Problem for every job in a job file, without the graph editor.')
+	parser.add_argument('job_file', type=str, help='A JSON file holding a list of jobs, or an object with a "jobs" list and optional "defaults", or one JSON job per line.')
+	parser.add_argument('--workers', type=int, default=None, help='The number of jobs to solve at once. Defaults to the number of CPUs.')
+	parser.add_argument('--summary', type=str, default='batch_summary.csv', help='The name of the csv file to write the per-job timing summary to.')
+	parser.add_argument('--verbose', action='store_true', help='Output information from every job as it runs.')
+	return parser.parse_args(args)
+
+
+def load_jobs(path):
+	# Read a job file and return its jobs as dicts.  Keys missing from a job are taken from
+	# the file's "defaults", if it has them.
+
+	with open(path) as job_file:
+		text = job_file.read()
+	try:
+		data = json.loads(text)
+	except json.JSONDecodeError:
+		data = [json.loads(line) for line in text.splitlines() if line.strip()]
+
+	defaults = {}
+	if isinstance(data, dict):
+		defaults = data.get('defaults', {})
+		data = data['jobs']
+
+	jobs = []
+	for i, job in enumerate(data):
+		job = dict(defaults, **job)
+		if 'bbox' not in job or 'output' not in job:
+			raise ValueError('Job %d in %s needs a "bbox" and an "output"' % (i, path))
+		job.setdefault('name', os.path.basename(os.path.normpath(job['output'])) or 'job%d' % i)
+		jobs.append(job)
+	return jobs
+
+
+def run_job(job, verbose=False):
+	# Fetch, solve and save the route for one job and return its summary row.  Runs in a
+	# worker process, so failures are reported in the row instead of raised.
+
+	row = {'name':job['name'], 'status':'failed'}
+	start = time.perf_counter()
+	try:
+		output = job['output']
+		os.makedirs(output, exist_ok=True)
+		exports = job.get('exports', ['csv'])
+		export_path = lambda extension: os.path.join(output, 'route.' + extension) if extension in exports else None
+		bbox = job['bbox']
+
+		cpi = ChinesePostmanInteractive((bbox[0], bbox[1]), (bbox[2], bbox[3]),
+										network_type=job.get('network_type', 'drive'),
+										verbose=verbose,
+										simplify=job.get('simplify', False),
+										out_file=export_path('csv'),
+										climb_factor=job.get('climb_factor'),
+										elevation_source=job.get('elevation_source'),
+										artifact_dir=os.path.join(output, 'route'),
+										gpx=export_path('gpx'),
+										geojson=export_path('geojson'),
+										graph_file=job.get('graph'),
+										solver_cache=job.get('solver_cache', 'solver_cache'),
+										edge_counts=os.path.join(output, 'edge_counts.csv') if 'edge_counts' in exports else None,
+										tracks=job.get('tracks'),
+										match_radius=job.get('match_radius', 15.0))
+		row['fetch_s'] = time.perf_counter() - start
+
+		fetched = time.perf_counter()
+		starting_node = cpi.nearest_node(*job['start']) if job.get('start') else None
+		eulerian_circuit = cpi.solve(starting_node)
+		row['solve_s'] = time.perf_counter() - fetched
+
+		solved = time.perf_counter()
+		artifact = cpi.save_results(eulerian_circuit)
+		row['write_s'] = time.perf_counter() - solved
+
+		row['nodes'] = len(artifact.node_ids)
+		row['edges'] = len(artifact.edge_length)
+		row['route_m'] = float(artifact.edge_length[artifact.route_edges].sum())
+		row['roads_m'] = float(artifact.edge_length[artifact.traversal_counts() > 0].sum())
+		row['deadhead_m'] = row['route_m'] - row['roads_m']
+		row['status'] = 'ok'
+	except Exception as e:
+		row['error'] = '%s: %s' % (type(e).__name__, e)
+		if verbose: traceback.print_exc()
+	row['total_s'] = time.perf_counter() - start
+	return row
+
+
+def write_summary(rows, path):
+	# Write the summary rows of the jobs to a csv file
+
+	with open(path, 'w', newline='') as csvfile:
+		writer = csv.DictWriter(csvfile, fieldnames=SUMMARY_FIELDS)
+		writer.writeheader()
+		for row in rows:
+			writer.writerow({key:round(value, 3) if type(value) == float else value for key, value in row.items()})
+
+
+def print_summary(rows):
+	# Print a table of the summary rows of the jobs
+
+	print()
+	print('%-24s %-7s %9s %9s %9s %9s %12s' % ('Job', 'Status', 'Fetch s', 'Solve s', 'Write s', 'Total s', 'Deadhead m'))
+	for row in rows:
+		print('%-24s %-7s %9.2f %9.2f %9.2f %9.2f %12s' % (row['name'][:24], row['status'], row.get('fetch_s', 0), row.get('solve_s', 0),
+													  row.get('write_s', 0), row['total_s'],
+													  '%.1f' % row['deadhead_m'] if 'deadhead_m' in row else ''))
+		if 'error' in row:
+			print('    ' + row['error'])
+	print()
+
+
+def main(args):
+	# Solve every job in the job file across a process pool
+
+	jobs = load_jobs(args.job_file)
+	rows = []
+	start = time.perf_counter()
+	with ProcessPoolExecutor(max_workers=args.workers) as pool:
+		futures = {pool.submit(run_job, job, args.verbose):i for i, job in enumerate(jobs)}
+		for future in as_completed(futures):
+			row = future.result()
+			rows.append((futures[future], row))
+			print('[%d/%d] %s: %s in %.1fs' % (len(rows), len(jobs), row['name'], row['status'], row['total_s']))
+
+	rows = [row for _, row in sorted(rows, key=lambda item: item[0])]
+	print_summary(rows)
+	print('Solved %d of %d jobs in %.1fs' % (sum(row['status'] == 'ok' for row in rows), len(rows), time.perf_counter() - start))
+	write_summary(rows, args.summary)
+	return 0 if all(row['status'] == 'ok' for row in rows) else 1
+
+
+if __name__ == '__main__':
+	sys.exit(main(parse_args()))
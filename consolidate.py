@@ -0,0 +1,142 @@
+import numpy as np
+from pyproj import Transformer
+from shapely.geometry import LineString
+
+from graphcoords import edge_geometries
+
+
+def connected_labels(n, a, b):
+	# Label n items so that items joined by the pairs (a[i], b[i]) share a label.  Every
+	# label is the smallest index in its group.
+
+	labels = np.arange(n)
+	while True:
+		low = np.minimum(labels[a], labels[b])
+		new = labels.copy()
+		np.minimum.at(new, a, low)
+		np.minimum.at(new, b, low)
+		new = new[new]  # Follow labels to their own labels
+		if np.array_equal(new, labels):
+			return labels
+		labels = new
+
+
+def close_pairs(xy, distance):
+	# Return the index arrays (a, b) of every pair of points in an (n, 2) array at most
+	# distance apart.  Points are hashed into a grid of cells distance wide, so each point
+	# is only compared against the points in its own and neighbouring cells.
+
+	cells = np.floor(xy / distance).astype(np.int64)
+	cells -= cells.min(axis=0)
+	width = cells[:, 0].max() + 3
+	keys = cells[:, 0] + 1 + (cells[:, 1] + 1) * width
+	order = np.argsort(keys, kind='stable')
+	sorted_keys = keys[order]
+
+	pairs_a, pairs_b = [], []
+	# Half of the neighbouring cells, so that each pair of cells is visited once
+	for offset in (0, 1, width - 1, width, width + 1):
+		starts = np.searchsorted(sorted_keys, keys + offset, side='left')
+		counts = np.searchsorted(sorted_keys, keys + offset, side='right') - starts
+		a = np.repeat(np.arange(len(xy)), counts)
+		b = order[np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + np.repeat(starts, counts)]
+		if offset == 0:
+			keep = a < b
+			a, b = a[keep], b[keep]
+		close = ((xy[a] - xy[b])**2).sum(axis=1) <= distance**2
+		pairs_a.append(a[close])
+		pairs_b.append(b[close])
+	return np.concatenate(pairs_a), np.concatenate(pairs_b)
+
+
+def consolidate_intersections(G, tolerance, progress=None):
+	'''
+	Merge the nodes of a projected graph G into single nodes wherever they lie within
+	2*tolerance of each other, as osmnx.simplification.consolidate_intersections does when
+	rebuilding the graph.  Nodes in a cluster which are not joined by edges inside it stay
+	separate.  Merged nodes sit at the centroid of their cluster, keep the id of the first
+	node in it, and list the ids they replace in 'osmid_original'.  Returns a new graph.
+	If given, progress is called with the fraction of the work done, e.g. jobs.Job.report.
+	'''
+
+	if progress is None:
+		progress = lambda fraction, message=None: None
+
+	progress(0.0, 'Clustering nodes...')
+	node_ids = list(G.nodes)
+	node_row = dict(zip(node_ids, range(len(node_ids))))
+	xy = np.array([(G.nodes[id_]['x'], G.nodes[id_]['y']) for id_ in node_ids], dtype=np.float64).reshape(-1, 2)
+	edge_ids = list(G.edges)
+	us = np.array([node_row[u] for u, _, _ in edge_ids], dtype=np.int64)
+	vs = np.array([node_row[v] for _, v, _ in edge_ids], dtype=np.int64)
+
+	a, b = close_pairs(xy, 2 * tolerance) if len(xy) else (np.empty(0, dtype=np.int64),)*2
+	clusters = connected_labels(len(xy), a, b)
+
+	# Split clusters into the parts joined by edges inside them
+	progress(0.3, 'Splitting disconnected clusters...')
+	inside = clusters[us] == clusters[vs]
+	clusters = connected_labels(len(xy), us[inside], vs[inside])
+
+	# Position merged nodes at the centroids of their clusters
+	progress(0.5, 'Creating merged nodes...')
+	sizes = np.bincount(clusters, minlength=len(xy))
+	new_xy = np.stack([np.bincount(clusters, weights=xy[:, 0], minlength=len(xy)),
+					   np.bincount(clusters, weights=xy[:, 1], minlength=len(xy))], axis=1)
+	new_xy[sizes > 0] /= sizes[sizes > 0, None]
+	merged = sizes > 1
+
+	to_lat_lon = Transformer.from_crs(G.graph['crs'], 'EPSG:4326', always_xy=True)
+	merged_rows = np.flatnonzero(merged)
+	lons, lats = to_lat_lon.transform(new_xy[merged_rows, 0], new_xy[merged_rows, 1])
+
+	members = {}
+	for row, cluster in zip(np.flatnonzero(merged[clusters]).tolist(), clusters[merged[clusters]].tolist()):
+		members.setdefault(cluster, []).append(node_ids[row])
+
+	C = G.__class__(**G.graph)
+	nodes = {row:(node_ids[row], dict(G.nodes[node_ids[row]])) for row in np.flatnonzero(sizes == 1).tolist()}
+	for row, (x, y), lat, lon in zip(merged_rows.tolist(), new_xy[merged_rows].tolist(), np.atleast_1d(lats).tolist(),
+									 np.atleast_1d(lons).tolist()):
+		# Keep the attributes the merged nodes agree on
+		attrs = {}
+		for id_ in members[row]:
+			for key, value in G.nodes[id_].items():
+				attrs.setdefault(key, []).append(value)
+		data = {key:values[0] for key, values in attrs.items()
+				if len(values) == len(members[row]) and all(value == values[0] for value in values)}
+		data.update({'x':x, 'y':y, 'lat':lat, 'lon':lon, 'osmid_original':members[row]})
+		nodes[row] = (node_ids[row], data)
+	nodes = [nodes[row] for row in sorted(nodes)]
+	C.add_nodes_from(nodes)
+
+	# Rewire the edges to the cluster nodes, dropping edges inside clusters
+	progress(0.7, 'Rewiring edges...')
+	keep = (clusters[us] != clusters[vs]) | (us == vs)
+	moved = keep & (merged[clusters[us]] | merged[clusters[vs]])
+	new_ids = [node_ids[cluster] for cluster in clusters.tolist()]
+	edges = [(new_ids[u], new_ids[v], dict(data)) for (_, _, data), u, v, kept
+			 in zip(G.edges(data=True), us.tolist(), vs.tolist(), keep.tolist()) if kept]
+
+	# Extend the geometries of edges ending at merged nodes to reach them
+	moved_rows = np.flatnonzero(moved)
+	_, geoms = edge_geometries(G, [edge_ids[i] for i in moved_rows.tolist()])
+	data_index = np.cumsum(keep) - 1
+	for i, geom in zip(moved_rows.tolist(), geoms):
+		coords = list(geom.coords)
+		u, v = us[i], vs[i]
+		if np.hypot(*(np.subtract(coords[0], xy[v]))) < np.hypot(*(np.subtract(coords[0], xy[u]))):
+			u, v = v, u
+		if merged[clusters[u]]:
+			coords.insert(0, tuple(new_xy[clusters[u]]))
+		if merged[clusters[v]]:
+			coords.append(tuple(new_xy[clusters[v]]))
+		edges[data_index[i]][2]['geometry'] = LineString(coords)
+	C.add_edges_from(edges)
+
+	for row in merged_rows.tolist():
+		id_ = node_ids[row]
+		C.nodes[id_]['street_count'] = len(C.edges(id_))
+
+	progress(1.0)
+	return C
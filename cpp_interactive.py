@@ -1,34 +1,48 @@
 import os
 os.environ['PYGAME_HIDE_SUPPORT_PROMPT'] = "hide"
-import pygame
-import osmnx as ox
-from PIL import Image
-import csv
-import pickle
+import math
 import argparse
-
-from graphedit import GraphEdit
-from mapboxloader import MapboxLoader
-import cppsolver
-from routeviewer import RouteViewer
-
-
-# Parse arguments from user
-parser = argparse.ArgumentParser()
-parser.add_argument('coordinates', type=float, nargs=4, help='The latitude-longitude condinates of the upper left and lower right corners of the bounding box of the path network.')
-parser.add_argument('--network_type', type=str, default='drive', help='What type of street network to get. One of ‘walk’, ‘bike’, ‘drive’, ‘drive_service’, ‘all’, or ‘all_private’.')
-parser.add_argument('--map_type', type=str, default=None, help='What type of background image to display. One of ‘satellite’, ‘elevation’, ‘terrain’, or ‘streets’. If not specified, no background will be set.')
-parser.add_argument('--resolution', type=int, default=15, help='Resolution of the background image if applicable. An integer in [1, 20]. The higher the resolution, the longer the background image will take to generate.')
-parser.add_argument('--csv', type=str, default='path.csv', help='The name of the output csv file.')
-parser.add_argument('--verbose', action='store_true', help='Output information as the program runs.')
-parser.add_argument('--simplify', action='store_true', help='Simplify the graph to remove interstitial nodes. This feature is experimental and may produce undesirable results.')
-args = parser.parse_args()
+from concurrent.futures import ThreadPoolExecutor
+
+from jobs import Job
+
+# pygame, osmnx and the modules built on them take most of a second to import, so they
+# are imported by the methods which use them.  Neither parsing arguments nor running
+# headless from batch.py loads the editor.
+
+
+def parse_args(args=None):
+	# Parse arguments from user
+
+	parser = argparse.ArgumentParser()
+	parser.add_argument('coordinates', type=float, nargs=4, help='The latitude-longitude condinates of the upper left and lower right corners of the bounding box of the path network.')
+	parser.add_argument('--network_type', type=str, default='drive', help='What type of street network to get. One of ‘walk’, ‘bike’, ‘drive’, ‘drive_service’, ‘all’, or ‘all_private’.')
+	parser.add_argument('--map_type', type=str, default=None, help='What type of background image to display. One of ‘satellite’, ‘elevation’, ‘terrain’, or ‘streets’. If not specified, no background will be set.')
+	parser.add_argument('--resolution', type=int, default=15, help='Resolution of the background image if applicable. An integer in [1, 20]. The higher the resolution, the longer the background image will take to generate.')
+	parser.add_argument('--tile_source', type=str, default=None, help='An MBTiles file or a local {z}/{x}/{y}.png tile directory to build the background image from. If not specified, tiles are downloaded from Mapbox.')
+	parser.add_argument('--climb_factor', type=float, default=None, help='Penalize climbing by adding this many meters to an edge\'s cost for every meter climbed. Elevations are sampled from terrain-rgb tiles.')
+	parser.add_argument('--elevation_source', type=str, default=None, help='An MBTiles file or a local {z}/{x}/{y}.png directory of terrain-rgb tiles. If not specified, tiles are downloaded from Mapbox.')
+	parser.add_argument('--csv', type=str, default='path.csv', help='The name of the output csv file.')
+	parser.add_argument('--gpx', type=str, default=None, help='The name of an output gpx file, if one is wanted.')
+	parser.add_argument('--geojson', type=str, default=None, help='The name of an output geojson file, if one is wanted.')
+	parser.add_argument('--edge_counts', type=str, default=None, help='The name of an output csv file listing how many times the route traverses each edge, if one is wanted.')
+	parser.add_argument('--artifact', type=str, default='route', help='The directory to save the graph and route to for routeviewer.py.')
+	parser.add_argument('--solver_cache', type=str, default='solver_cache', help='The directory to save shortest path lengths and matchings to, so solving the same graph again, e.g. from another starting node, is fast. Pass an empty string to disable.')
+	parser.add_argument('--tracks', type=str, nargs='+', default=None, help='GPX or CSV tracks already ridden. The edges they cover are matched and the route only covers the rest.')
+	parser.add_argument('--match_radius', type=float, default=15.0, help='The largest distance in meters from a track point to the edge it is matched to.')
+	parser.add_argument('--undo_limit', type=int, default=200000, help='The number of nodes and edges the editor keeps to undo changes. The oldest changes are forgotten past this. Pass 0 for no limit.')
+	parser.add_argument('--verbose', action='store_true', help='Output information as the program runs.')
+	parser.add_argument('--simplify', action='store_true', help='Simplify the graph to remove interstitial nodes. This feature is experimental and may produce undesirable results.')
+	return parser.parse_args(args)
 
 # User Defined Functions
 
 class ChinesePostmanInteractive:
 
-	def __init__(self, tl, br, network_type='drive', map_type=None, resolution=15, verbose=True, simplify=False, out_file='path.csv'):
+	def __init__(self, tl, br, network_type='drive', map_type=None, resolution=15, verbose=True, simplify=False, out_file='path.csv', tile_source=None,
+				 climb_factor=None, elevation_source=None, artifact_dir='route', gpx=None, geojson=None, graph_file=None,
+				 solver_cache='solver_cache', edge_counts=None, tracks=None, match_radius=15.0,
+				 undo_limit=200000):
 
 		self.verbose = verbose
 		self.tl = tl
@@ -38,63 +52,157 @@ class ChinesePostmanInteractive:
 		self.simplify = simplify
 		self.map_type = map_type
 		self.csv = out_file
-
-		if self.verbose: print('Fetching graph data...')
-		self.G = self.get_graph()
-
-		if self.map_type:
-			self.bg_img, self.img_tl_lat_lon, self.img_br_lat_lon = self.get_bg_image(map_type)
+		self.tile_source = tile_source
+		self.climb_factor = climb_factor
+		self.elevation_source = elevation_source
+		self.artifact_dir = artifact_dir
+		self.gpx = gpx
+		self.geojson = geojson
+		self.graph_file = graph_file
+		self.solver_cache = solver_cache
+		self.edge_counts = edge_counts
+		self.tracks = tracks
+		self.match_radius = match_radius
+		self.undo_limit = undo_limit  # Nodes and edges the editor keeps for undo, or 0 for no limit
+		self.tiles = None  # A TilePyramid serving the background map, if one is loaded
+
+		# The graph download and the background tiles only depend on the bounding box,
+		# so fetch them at the same time.  The tiles keep loading while the graph is projected.
+		with ThreadPoolExecutor(max_workers=2) as pool:
+			if self.verbose: print('Fetching graph data...')
+			graph_future = pool.submit(self.fetch_graph)
+			if self.map_type:
+				tiles_future = pool.submit(self.get_bg_image, map_type)
+
+			self.G = self.project_graph(graph_future.result())
+			self.graph_fingerprint = self.fingerprint_graph()
+			if self.tracks:
+				self.mark_covered()
+			if self.map_type:
+				self.tiles = self.get_tiles_result(tiles_future)
+
+	def fingerprint_graph(self):
+		# Return a hash of the graph as fetched, before it is edited, which identifies the
+		# routes planned on it
+
+		from cppsolver import SolveCache
+		return SolveCache.graph_fingerprint(self.G)
+
+	def get_tiles_result(self, tiles_future):
+		# Return the background tiles once loaded.  If they could not be loaded, e.g. without a
+		# Mapbox API key or network access, carry on without a background.
+
+		try:
+			return tiles_future.result()
+		except Exception as e:
+			print('Could not load the background map, continuing without it (%s: %s)' % (type(e).__name__, e))
+			self.map_type = None
+			return None
 
 	def get_window_size(self, max_width=1440, max_height=848):
 		# Get the window size which matches the proportions of the graph G
 
-		x_bounds = GraphEdit.get_x_bounds(self.G)
-		y_bounds = GraphEdit.get_y_bounds(self.G)
-		width = int( max_height*(x_bounds[1] - x_bounds[0])/(y_bounds[1] - y_bounds[0]) )
+		from graphedit import GraphEdit
+		x_bounds, y_bounds = GraphEdit.get_bounds(self.G)
+		return self.fit_window_size(x_bounds[1] - x_bounds[0], y_bounds[1] - y_bounds[0], max_width, max_height)
+
+	def get_bbox_window_size(self, max_width=1440, max_height=848):
+		# Estimate the window size from the bounding box, before the graph is available
+
+		mean_lat = math.radians((self.tl[0] + self.br[0]) / 2)
+		x_span = abs(self.br[1] - self.tl[1]) * math.cos(mean_lat)
+		y_span = abs(self.tl[0] - self.br[0])
+		return self.fit_window_size(x_span, y_span, max_width, max_height)
+
+	@staticmethod
+	def fit_window_size(x_span, y_span, max_width, max_height):
+		# Get the largest window size with the proportions x_span:y_span
+
+		width = int( max_height*x_span/y_span )
 		if width <= max_width:
 			return (width, max_height)
-		height = int( max_width*(y_bounds[1] - y_bounds[0])/(x_bounds[1] - x_bounds[0]) )
+		height = int( max_width*y_span/x_span )
 		return (max_width, height)
 
 	def create_window(self, size, title=''):
 		# Open a window on the display and return its surface.
 
+		import pygame
 		pygame.init()
 		surface = pygame.display.set_mode(size)
 		pygame.display.set_caption(title)
 		return surface
 
 	def get_bg_image(self, img_type='satellite'):
+		# Create a tile pyramid for the background.  Tiles are loaded as the editor needs them.
 
-		Loader = MapboxLoader(self.tl, self.br, zoom=self.res, verbose=self.verbose)
-		img_tl_lat_lon = Loader.num2deg(*Loader.tl_tile, self.res)
-		img_br_lat_lon = Loader.num2deg(*Loader.br_tile, self.res)
-
-		img_id = str(sum((sum(self.tl), sum(self.br))) + self.res)
+		from mapboxloader import open_tile_source
+		from tilepyramid import TilePyramid
+		if self.verbose: print('Loading background tiles...')
+		source = open_tile_source(self.tile_source, img_type, cache_dir='./tiles/' + img_type)
+		tiles = TilePyramid(source, max_zoom=self.res)
+		tiles.prefetch(self.tl, self.br, self.get_bbox_window_size()[0])
+		return tiles
 
-		img_path = './composite_images/' + img_type + img_id + '.png'
-		if os.path.exists(img_path):
-			if self.verbose: print('Loading background image...')
-			return (Image.open(img_path), img_tl_lat_lon, img_br_lat_lon)
-		
-		if self.verbose: print('Generating background image...')
-		Loader.generate_data(img_type)
-		img = Loader.compose_image(img_type, remove_temp=True, save=True)
-		return (img, img_tl_lat_lon, img_br_lat_lon)
+	def fetch_graph(self):
+		# Download the road network inside the bounding box.  If a graph file is given it is
+		# loaded instead, or written after the download when it does not exist yet.
 
-	def get_graph(self):
+		import osmnx as ox
+		if self.graph_file and os.path.exists(self.graph_file):
+			return ox.load_graphml(self.graph_file)
 
 		g = ox.graph_from_bbox(self.tl[0],
 							   self.br[0],
 							   self.br[1],
 							   self.tl[1],
 							   network_type=self.network_type)
+		if self.graph_file:
+			ox.save_graphml(g, self.graph_file)
+		return g
+
+	@staticmethod
+	def project_graph(g):
+		# Project the graph to UTM and make it undirected
+
+		import osmnx as ox
 		g = ox.project_graph(g)
 		return g.to_undirected()
 
+	def mark_covered(self):
+		# Match the recorded tracks onto the graph and flag the edges they cover
+
+		import trackmatch
+		if self.verbose: print('Matching %d tracks to the graph...' % len(self.tracks))
+		trackmatch.mark_covered(self.G, self.tracks, self.match_radius, verbose=self.verbose)
+
+	def required_edges(self):
+		# Return the ids of the edges not yet covered by a recorded track, or None if none are
+
+		from trackmatch import is_covered
+		edge_ids = list(self.G.edges(keys=True))
+		required = [id_ for id_ in edge_ids if not is_covered(self.G.edges[id_])]
+		if len(required) == len(edge_ids):
+			return None
+		if not required:
+			raise ValueError('Every edge is already covered.')
+		return required
+
+	def add_climb_cost(self):
+		# Sample elevations for the graph and weight its edges by length and climbing
+
+		from mapboxloader import open_tile_source
+		import elevation
+		source = open_tile_source(self.elevation_source, 'elevation', cache_dir='./tiles/elevation')
+		sampler = elevation.ElevationSampler(source)
+		elevation.add_edge_elevation(self.G, sampler)
+		source.close()
+		return elevation.add_climb_cost(self.G, self.climb_factor)
+
 	def simplify_graph(self):
 		# Run osmnx's simplify_graph method to remove interstitial nodes
 
+		import osmnx as ox
 		self.G.graph['simplified'] = False
 
 		# We must make every value in each edge dict hashable
@@ -109,73 +217,127 @@ class ChinesePostmanInteractive:
 
 		self.G = ox.simplification.simplify_graph(self.G, strict=True, remove_rings=False)
 
-	def save_path(self, path):
-		# Save the final Eulerian circuit to a csv file
+	def nearest_node(self, lat, lon):
+		# Return the id of the node of the graph closest to a latitude and longitude
 
-		if self.csv[-4:] != '.csv':
-			self.csv += '.csv'
+		import numpy as np
+		from pyproj import Transformer
+		to_xy = Transformer.from_crs('EPSG:4326', self.G.graph['crs'], always_xy=True)
+		x, y = to_xy.transform(lon, lat)
+		node_ids = list(self.G.nodes)
+		xy = np.array([(self.G.nodes[id_]['x'], self.G.nodes[id_]['y']) for id_ in node_ids], dtype=np.float64)
+		return node_ids[int(np.argmin(np.hypot(xy[:, 0] - x, xy[:, 1] - y)))]
+
+	def solve(self, starting_node=None, progress=None):
+		# Simplify and weight the graph as requested and return an Eulerian circuit over it.
+		# If given, progress is called with the fraction of the work done, e.g. jobs.Job.report.
+
+		import cppsolver
+		if progress is None:
+			progress = lambda fraction, message=None: None
 
-		if self.verbose: print('Writing path to %s...' % self.csv)
+		if self.simplify:
+			if self.verbose: print('Simplifying graph...')
+			progress(0.0, 'Simplifying graph...')
+			self.simplify_graph()
 
-		with open(self.csv, 'w', newline='') as csvfile:
-			writer = csv.writer(csvfile, delimiter=',')
+		weight = 'length'
+		if self.climb_factor is not None:
+			if self.verbose: print('Sampling elevations...')
+			progress(0.0, 'Sampling elevations...')
+			weight = self.add_climb_cost()
+
+		# Only cover the edges which have not been ridden, starting from the nearest of their nodes
+		required = self.required_edges()
+		if required is not None:
+			if self.verbose: print('Covering the %d edges not covered by recorded tracks...' % len(required))
+			nodes = {n for id_ in required for n in id_[:2]}
+			if starting_node is not None and starting_node not in nodes:
+				start = self.G.nodes[starting_node]
+				starting_node = min(nodes, key=lambda n: math.hypot(self.G.nodes[n]['x'] - start['x'], self.G.nodes[n]['y'] - start['y']))
+				if self.verbose: print('Starting from node %s, the nearest node on an uncovered edge.' % starting_node)
 
-			writer.writerow(['START NODE', 
-							 'END NODE', 
-							 'NAME', 
-							 'START LAT', 
-							 'START LON', 
-							 'END LAT', 
-							 'END LON', 
-							 'LENGTH'])
+		if self.verbose: print('Solving Chinese Postman Problem on graph...')
+		return cppsolver.solve_cpp(self.G, starting_node, verbose=self.verbose, weight=weight, progress=progress,
+									required=required, cache_dir=self.solver_cache or None)
+
+	def save_results(self, eulerian_circuit):
+		# Write the route exports and the route artifact, and return the artifact
 
-			for edge in path:
-				n1, n2, data = edge
+		from routeartifact import RouteArtifact
+		artifact = RouteArtifact.from_route(self.G, eulerian_circuit, self.graph_fingerprint)
+		self.save_path(artifact)
 
-				n1_data = self.G.nodes[n1]
-				n2_data = self.G.nodes[n2]
+		if self.verbose: self.print_stats(artifact)
 
-				try:
-					name = data[0]['name'][0] if type(data[0]['name']) == list else data[0]['name']
-				except KeyError:
-					name = 'unknown'
+		if self.verbose: print('Writing route artifact to %s...' % self.artifact_dir)
+		artifact.save(self.artifact_dir)
+		return artifact
 
-				length = round(data[0]['length'], 3) if 'length' in data[0] else 0
+	def save_path(self, artifact):
+		# Save the final route to a csv file, and to gpx and geojson files if requested
 
-				writer.writerow([n1, 
-								 n2,
-								 name,
-								 n1_data['lat'],
-								 n1_data['lon'],
-								 n2_data['lat'],
-								 n2_data['lon'],
-								 length])
+		import exporters
+		if self.csv and self.csv[-4:] != '.csv':
+			self.csv += '.csv'
 
-	def print_stats(self, path):
-		# Print stats about the Eulerian circuit
+		for path in (self.csv, self.gpx, self.geojson):
+			if path:
+				if self.verbose: print('Writing path to %s...' % path)
+				exporters.export_route(artifact, path)
 
-		path_length = round(sum([e[2][0]['length'] for e in path if 'length' in e[2][0]]), 3)
+		if self.edge_counts:
+			if self.verbose: print('Writing edge traversal counts to %s...' % self.edge_counts)
+			exporters.write_edge_counts(artifact, self.edge_counts)
 
-		all_roads_length = round(sum([self.G.edges[e]['length'] for e in self.G.edges if 'length' in self.G.edges[e]]), 3)
+	def print_stats(self, artifact, top=5):
+		# Print stats about the route, and the streets with the most length traversed more than once
+
+		import numpy as np
+		counts = artifact.traversal_counts()
+		path_length = float(artifact.edge_length @ counts)
+		all_roads_length = float(artifact.edge_length[counts > 0].sum())  # Leaves out edges covered by earlier tracks
 
 		print()
 		print('Total length of route:           %.3fm' % path_length)
 		print('Combined length of all paths:    %.3fm' % all_roads_length)
 		print('Length of paths traversed twice: %.3fm' % (path_length - all_roads_length))
+
+		names = artifact.meta['names'] + ['unknown']
+		repeated = np.bincount(artifact.edge_name % len(names), np.maximum(counts - 1, 0) * artifact.edge_length, minlength=len(names))
+		for i in np.argsort(-repeated)[:top]:
+			if repeated[i] > 0:
+				print('    %-28s %.3fm' % (names[i][:28], repeated[i]))
 		print()
 
+	def load_traversals(self):
+		# Return the traversal counts of the edges in the route previously saved to the artifact
+		# directory, keyed by edge id, or None if there is no readable route there.  Routes
+		# planned on a different graph, e.g. for another bounding box, are not used.
+
+		from routeartifact import RouteArtifact
+		try:
+			artifact = RouteArtifact.load(self.artifact_dir)
+		except (OSError, ValueError, KeyError):
+			return None
+		if artifact.meta.get('graph_fingerprint') != self.graph_fingerprint:
+			print('Not showing traversal counts from the route in %s, as it was planned on a different graph.' % self.artifact_dir)
+			return None
+		return artifact.edge_traversals()
+
 	def main(self):
 		# The main routine
 
+		import pygame
+		from graphedit import GraphEdit
 		if self.verbose: print('Loading graph editor...')
 		window_size = self.get_window_size()
 		surface = self.create_window(window_size, title='Chinese Postman Interactive')
+		traversals = self.load_traversals()
 		if self.map_type:
-			graph_edit = GraphEdit(self.G, surface, window_size, (self.bg_img, 
-																  self.img_tl_lat_lon, 
-																  self.img_br_lat_lon))
+			graph_edit = GraphEdit(self.G, surface, window_size, self.tiles, undo_limit=self.undo_limit, traversals=traversals)
 		else:
-			graph_edit = GraphEdit(self.G, surface, window_size)
+			graph_edit = GraphEdit(self.G, surface, window_size, undo_limit=self.undo_limit, traversals=traversals)
 
 		graph_edit.edit_graph()
 		if not graph_edit.get_finished():
@@ -183,28 +345,20 @@ class ChinesePostmanInteractive:
 			return
 		self.G = graph_edit.get_graph()
 		starting_node = graph_edit.get_start_node()
-		pygame.quit()
-
-		if self.simplify:
-			if self.verbose: print('Simplifying graph...')
-			self.simplify_graph()
-
-		if self.verbose: print('Solving Chinese Postman Problem on graph...')
-		eulerian_circuit = cppsolver.solve_cpp(self.G, starting_node)
-
-		self.save_path(eulerian_circuit)
 
-		if self.verbose: self.print_stats(eulerian_circuit)
-
-		route = [eulerian_circuit[0][0]] + [e[1] for e in eulerian_circuit]
-
-		if self.verbose: print('Writing pickle files...')
-		with open('graph.pkl', 'wb') as graph_file:
-			pickle.dump(self.G, graph_file)
-		with open('route.pkl', 'wb') as route_file:
-			pickle.dump(route, route_file)
+		# Solve on a worker thread, showing progress in the editor window
+		solve = lambda job: self.solve(starting_node, progress=job.report)
+		job = graph_edit.run_job(Job(solve, 'Solving Chinese Postman Problem...'))
+		pygame.quit()
+		if job.cancelled:
+			if self.verbose: print('Computation aborted.')
+			return
+		if job.error is not None:
+			raise job.error
+		self.save_results(job.result)
 
 if __name__ == '__main__':
+	args = parse_args()
 	tl = (args.coordinates[0], args.coordinates[1])
 	br = (args.coordinates[2], args.coordinates[3])
 	cpi = ChinesePostmanInteractive(tl, br, 
@@ -213,5 +367,16 @@ if __name__ == '__main__':
 									resolution=args.resolution,
 									verbose=args.verbose,
 									simplify=args.simplify,
-									out_file=args.csv)
+									out_file=args.csv,
+									tile_source=args.tile_source,
+									climb_factor=args.climb_factor,
+									elevation_source=args.elevation_source,
+									artifact_dir=args.artifact,
+									gpx=args.gpx,
+									geojson=args.geojson,
+									solver_cache=args.solver_cache,
+									edge_counts=args.edge_counts,
+									tracks=args.tracks,
+									match_radius=args.match_radius,
+									undo_limit=args.undo_limit)
 	cpi.main()
\ No newline at end of file
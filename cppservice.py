@@ -0,0 +1,247 @@
+import os
+import json
+import time
+import argparse
+import threading
+import numpy as np
+import networkx as nx
+from collections import OrderedDict
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from pyproj import Transformer
+
+from cpp_interactive import ChinesePostmanInteractive
+import cppsolver
+
+
+class GraphEntry:
+	# A loaded graph with the arrays and solver caches kept between the requests using it
+
+	def __init__(self, G, cache_dir=None):
+
+		self.G = G
+		self.cache_dir = cache_dir  # Where the solver caches are saved, if anywhere
+		self.lock = threading.Lock()  # Held while solving, as the solver caches are not thread safe
+		self.caches = {}  # edge weight -> cppsolver.SolveCache
+		self.requests = 0
+
+		self.node_ids = list(G.nodes)
+		node_row = dict(zip(self.node_ids, range(len(self.node_ids))))
+		xy = np.array([(G.nodes[id_]['x'], G.nodes[id_]['y']) for id_ in self.node_ids], dtype=np.float64).reshape(-1, 2)
+		self.to_xy = Transformer.from_crs('EPSG:4326', G.graph['crs'], always_xy=True)
+		lons, lats = Transformer.from_crs(G.graph['crs'], 'EPSG:4326', always_xy=True).transform(xy[:, 0], xy[:, 1])
+		self.node_xy = xy
+		self.node_lat_lon = np.stack([lats, lons], axis=1).reshape(-1, 2)
+		self.edge_ids = list(G.edges(keys=True))
+		self.edge_nodes = np.array([(node_row[u], node_row[v]) for u, v, _ in self.edge_ids], dtype=np.int64).reshape(-1, 2)
+
+	def cache(self, weight='length'):
+		# Return the solver cache for an edge weight
+
+		if weight not in self.caches:
+			self.caches[weight] = cppsolver.SolveCache(self.G, weight, directory=self.cache_dir)
+		return self.caches[weight]
+
+	def area_edges(self, tl, br):
+		# Return the ids of the edges with both ends inside a latitude-longitude box
+
+		lat_lo, lat_hi = sorted((tl[0], br[0]))
+		lon_lo, lon_hi = sorted((tl[1], br[1]))
+		lats, lons = self.node_lat_lon[:, 0], self.node_lat_lon[:, 1]
+		inside = (lats >= lat_lo) & (lats <= lat_hi) & (lons >= lon_lo) & (lons <= lon_hi)
+		rows = np.flatnonzero(inside[self.edge_nodes[:, 0]] & inside[self.edge_nodes[:, 1]])
+		return [self.edge_ids[row] for row in rows.tolist()]
+
+	def nearest_node(self, lat, lon, among=None):
+		# Return the id of the node closest to a latitude and longitude, out of the node ids
+		# among if given
+
+		x, y = self.to_xy.transform(lon, lat)
+		if among is None:
+			rows = np.arange(len(self.node_ids))
+		else:
+			node_row = {id_:row for row, id_ in enumerate(self.node_ids)}
+			rows = np.array([node_row[id_] for id_ in among], dtype=np.int64)
+		d = np.hypot(self.node_xy[rows, 0] - x, self.node_xy[rows, 1] - y)
+		return self.node_ids[int(rows[np.argmin(d)])]
+
+	def describe(self):
+		# Return a summary of the entry
+
+		return {'nodes':len(self.node_ids),
+				'edges':len(self.edge_ids),
+				'requests':self.requests,
+				'pair_lengths':sum(len(cache.lengths) for cache in self.caches.values()),
+				'matchings':sum(len(cache.matchings) for cache in self.caches.values())}
+
+
+class SolverService:
+	# Solve Chinese Postman requests, keeping the most recently used graphs and their
+	# shortest path caches in memory.  Requests name the graph by its bounding box, network
+	# type and optional GraphML file, as in a batch.py job.
+
+	def __init__(self, max_graphs=4, verbose=False, cache_dir=None):
+
+		self.max_graphs = max_graphs
+		self.cache_dir = cache_dir
+		self.verbose = verbose
+		self.graphs = OrderedDict()  # graph key -> GraphEntry
+		self.lock = threading.Lock()
+		self.load_lock = threading.Lock()
+
+	@staticmethod
+	def graph_key(request):
+
+		graph_file = request.get('graph')
+		return (tuple(round(float(c), 7) for c in request['bbox']),
+				request.get('network_type', 'drive'),
+				os.path.abspath(graph_file) if graph_file else None)
+
+	def get_graph(self, request):
+		# Return the entry for the graph of a request and whether it was already loaded
+
+		key = self.graph_key(request)
+		with self.lock:
+			if key in self.graphs:
+				self.graphs.move_to_end(key)
+				return self.graphs[key], True
+
+		with self.load_lock:
+			with self.lock:
+				if key in self.graphs:
+					return self.graphs[key], True
+			bbox, network_type, graph_file = key
+			if self.verbose: print('Loading graph for %s...' % (key,))
+			cpi = ChinesePostmanInteractive(bbox[:2], bbox[2:], network_type=network_type, verbose=False, graph_file=graph_file)
+			entry = GraphEntry(cpi.G, self.cache_dir)
+
+		with self.lock:
+			self.graphs[key] = entry
+			while len(self.graphs) > self.max_graphs:
+				self.graphs.popitem(last=False)
+		return entry, False
+
+	def solve(self, request):
+		# Solve a request and return a summary and the Eulerian circuit.  Requests may give
+		# 'required' edges as [u, v, key] lists, or an 'area' box whose edges are required,
+		# and a 'start' node id or 'start_point' latitude-longitude.
+
+		start = time.perf_counter()
+		entry, cached = self.get_graph(request)
+		loaded = time.perf_counter()
+
+		required = request.get('required')
+		if required is None and request.get('area'):
+			area = request['area']
+			required = entry.area_edges(area[:2], area[2:])
+			if not required:
+				raise ValueError('There are no edges inside the area.')
+
+		with entry.lock:
+			entry.requests += 1
+			starting_node = request.get('start')
+			if starting_node is None and request.get('start_point'):
+				among = {n for edge_id in required for n in edge_id[:2]} if required else None
+				starting_node = entry.nearest_node(*request['start_point'], among=among)
+			circuit = cppsolver.solve_cpp(entry.G, starting_node, verbose=False, weight=request.get('weight', 'length'),
+										  required=required, cache=entry.cache(request.get('weight', 'length')))
+		solved = time.perf_counter()
+
+		lengths = [next(iter(data.values())).get('length', 0) for _, _, data in circuit]
+		summary = {'graph_cached':cached,
+				   'load_ms':round(1000 * (loaded - start), 1),
+				   'solve_ms':round(1000 * (solved - loaded), 1),
+				   'steps':len(circuit),
+				   'length':round(sum(lengths), 3),
+				   'start':circuit[0][0] if circuit else starting_node}
+		return summary, circuit
+
+
+class ServiceHandler(BaseHTTPRequestHandler):
+	# POST /solve solves a JSON request and writes the summary and then one circuit step
+	# per line as newline delimited JSON, in chunks of chunk_size steps.  The circuit is
+	# solved in full before the response starts, so only its output is streamed.  GET
+	# /graphs lists the loaded graphs.
+
+	service = None
+	chunk_size = 2048
+
+	def do_GET(self):
+
+		if self.path == '/graphs':
+			with self.service.lock:
+				graphs = [dict(entry.describe(), bbox=key[0], network_type=key[1], graph=key[2])
+						  for key, entry in self.service.graphs.items()]
+			self.send_json(200, {'graphs':graphs})
+		elif self.path == '/health':
+			self.send_json(200, {'status':'ok'})
+		else:
+			self.send_json(404, {'error':'Unknown path: %s' % self.path})
+
+	def do_POST(self):
+
+		if self.path != '/solve':
+			return self.send_json(404, {'error':'Unknown path: %s' % self.path})
+		try:
+			request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+			summary, circuit = self.service.solve(request)
+		except (ValueError, KeyError, TypeError, nx.NetworkXException) as e:
+			return self.send_json(400, {'error':'%s: %s' % (type(e).__name__, e)})
+		except Exception as e:
+			return self.send_json(500, {'error':'%s: %s' % (type(e).__name__, e)})
+
+		self.send_response(200)
+		self.send_header('Content-Type', 'application/x-ndjson')
+		self.end_headers()
+		self.wfile.write((json.dumps(summary) + '\n').encode())
+		for i in range(0, len(circuit), self.chunk_size):
+			lines = []
+			for u, v, data in circuit[i:i+self.chunk_size]:
+				key, edge = next(iter(data.items()))
+				name = edge.get('name')
+				lines.append(json.dumps({'u':u, 'v':v, 'key':key, 'length':round(edge.get('length', 0), 3),
+										 'name':name[0] if type(name) == list else name}))
+			self.wfile.write(('\n'.join(lines) + '\n').encode())
+			self.wfile.flush()
+
+	def send_json(self, status, body):
+
+		data = json.dumps(body).encode()
+		self.send_response(status)
+		self.send_header('Content-Type', 'application/json')
+		self.send_header('Content-Length', str(len(data)))
+		self.end_headers()
+		self.wfile.write(data)
+
+	def log_message(self, format, *args):
+
+		if self.service.verbose:
+			super().log_message(format, *args)
+
+
+def parse_args(args=None):
+	# Parse arguments from user
+
+	parser = argparse.ArgumentParser(description='Serve Chinese Postman solves over HTTP, keeping recently used graphs in memory.')
+	parser.add_argument('--host', type=str, default='127.0.0.1', help='The address to listen on.')
+	parser.add_argument('--port', type=int, default=8765, help='The port to listen on.')
+	parser.add_argument('--max_graphs', type=int, default=4, help='The number of graphs to keep in memory.')
+	parser.add_argument('--solver_cache', type=str, default=None, help='A directory to also save shortest path lengths and matchings to, so they outlive the service.')
+	parser.add_argument('--verbose', action='store_true', help='Log requests and graph loads.')
+	return parser.parse_args(args)
+
+
+def main(args):
+	# Serve until interrupted
+
+	ServiceHandler.service = SolverService(args.max_graphs, args.verbose, args.solver_cache)
+	server = ThreadingHTTPServer((args.host, args.port), ServiceHandler)
+	print('Serving on http://%s:%d' % server.server_address[:2])
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
+	server.server_close()
+
+
+if __name__ == '__main__':
+	main(parse_args())
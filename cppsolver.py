@@ -1,61 +1,300 @@
-import osmnx as ox
+import os
+import time
+import hashlib
+import tempfile
+import numpy as np
 import networkx as nx
-import pandas as pd
 from networkx.algorithms.matching import max_weight_matching
 from networkx.algorithms.components import is_connected
-from itertools import combinations
+from itertools import combinations, count
+from heapq import heappush, heappop
 
-def solve_cpp(G, starting_node=None, verbose=True):
+
+class SolveCache:
+	# Shortest path lengths, paths and matchings over a graph which are kept between solves,
+	# e.g. by cppservice.py.  Lengths are found by Dijkstra searches that stop once every
+	# node asked for has been reached, and only the lengths between requested nodes are kept.
+	# If a directory is given, the cache is saved there under a fingerprint of the graph and
+	# loaded again by later solves on the same graph, including solves that were killed.
+
+	def __init__(self, G, weight='length', directory=None, checkpoint_interval=30):
+
+		self.G = G
+		self.weight = weight
+		self.lengths = {}  # (u, v) with u <= v -> shortest path length
+		self.paths = {}  # (u, v) with u <= v -> list of nodes on the shortest path from u to v
+		self.matchings = {}  # frozenset of odd nodes -> list of matched node pairs
+
+		self.directory = directory
+		self.checkpoint_interval = checkpoint_interval  # Seconds between saves while searching
+		self.last_save = time.monotonic()
+		self.unsaved = False
+		self.save_failed = False  # Whether a save has failed, so the failure is only reported once
+		if self.directory:
+			self.fingerprint = self.graph_fingerprint(G, weight)
+			self.load()
+
+		# The lightest edge between each pair of neighbours
+		self.adj = {}
+		for u, neighbours in G.adj.items():
+			self.adj[u] = [(v, min(data.get(weight, 1) for data in keydict.values()))
+						   for v, keydict in neighbours.items() if v != u]
+
+	@staticmethod
+	def graph_fingerprint(G, weight='length'):
+		# Return a hash of the nodes, edges and edge weights of a graph
+
+		edges = sorted((min(u, v), max(u, v), key, data.get(weight, 1)) for u, v, key, data in G.edges(keys=True, data=True))
+		h = hashlib.sha256(weight.encode())
+		h.update(np.array(sorted(G.nodes), dtype=np.int64).tobytes())
+		h.update(np.array([edge[:3] for edge in edges], dtype=np.int64).tobytes())
+		h.update(np.array([edge[3] for edge in edges], dtype=np.float64).tobytes())
+		return h.hexdigest()[:32]
+
+	def file_path(self):
+
+		return os.path.join(self.directory, self.fingerprint + '.npz')
+
+	def load(self):
+		# Load the cache saved for this graph, if there is one
+
+		if not os.path.exists(self.file_path()):
+			return
+		with np.load(self.file_path()) as data:
+			pairs = data['pairs'].tolist()
+			self.lengths.update(zip(map(tuple, pairs), data['lengths'].tolist()))
+			nodes, offsets = data['path_nodes'].tolist(), data['path_offsets'].tolist()
+			for pair, a, b in zip(data['path_pairs'].tolist(), offsets[:-1], offsets[1:]):
+				self.paths[tuple(pair)] = nodes[a:b]
+			matched, offsets = data['matched'].tolist(), data['matching_offsets'].tolist()
+			for a, b in zip(offsets[:-1], offsets[1:]):
+				matching = list(map(tuple, matched[a:b]))
+				self.matchings[frozenset(n for pair in matching for n in pair)] = matching
+		self.last_save = time.monotonic()
+
+	def save(self):
+		# Write the cache to its directory.  Each save writes its own temporary file, which
+		# replaces the cache file in one step, so a solve killed while saving leaves the
+		# previous checkpoint and processes sharing the directory do not collide.  A failed
+		# write is reported, but never fails the solve.
+
+		if not self.directory or not self.unsaved:
+			return
+		tmp_path = None
+		try:
+			os.makedirs(self.directory, exist_ok=True)
+			fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.npz')
+			self.write(fd)
+			os.replace(tmp_path, self.file_path())
+		except OSError as e:
+			if not self.save_failed:
+				print('Could not save the solver cache to %s (%s)' % (self.directory, e))
+			self.save_failed = True
+			if tmp_path and os.path.exists(tmp_path):
+				os.remove(tmp_path)
+		else:
+			self.unsaved = False
+		self.last_save = time.monotonic()
+
+	def write(self, fd):
+		# Write the cache as arrays to an open file descriptor, which is closed afterwards
+
+		paths = list(self.paths.items())
+		matchings = list(self.matchings.values())
+		offsets = lambda lists: np.cumsum([0] + [len(items) for items in lists], dtype=np.int64)
+		with os.fdopen(fd, 'wb') as cache_file:
+			np.savez(cache_file,
+					 pairs=np.array(list(self.lengths), dtype=np.int64).reshape(-1, 2),
+					 lengths=np.array(list(self.lengths.values()), dtype=np.float64),
+					 path_pairs=np.array([pair for pair, _ in paths], dtype=np.int64).reshape(-1, 2),
+					 path_nodes=np.array([n for _, path in paths for n in path], dtype=np.int64),
+					 path_offsets=offsets([path for _, path in paths]),
+					 matched=np.array([pair for matching in matchings for pair in matching], dtype=np.int64).reshape(-1, 2),
+					 matching_offsets=offsets(matchings))
+
+	def checkpoint(self):
+		# Save the cache if it has changed and the last save was long enough ago
+
+		if self.unsaved and time.monotonic() - self.last_save > self.checkpoint_interval:
+			self.save()
+
+	@staticmethod
+	def key(u, v):
+
+		return (u, v) if u <= v else (v, u)
+
+	def settled(self, sources):
+		# Yield (node, length, source) for every node reachable from any of sources, in order
+		# of the length of the shortest path to it from the nearest source
+
+		best = {}
+		done = set()
+		tie = count()
+		heap = []
+		for source in sources:
+			best[source] = 0
+			heappush(heap, (0, next(tie), source, source))
+		while heap:
+			length, _, u, source = heappop(heap)
+			if u in done:
+				continue
+			done.add(u)
+			yield u, length, source
+			for v, w in self.adj[u]:
+				if v not in done and length + w < best.get(v, float('inf')):
+					best[v] = length + w
+					heappush(heap, (length + w, next(tie), v, source))
+
+	def pair_lengths(self, nodes, progress=None):
+		'''
+		Return a dictionary of the shortest path length between every pair of nodes, keyed
+		on node pairs (tuples).  Lengths which are not known yet are found by searching from
+		each node until the nodes after it have all been reached.  Progress is reported as
+		the first 60% of the solve.
+		'''
+
+		nodes = list(nodes)
+		step = max(len(nodes) // 100, 1)
+		for i, u in enumerate(nodes):
+			if progress and i % step == 0:
+				progress(0.6 * (1 - (1 - i / len(nodes))**2))
+			targets = {v for v in nodes[i+1:] if self.key(u, v) not in self.lengths}
+			if not targets:
+				continue
+			for v, length, _ in self.settled([u]):
+				if v in targets:
+					self.lengths[self.key(u, v)] = length
+					targets.discard(v)
+					if not targets:
+						break
+			if targets:
+				raise nx.NetworkXNoPath('No path from %s to %s.' % (u, next(iter(targets))))
+			self.unsaved = True
+			self.checkpoint()
+		return {(u, v): self.lengths[self.key(u, v)] for u, v in combinations(nodes, 2)}
+
+	def path(self, u, v):
+		# Return the nodes on the shortest path from u to v
+
+		key = self.key(u, v)
+		if key not in self.paths:
+			self.paths[key] = nx.dijkstra_path(self.G, key[0], key[1], weight=self.weight)
+			self.unsaved = True
+		path = self.paths[key]
+		return path if path[0] == u else path[::-1]
+
+	def connect(self, components):
+		'''
+		Return the node pairs whose shortest paths join the components, a list of node sets,
+		along a minimum spanning tree of the distances between the components.
+		'''
+
+		component_of = {n: i for i, component in enumerate(components) for n in component}
+		g = nx.Graph()
+		for i, component in enumerate(components):
+			remaining = set(range(len(components))) - {i}
+			for v, length, u in self.settled(component):
+				j = component_of.get(v, i)
+				if j in remaining:
+					# The first node reached in a component is its nearest to this one
+					if not g.has_edge(i, j) or length < g.edges[i, j]['weight']:
+						g.add_edge(i, j, weight=length, pair=(u, v))
+					remaining.discard(j)
+					if not remaining:
+						break
+		if not nx.is_connected(g) or len(g) < len(components):
+			raise nx.NetworkXNoPath('The required edges are not connected by the graph.')
+		return [data['pair'] for _, _, data in nx.minimum_spanning_edges(g, data=True)]
+
+
+def solve_cpp(G, starting_node=None, verbose=True, weight='length', progress=None, required=None, cache=None, cache_dir=None):
 	''' 
 	Find the most efficient path over all edges in the graph G.  That is, solve the 
-	Chinese Postman Problem on G.
+	Chinese Postman Problem on G.  The edge attribute weight is minimized, e.g. 'length',
+	or 'climb_cost' from elevation.add_climb_cost.  If given, progress is called with the
+	fraction of the work done and a description of the current step, e.g. jobs.Job.report.
+	If required is given, only those edges, as (u, v, key) tuples, must be covered and the
+	others are only travelled between them.  Separate groups of required edges are first
+	joined by shortest paths, so the route is then near, not always at, the minimum.  cache
+	is a SolveCache over G to reuse the paths and matchings of earlier solves.  Otherwise, if
+	cache_dir is given, they are saved there and reused by later solves of the same graph.
 	'''
 
+	if progress is None:
+		progress = lambda fraction, message=None: None
+
 	# Graph must be undirected and connected
 	if nx.is_directed(G):
 		if verbose: print('Graph is directed. Converting to undirected.')
 		G = G.to_undirected()
-	assert is_connected(G), 'Graph is not connected.'
+	if cache is None:
+		cache = SolveCache(G, weight, directory=cache_dir)
+		if verbose and cache.lengths: print('    Reusing %d saved shortest path lengths...' % len(cache.lengths))
+
+	if required is None:
+		assert is_connected(G), 'Graph is not connected.'
+		G_req = nx.MultiGraph(G)
+	else:
+		required = [tuple(edge_id) for edge_id in required]
+		missing = [edge_id for edge_id in required if not G.has_edge(*edge_id)]
+		if missing:
+			raise ValueError('Required edges are not in the graph: %s' % missing[:5])
+		G_req = nx.MultiGraph(G.edge_subgraph(required))
+	for edge_id in G_req.edges:
+		G_req.edges[edge_id]['trail'] = 'original'
+
+	# Join separate groups of required edges
+	if required is not None:
+		components = list(nx.connected_components(G_req))
+		if len(components) > 1:
+			if verbose: print('    Joining %d groups of required edges...' % len(components))
+			progress(0.0, 'Joining required edges...')
+			for u, v in cache.connect(components):
+				G_req.add_edge(u, v, length=cache.pair_lengths([u, v])[(u, v)], trail='augmented')
+
+	if starting_node is not None and starting_node not in G_req:
+		raise ValueError('The starting node %s is not on an edge to be covered.' % starting_node)
 
 	# Get a list of all nodes of odd degree
-	odd_deg_nodes = [n for n, d in G.degree if d % 2 == 1]
-	
-	# Get a list of all pairs of odd degree nodes
-	odd_node_pairs = list(combinations(odd_deg_nodes, 2))
+	odd_deg_nodes = [n for n, d in G_req.degree if d % 2 == 1]
 
-	# Get the length of the shortest path between each pair of nodes
-	if verbose: print('    Getting shortest path length between all odd node pairs...')
-	odd_node_pairs_shortest_paths = _get_shortest_paths_lengths(G, odd_node_pairs, 'length')
+	# A saved matching of the same odd nodes is still the best one, since the graph is the same
+	odd_matching = cache.matchings.get(frozenset(odd_deg_nodes))
+	if odd_matching is not None:
+		if verbose: print('    Reusing saved matching of odd nodes...')
+	else:
+		# Get the length of the shortest path between each pair of nodes
+		if verbose: print('    Getting shortest path length between all odd node pairs...')
+		progress(0.0, 'Getting shortest path lengths...')
+		odd_node_pairs_shortest_paths = cache.pair_lengths(odd_deg_nodes, progress)
+		cache.save()
 
-	# Create a completely connected graph using the odd nodes and the shortest path lengths between them
-	g_odd_complete = _create_complete_graph(odd_node_pairs_shortest_paths)
+		# Create a completely connected graph using the odd nodes and the shortest path lengths between them
+		g_odd_complete = _create_complete_graph(odd_node_pairs_shortest_paths)
 
-	# Compute minimum weight matching. Takes O(n ** 3) time
-	if verbose: print('    Performing minimum weight matching...')
-	odd_matching_dupes = max_weight_matching(g_odd_complete, True)
+		# Compute minimum weight matching. Takes O(n ** 3) time
+		if verbose: print('    Performing minimum weight matching...')
+		progress(0.6, 'Performing minimum weight matching...')
+		odd_matching_dupes = max_weight_matching(g_odd_complete, True)
 
-	# Remove duplicate minimum weight pairs
-	odd_matching = list(pd.unique([tuple(sorted([n1, n2])) for n1, n2 in odd_matching_dupes]))
+		# Remove duplicate minimum weight pairs
+		odd_matching = list(dict.fromkeys([tuple(sorted([n1, n2])) for n1, n2 in odd_matching_dupes]))
+		cache.matchings[frozenset(odd_deg_nodes)] = odd_matching
+		cache.unsaved = True
+	cache.save()
 
 	# Add the min weight matching edges to the original graph
-	G_aug = _add_augmenting_path_to_graph(G, odd_matching)
+	progress(0.8, 'Adding augmenting paths...')
+	G_aug = _add_augmenting_path_to_graph(G_req, odd_matching, {pair: cache.lengths[cache.key(*pair)] for pair in odd_matching})
 
 	if verbose: print('    Creating Eulerian circuit...')
-	return _create_eulerian_circuit(G_aug, G, starting_node=starting_node)
+	progress(0.9, 'Creating Eulerian circuit...')
+	euler_circuit = _create_eulerian_circuit(G_aug, G, cache, starting_node=starting_node)
+	cache.save()
+	return euler_circuit
 
 	#circuit_nodes = [eulerian_circuit[0][0]] + [n[1] for n in eulerian_circuit]
 
-def _get_shortest_paths_lengths(G, pairs, edge_weight_name):
-	'''
-	Compute shortest distance between each pair of nodes in a graph.  Return a 
-	dictionary keyed on node pairs (tuples).
-	'''
-
-	path_lengths = {}
-	for pair in pairs:
-		path_lengths[pair] = nx.dijkstra_path_length(G, pair[0], pair[1], weight=edge_weight_name)
-	return path_lengths
-
 def _create_complete_graph(pair_weights, flip_weights=True):
 	'''
 	Create a completely connected graph using a list of vertex pairs and the 
@@ -72,59 +311,50 @@ def _create_complete_graph(pair_weights, flip_weights=True):
 		g.add_edge(k[0], k[1], **{'length': v, 'weight': wt_i})  
 	return g
 
-def _add_augmenting_path_to_graph(G, min_weight_pairs):
+def _add_augmenting_path_to_graph(G, min_weight_pairs, pair_lengths):
 	'''
-	Add the min weight matching edges to the original graph
+	Add the min weight matching edges to the graph of edges to cover
 	Parameters:
-		G: NetworkX graph 
+		G: NetworkX MultiGraph whose edges have a trail attribute, which is modified
 		min_weight_pairs: list[tuples] of node pairs from min weight matching
+		pair_lengths: dict of the shortest path lengths between the pairs
 	Returns:
 		augmented NetworkX graph
 	'''
 
-	# We need to make the augmented graph a MultiGraph so we can add parallel edges
-	G_aug = nx.MultiGraph(G.copy())
 	for pair in min_weight_pairs:
-		G_aug.add_edge(pair[0], 
-					   pair[1], 
-					   **{'length': nx.dijkstra_path_length(G, pair[0], pair[1]), 'trail': 'augmented'})
-
-	# Make sure each edge has a trail attribute
-	for edge_id in G_aug.edges:
-		if 'trail' not in G_aug.edges[edge_id]:
-			G_aug.edges[edge_id]['trail'] = 'original'
-
-	return G_aug
+		G.add_edge(pair[0], pair[1], **{'length': pair_lengths[pair], 'trail': 'augmented'})
+	return G
 
-def _create_eulerian_circuit(graph_augmented, graph_original, starting_node=None):
+def _create_eulerian_circuit(graph_augmented, graph_original, cache, starting_node=None):
 	'''
-	Create the Eulerian path using only edges from the original graph.
+	Create the Eulerian path using only edges from the original graph.  Each step is
+	(u, v, {key: edge data}) for the edge of the original graph it traverses.
 	'''
 
 	euler_circuit = []
-	naive_circuit = list(nx.eulerian_circuit(graph_augmented, source=starting_node))
+	naive_circuit = nx.eulerian_circuit(graph_augmented, source=starting_node, keys=True)
 
-	for edge in naive_circuit:
-		edge_data = graph_augmented.get_edge_data(edge[0], edge[1])
-
-		if edge_data[0]['trail'] != 'augmented':
+	for u, v, key in naive_circuit:
+		if graph_augmented.edges[u, v, key]['trail'] != 'augmented':
 			# If 'edge' exists in original graph, grab the edge attributes and add to eulerian circuit.
-			edge_att = graph_original[edge[0]][edge[1]]
-			euler_circuit.append((edge[0], edge[1], dict(edge_att))) 
+			euler_circuit.append((u, v, {key: dict(graph_original.edges[u, v, key])}))
 		else: 
-			aug_path = nx.shortest_path(graph_original, edge[0], edge[1], weight='length')
-			aug_path_pairs = list(zip(aug_path[:-1], aug_path[1:]))
+			aug_path = cache.path(u, v)
 
-			# If 'edge' does not exist in original graph, find the shortest path between its nodes and 
-			# add the edge attributes for each link in the shortest path.
-			for edge_aug in aug_path_pairs:
-				edge_aug_att = graph_original[edge_aug[0]][edge_aug[1]]
-				euler_circuit.append((edge_aug[0], edge_aug[1], dict(edge_aug_att)))
+			# If 'edge' does not exist in original graph, follow the shortest path between its nodes
+			# and add the attributes of the lightest edge for each link in the shortest path.
+			for edge_aug in zip(aug_path[:-1], aug_path[1:]):
+				keydict = graph_original[edge_aug[0]][edge_aug[1]]
+				key_aug = min(keydict, key=lambda k: keydict[k].get(cache.weight, 1))
+				euler_circuit.append((edge_aug[0], edge_aug[1], {key_aug: dict(keydict[key_aug])}))
 
 	return euler_circuit
 
 
 if __name__ == '__main__':
+	import osmnx as ox
+
 	tl = (51.,-118.20094232802526)
 	br = (50.983281785654624,-118.1811147141947)
 	g = ox.graph_from_bbox(tl[0],
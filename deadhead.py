@@ -0,0 +1,102 @@
+import numpy as np
+import math
+
+
+def nearest_neighbours(xy, k, window=None):
+	# Return the indices of approximately the k nearest other points of every point in an
+	# (n, 2) array.  Points are sorted along four directions, and the points within window
+	# places of a point in any of the orders are its candidates.
+
+	n = len(xy)
+	if window is None:
+		window = k
+	window = min(window, n - 1)
+	offsets = np.concatenate([np.arange(1, window+1), -np.arange(1, window+1)])
+
+	candidates = []
+	for angle in (0, math.pi/4, math.pi/2, 3*math.pi/4):
+		order = np.argsort(xy[:, 0]*math.cos(angle) + xy[:, 1]*math.sin(angle), kind='stable')
+		rank = np.empty(n, dtype=np.int64)
+		rank[order] = np.arange(n)
+		candidates.append(order[np.clip(rank[:, None] + offsets, 0, n-1)])
+	candidates = np.concatenate(candidates, axis=1)
+
+	d2 = ((xy[candidates] - xy[:, None, :])**2).sum(axis=2)
+	d2[candidates == np.arange(n)[:, None]] = np.inf
+	nearest = np.argpartition(d2, k-1, axis=1)[:, :k]
+	return np.take_along_axis(candidates, nearest, axis=1)
+
+
+def greedy_matching(xy, k=8, check=None):
+	# Pair up the points of an (n, 2) array, taking the closest remaining pair first.  Only the
+	# k nearest neighbours of each point are candidates, and points left over when all their
+	# candidates are taken are matched again among themselves.  check is called between
+	# rounds, e.g. jobs.Job.check.  Returns a list of (i, j) pairs.
+
+	remaining = np.arange(len(xy))
+	pairs = []
+	while len(remaining) > 1:
+		if check: check()
+		kk = min(k, len(remaining) - 1)
+		pts = xy[remaining]
+		neighbours = nearest_neighbours(pts, kk)
+		dists = np.hypot(*(pts[neighbours] - pts[:, None, :]).transpose(2, 0, 1))
+		order = np.argsort(dists.ravel(), kind='stable')
+		firsts = (order // kk).tolist()
+		seconds = neighbours.ravel()[order].tolist()
+
+		matched = [False] * len(remaining)
+		for a, b in zip(firsts, seconds):
+			if not matched[a] and not matched[b]:
+				matched[a] = matched[b] = True
+				pairs.append((int(remaining[a]), int(remaining[b])))
+		remaining = remaining[~np.array(matched)]
+	return pairs
+
+
+def improve_matching(xy, pairs, k=8, passes=5, check=None):
+	# Improve a matching by swapping partners: when a point is closer to a neighbour than to
+	# its partner, and pairing it with the neighbour and the two old partners together is
+	# shorter overall, the pairs are swapped.  Greedy matchings leave long pairs between
+	# points whose neighbours were taken; this removes most of that excess.
+
+	if len(xy) < 4:
+		return pairs
+	mate = {}
+	for a, b in pairs:
+		mate[a] = b
+		mate[b] = a
+	neighbours = nearest_neighbours(xy, min(k, len(xy) - 1)).tolist()
+	xs, ys = xy[:, 0].tolist(), xy[:, 1].tolist()
+	dist = lambda i, j: math.hypot(xs[i] - xs[j], ys[i] - ys[j])
+
+	for _ in range(passes):
+		if check: check()
+		swapped = False
+		for a in mate:
+			b = mate[a]
+			for c in neighbours[a]:
+				d = mate.get(c)
+				if c == b or d is None:
+					continue
+				if dist(a, c) + dist(b, d) < dist(a, b) + dist(c, d) - 1e-9:
+					mate[a], mate[c], mate[b], mate[d] = c, a, d, b
+					b = c
+					swapped = True
+		if not swapped:
+			break
+	return [(a, b) for a, b in mate.items() if a < b]
+
+
+def estimate_deadhead(xy, check=None):
+	# Estimate the length of the repeated paths a Chinese Postman route needs, given the
+	# coordinates of the odd degree nodes.  The solver matches odd nodes by shortest path
+	# length; this matches them by straight line distance, which is fast enough to run after
+	# every edit.
+
+	xy = np.asarray(xy, dtype=np.float64).reshape(-1, 2)
+	pairs = improve_matching(xy, greedy_matching(xy, check=check), check=check)
+	if not pairs:
+		return 0.0
+	pairs = np.array(pairs)
+	return float(np.hypot(*(xy[pairs[:, 0]] - xy[pairs[:, 1]]).T).sum())
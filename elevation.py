@@ -0,0 +1,124 @@
+import numpy as np
+import io
+from pyproj import Transformer
+from PIL import Image
+
+from graphcoords import PackedCoords
+
+
+def decode_terrain_rgb(rgb):
+	# Decode an (..., 3) array of Mapbox terrain-rgb pixels into heights in meters
+
+	rgb = rgb.astype(np.float64)
+	return -10000 + (rgb[..., 0]*65536 + rgb[..., 1]*256 + rgb[..., 2]) * 0.1
+
+
+class ElevationSampler:
+	# Sample elevations from terrain-rgb tiles.  Each tile is fetched and decoded once, and
+	# all points falling on it are looked up in a single indexing operation.
+
+	def __init__(self, source, zoom=14):
+
+		self.source = source  # A mapboxloader.TileSource serving terrain-rgb tiles
+		self.z = zoom
+		self.heights = {}  # (x, y) tile -> decoded height array, or None if the tile is missing
+
+	def load_tiles(self, tiles):
+		# Fetch and decode every tile not already loaded in one batch
+
+		missing = [tile for tile in tiles if tile not in self.heights]
+		if not missing:
+			return
+		for tile, data in self.source.get_tiles(self.z, missing).items():
+			if data is None:
+				self.heights[tile] = None
+				continue
+			rgb = np.asarray(Image.open(io.BytesIO(data)).convert('RGB'))
+			self.heights[tile] = decode_terrain_rgb(rgb)
+
+	def sample(self, lats, lons):
+		# Return an array of elevations at arrays of latitudes and longitudes.  Points on
+		# tiles missing from the source get NaN.
+
+		lats = np.asarray(lats, dtype=np.float64)
+		lons = np.asarray(lons, dtype=np.float64)
+
+		# Fractional web mercator tile coordinates of every point
+		n = 2.0 ** self.z
+		tile_x = (lons + 180.0) / 360.0 * n
+		tile_y = (1.0 - np.arcsinh(np.tan(np.radians(lats))) / np.pi) / 2.0 * n
+		xs = np.floor(tile_x).astype(np.int64)
+		ys = np.floor(tile_y).astype(np.int64)
+
+		tiles, inverse = np.unique(np.stack([xs, ys], axis=1), axis=0, return_inverse=True)
+		inverse = inverse.ravel()
+		tiles = [(int(x), int(y)) for x, y in tiles]
+		self.load_tiles(tiles)
+
+		elevations = np.full(lats.shape, np.nan)
+		order = np.argsort(inverse, kind='stable')
+		bounds = np.searchsorted(inverse[order], np.arange(len(tiles)+1))
+		for t, tile in enumerate(tiles):
+			heights = self.heights[tile]
+			if heights is None:
+				continue
+			points = order[bounds[t]:bounds[t+1]]
+			size = heights.shape[0]
+			rows = np.clip(((tile_y[points] - tile[1]) * size).astype(np.int64), 0, size-1)
+			cols = np.clip(((tile_x[points] - tile[0]) * size).astype(np.int64), 0, size-1)
+			elevations[points] = heights[rows, cols]
+		return elevations
+
+
+def add_edge_elevation(G, sampler):
+	# Add an 'elevation' attribute to every node, and 'ascent' and 'descent' attributes (in
+	# meters, going from the first to the second node of the edge id) to every edge of a
+	# projected graph G.  All geometry points are sampled in one pass.
+
+	to_lat_lon = Transformer.from_crs(G.graph['crs'], 'EPSG:4326', always_xy=True)
+
+	packed = PackedCoords.from_graph(G)
+	node_ids, node_xy = packed.node_ids, packed.node_xy
+	edge_ids, coords = packed.edge_ids, packed.geom_xy
+	index = np.repeat(np.arange(len(edge_ids)), np.diff(packed.offsets))
+
+	# Sample nodes and geometry points together
+	xy = np.concatenate([node_xy, coords])
+	lons, lats = to_lat_lon.transform(xy[:, 0], xy[:, 1])
+	elevations = sampler.sample(lats, lons)
+	node_elevations = elevations[:len(node_ids)]
+	coord_elevations = elevations[len(node_ids):]
+
+	for id_, h in zip(node_ids, node_elevations.tolist()):
+		G.nodes[id_]['elevation'] = h
+
+	# Sum the climbs between consecutive points of the same edge
+	rise = np.nan_to_num(np.diff(coord_elevations))
+	same_edge = index[1:] == index[:-1]
+	edge_index = index[1:][same_edge]
+	rise = rise[same_edge]
+	ascent = np.bincount(edge_index, weights=np.maximum(rise, 0), minlength=len(edge_ids))
+	descent = np.bincount(edge_index, weights=np.maximum(-rise, 0), minlength=len(edge_ids))
+
+	# Geometries may run from the second node to the first
+	starts = coords[packed.offsets[:-1]]
+	node_row = {id_:i for i, id_ in enumerate(node_ids)}
+	u_xy = node_xy[[node_row[id_[0]] for id_ in edge_ids]]
+	v_xy = node_xy[[node_row[id_[1]] for id_ in edge_ids]]
+	reversed_ = np.hypot(*(starts - v_xy).T) < np.hypot(*(starts - u_xy).T)
+	ascent, descent = np.where(reversed_, descent, ascent), np.where(reversed_, ascent, descent)
+
+	for id_, up, down in zip(edge_ids, ascent.tolist(), descent.tolist()):
+		G.edges[id_]['ascent'] = up
+		G.edges[id_]['descent'] = down
+
+
+def add_climb_cost(G, climb_factor, weight_name='climb_cost'):
+	# Add an edge weight equal to the edge length plus climb_factor meters for every meter
+	# climbed.  The graph is undirected, so an edge costs its average climb over both directions.
+
+	for id_ in G.edges:
+		edge = G.edges[id_]
+		climb = (edge.get('ascent', 0) + edge.get('descent', 0)) / 2
+		edge[weight_name] = edge.get('length', 0) + climb_factor * climb
+	return weight_name
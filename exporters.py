@@ -0,0 +1,162 @@
+import numpy as np
+import csv
+import json
+from xml.sax.saxutils import escape
+from pyproj import Transformer
+
+
+class RouteChunk:
+	# The steps start:stop of a route.  Each step traverses edge_rows[i] from node
+	# start_rows[i] to node end_rows[i], and its geometry, in the direction of travel, is
+	# lats/lons[offsets[i]:offsets[i+1]].
+
+	def __init__(self, start, stop, start_rows, end_rows, edge_rows, lats, lons, offsets):
+
+		self.start = start
+		self.stop = stop
+		self.start_rows = start_rows
+		self.end_rows = end_rows
+		self.edge_rows = edge_rows
+		self.lats = lats
+		self.lons = lons
+		self.offsets = offsets
+
+
+def route_chunks(artifact, chunk_size=4096):
+	# Yield the steps of the route in a RouteArtifact as RouteChunks of at most chunk_size
+	# steps, so only one chunk of geometry is held in memory at a time.  The chunks are read
+	# from a finished artifact, not from the circuit as it is solved.  An artifact loaded
+	# from disk is memory mapped, but one just built from a circuit holds the whole route.
+
+	to_lat_lon = Transformer.from_crs(artifact.meta['crs'], 'EPSG:4326', always_xy=True)
+	geom_offsets = artifact.geom_offsets
+	n_steps = len(artifact.route_edges)
+
+	for start in range(0, n_steps, chunk_size):
+		stop = min(start + chunk_size, n_steps)
+		edge_rows = np.asarray(artifact.route_edges[start:stop])
+		start_rows = np.asarray(artifact.route_nodes[start:stop])
+		end_rows = np.asarray(artifact.route_nodes[start+1:stop+1])
+
+		# Geometries run from either end of their edge, so compare each with the node the
+		# step leaves from
+		firsts = geom_offsets[edge_rows]
+		lasts = geom_offsets[edge_rows + 1] - 1
+		start_xy = artifact.node_xy[start_rows]
+		reversed_ = np.hypot(*(artifact.geom_xy[lasts] - start_xy).T) < np.hypot(*(artifact.geom_xy[firsts] - start_xy).T)
+
+		# Index every geometry point in the direction of travel
+		lengths = lasts - firsts + 1
+		offsets = np.zeros(len(edge_rows) + 1, dtype=np.int64)
+		np.cumsum(lengths, out=offsets[1:])
+		steps = np.arange(offsets[-1]) - np.repeat(offsets[:-1], lengths)
+		index = np.where(np.repeat(reversed_, lengths), np.repeat(lasts, lengths) - steps, np.repeat(firsts, lengths) + steps)
+
+		xy = artifact.geom_xy[index]
+		lons, lats = to_lat_lon.transform(xy[:, 0], xy[:, 1])
+		yield RouteChunk(start, stop, start_rows, end_rows, edge_rows, np.asarray(lats), np.asarray(lons), offsets)
+
+
+def write_csv(artifact, path):
+	# Write one row per step of the route with its end nodes, name, length and geometry as
+	# a WKT LINESTRING of longitudes and latitudes
+
+	with open(path, 'w', newline='', buffering=1<<20) as csvfile:
+		writer = csv.writer(csvfile, delimiter=',')
+		writer.writerow(['START NODE',
+						 'END NODE',
+						 'NAME',
+						 'START LAT',
+						 'START LON',
+						 'END LAT',
+						 'END LON',
+						 'LENGTH',
+						 'GEOMETRY'])
+
+		names = artifact.meta['names'] + ['unknown']  # An index of -1 is unknown
+		for chunk in route_chunks(artifact):
+			points = ['%.7f %.7f' % point for point in zip(chunk.lons.tolist(), chunk.lats.tolist())]
+			offsets = chunk.offsets.tolist()
+			start_lats, start_lons = artifact.node_lat_lon[chunk.start_rows].T.tolist()
+			end_lats, end_lons = artifact.node_lat_lon[chunk.end_rows].T.tolist()
+			writer.writerows(zip(artifact.node_ids[chunk.start_rows].tolist(),
+								 artifact.node_ids[chunk.end_rows].tolist(),
+								 [names[i] for i in artifact.edge_name[chunk.edge_rows].tolist()],
+								 start_lats,
+								 start_lons,
+								 end_lats,
+								 end_lons,
+								 np.round(artifact.edge_length[chunk.edge_rows], 3).tolist(),
+								 ['LINESTRING (%s)' % ', '.join(points[a:b]) for a, b in zip(offsets[:-1], offsets[1:])]))
+
+
+def write_gpx(artifact, path, name='Chinese Postman Route'):
+	# Write the route as a single GPX track
+
+	with open(path, 'w', buffering=1<<20) as gpxfile:
+		gpxfile.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+					  '<gpx version="1.1" creator="Chinese-Postman-Route-Creater" xmlns="http://www.topografix.com/GPX/1/1">\n'
+					  '<trk><name>%s</name><trkseg>\n' % escape(name))
+		for chunk in route_chunks(artifact):
+			# Each step starts where the last one ended, so drop the repeated points
+			keep = np.ones(len(chunk.lats), dtype=bool)
+			if chunk.start > 0:
+				keep[chunk.offsets[:-1]] = False
+			else:
+				keep[chunk.offsets[1:-1]] = False
+			gpxfile.write(''.join(['<trkpt lat="%.7f" lon="%.7f"/>\n' % point
+								   for point in zip(chunk.lats[keep].tolist(), chunk.lons[keep].tolist())]))
+		gpxfile.write('</trkseg></trk>\n</gpx>\n')
+
+
+def write_geojson(artifact, path):
+	# Write the route as a GeoJSON FeatureCollection with one LineString feature per step
+
+	with open(path, 'w', buffering=1<<20) as jsonfile:
+		jsonfile.write('{"type": "FeatureCollection", "features": [\n')
+		names = artifact.meta['names'] + ['unknown']
+		for chunk in route_chunks(artifact):
+			points = ['[%.7f, %.7f]' % point for point in zip(chunk.lons.tolist(), chunk.lats.tolist())]
+			offsets = chunk.offsets.tolist()
+			features = []
+			for i, (edge_name, length, (a, b)) in enumerate(zip(artifact.edge_name[chunk.edge_rows].tolist(),
+																 artifact.edge_length[chunk.edge_rows].tolist(),
+																 zip(offsets[:-1], offsets[1:]))):
+				properties = json.dumps({'step':chunk.start + i, 'name':names[edge_name], 'length':round(length, 3)})
+				features.append('{"type": "Feature", "properties": %s, "geometry": {"type": "LineString", '
+								'"coordinates": [%s]}}' % (properties, ', '.join(points[a:b])))
+			jsonfile.write((',\n' if chunk.start > 0 else '') + ',\n'.join(features))
+		jsonfile.write('\n]}\n')
+
+
+def write_edge_counts(artifact, path):
+	# Write one row per edge with the number of times the route traverses it and the length
+	# repeated on it, most repeated length first
+
+	counts = artifact.traversal_counts()
+	repeated = np.maximum(counts - 1, 0) * artifact.edge_length
+	order = np.lexsort((-counts, -repeated))
+	names = artifact.meta['names'] + ['unknown']
+	us, vs = artifact.node_ids[artifact.edge_nodes[order]].T.tolist()
+	with open(path, 'w', newline='') as csvfile:
+		writer = csv.writer(csvfile, delimiter=',')
+		writer.writerow(['U', 'V', 'KEY', 'NAME', 'LENGTH', 'TRAVERSALS', 'REPEATED LENGTH'])
+		writer.writerows(zip(us,
+							 vs,
+							 artifact.edge_keys[order].tolist(),
+							 [names[i] for i in artifact.edge_name[order].tolist()],
+							 np.round(artifact.edge_length[order], 3).tolist(),
+							 counts[order].tolist(),
+							 np.round(repeated[order], 3).tolist()))
+
+
+EXPORTERS = {'.csv':write_csv, '.gpx':write_gpx, '.geojson':write_geojson, '.json':write_geojson}
+
+
+def export_route(artifact, path):
+	# Write the route in a RouteArtifact in the format given by the extension of path
+
+	for extension, exporter in EXPORTERS.items():
+		if path.lower().endswith(extension):
+			return exporter(artifact, path)
+	raise ValueError('Unknown route export format: %s' % path)
@@ -0,0 +1,213 @@
+import numpy as np
+import shapely
+from shapely.geometry import LineString
+
+
+def edge_geometries(G, edge_ids=None):
+	# Return the edge ids of G and a matching list of geometries.  Edges without a geometry
+	# get a straight line between their nodes.
+
+	if edge_ids is None:
+		edge_ids = list(G.edges)
+	geoms = []
+	for id_ in edge_ids:
+		geom = G.edges[id_].get('geometry')
+		if geom is None:
+			u, v = G.nodes[id_[0]], G.nodes[id_[1]]
+			geom = LineString([(u['x'], u['y']), (v['x'], v['y'])])
+		geoms.append(geom)
+	return edge_ids, geoms
+
+
+def pack_geometries(geoms):
+	# Return the coordinates of a list of geometries as one (n, 2) array, and the offsets
+	# at which each geometry starts
+
+	geom_xy, index = shapely.get_coordinates(geoms, return_index=True)
+	offsets = np.zeros(len(geoms) + 1, dtype=np.int64)
+	np.cumsum(np.bincount(index, minlength=len(geoms)), out=offsets[1:])
+	return geom_xy, offsets
+
+
+class PackedCoords:
+	# Node and edge geometry coordinates of a graph packed into contiguous float arrays.
+	# The geometry of edge i is geom_xy[offsets[i]:offsets[i+1]].
+
+	def __init__(self, node_ids, node_xy, edge_ids, geom_xy, offsets):
+
+		self.node_ids = node_ids
+		self.node_xy = node_xy
+		self.edge_ids = edge_ids
+		self.geom_xy = geom_xy
+		self.offsets = offsets
+
+		# Removed nodes and edges are only flagged until the next compact()
+		self.node_row = dict(zip(node_ids, range(len(node_ids))))
+		self.edge_row = dict(zip(edge_ids, range(len(edge_ids))))
+		self.node_alive = np.ones(len(node_ids), dtype=bool)
+		self.edge_alive = np.ones(len(edge_ids), dtype=bool)
+
+		# Coordinates of added nodes and edges are appended to the arrays in one go by flush()
+		self.new_node_xy = []
+		self.new_geom_xy = []
+
+	@classmethod
+	def from_graph(cls, G):
+
+		node_ids = list(G.nodes)
+		node_xy = np.array([(G.nodes[id_]['x'], G.nodes[id_]['y']) for id_ in node_ids],
+						   dtype=np.float64).reshape(-1, 2)
+		edge_ids, geoms = edge_geometries(G)
+		return cls(node_ids, node_xy, edge_ids, *pack_geometries(geoms))
+
+	@classmethod
+	def from_geometries(cls, edge_ids, geoms):
+		# Pack a list of edge geometries, with no nodes
+
+		return cls([], np.empty((0, 2)), list(edge_ids), *pack_geometries(geoms))
+
+	def add_node(self, id_, xy):
+
+		self.node_row[id_] = len(self.node_ids)
+		self.node_ids.append(id_)
+		self.new_node_xy.append(xy)
+
+	def remove_node(self, id_):
+
+		row = self.node_row.pop(id_)
+		if row >= len(self.node_alive):
+			self.flush()
+		self.node_alive[row] = False
+
+	def add_edge(self, id_, geom_xy):
+
+		self.edge_row[id_] = len(self.edge_ids)
+		self.edge_ids.append(id_)
+		self.new_geom_xy.append(np.asarray(geom_xy, dtype=np.float64).reshape(-1, 2))
+
+	def remove_edge(self, id_):
+
+		row = self.edge_row.pop(id_)
+		if row >= len(self.edge_alive):
+			self.flush()
+		self.edge_alive[row] = False
+
+	def flush(self):
+		# Append the coordinates of the nodes and edges added since the last flush
+
+		if self.new_node_xy:
+			self.node_xy = np.concatenate([self.node_xy, np.array(self.new_node_xy, dtype=np.float64).reshape(-1, 2)])
+			self.node_alive = np.append(self.node_alive, np.ones(len(self.new_node_xy), dtype=bool))
+			self.new_node_xy = []
+		if self.new_geom_xy:
+			lengths = np.array([len(xy) for xy in self.new_geom_xy], dtype=np.int64)
+			self.geom_xy = np.concatenate([self.geom_xy] + self.new_geom_xy)
+			self.offsets = np.append(self.offsets, self.offsets[-1] + np.cumsum(lengths))
+			self.edge_alive = np.append(self.edge_alive, np.ones(len(self.new_geom_xy), dtype=bool))
+			self.new_geom_xy = []
+
+	def compact(self):
+		# Drop the rows of removed nodes and edges
+
+		self.flush()
+		if self.node_alive.all() and self.edge_alive.all():
+			return
+
+		node_alive = self.node_alive.tolist()
+		self.node_ids = [id_ for id_, alive in zip(self.node_ids, node_alive) if alive]
+		self.node_xy = self.node_xy[self.node_alive]
+
+		lengths = np.diff(self.offsets)
+		edge_alive = self.edge_alive.tolist()
+		self.edge_ids = [id_ for id_, alive in zip(self.edge_ids, edge_alive) if alive]
+		self.geom_xy = self.geom_xy[np.repeat(self.edge_alive, lengths)]
+		self.offsets = np.zeros(len(self.edge_ids) + 1, dtype=np.int64)
+		np.cumsum(lengths[self.edge_alive], out=self.offsets[1:])
+
+		self.node_row = dict(zip(self.node_ids, range(len(self.node_ids))))
+		self.edge_row = dict(zip(self.edge_ids, range(len(self.edge_ids))))
+		self.node_alive = np.ones(len(self.node_ids), dtype=bool)
+		self.edge_alive = np.ones(len(self.edge_ids), dtype=bool)
+
+	def bounds(self):
+		# Return the x and y bounds over all nodes and edge geometries
+
+		self.compact()
+		all_xy = np.concatenate([self.node_xy, self.geom_xy])
+		lo = all_xy.min(axis=0)
+		hi = all_xy.max(axis=0)
+		return ((lo[0], hi[0]), (lo[1], hi[1]))
+
+	def edge_bboxes(self):
+		# Return an (n, 4) array of the (min_x, min_y, max_x, max_y) bounding box of each edge
+
+		self.flush()
+		if not self.edge_ids:
+			return np.empty((0, 4))
+		starts = self.offsets[:-1]
+		return np.concatenate([np.minimum.reduceat(self.geom_xy, starts),
+							   np.maximum.reduceat(self.geom_xy, starts)], axis=1)
+
+	def split(self, geom_xy):
+		# Split an array of transformed geometry coordinates into one (k, 2) array view per edge
+
+		offsets = self.offsets.tolist()
+		return [geom_xy[a:b] for a, b in zip(offsets[:-1], offsets[1:])]
+
+
+def window_matrix(ws, x_bounds, y_bounds, edge_buffer, zoom_matrix=None):
+	# Return the 2x3 affine matrix mapping graph coordinates to window coordinates.  The
+	# graph bounds fill the window less edge_buffer pixels, with y pointing down.
+
+	sx = (ws[0] - 2*edge_buffer) / (x_bounds[1] - x_bounds[0])
+	sy = (ws[1] - 2*edge_buffer) / (y_bounds[1] - y_bounds[0])
+	matrix = np.array([[sx, 0, edge_buffer - sx*x_bounds[0]],
+					   [0, -sy, ws[1] - edge_buffer + sy*y_bounds[0]]])
+	if zoom_matrix is not None:
+		matrix = np.matmul(zoom_matrix, np.append(matrix, [[0, 0, 1]], axis=0))
+	return matrix
+
+
+def apply_affine(matrix, xy):
+	# Apply a 2x3 affine matrix to an (n, 2) array of points
+
+	return xy @ matrix[:, :2].T + matrix[:, 2]
+
+
+def points_in_polygon(xy, polygon):
+	# Return a boolean array flagging the points of an (n, 2) array inside a polygon given as
+	# a list of vertices.  Uses the even-odd rule, so self-intersecting polygons are allowed.
+
+	xy = np.asarray(xy, dtype=np.float64).reshape(-1, 2)
+	x, y = xy[:, 0], xy[:, 1]
+	inside = np.zeros(len(xy), dtype=bool)
+	vertices = np.asarray(polygon, dtype=np.float64)
+	for (x1, y1), (x2, y2) in zip(vertices.tolist(), np.roll(vertices, -1, axis=0).tolist()):
+		if y1 == y2:
+			continue
+		crosses = (y1 > y) != (y2 > y)
+		inside ^= crosses & (x < x1 + (y - y1) * (x2 - x1) / (y2 - y1))
+	return inside
+
+
+def polyline_distances(pos, polylines):
+	# Return an array of the distances from a point to each of a list of (k, 2) polylines
+
+	lengths = np.array([len(xy) for xy in polylines], dtype=np.int64)
+	xy = np.concatenate(polylines).astype(np.float64)
+	line = np.repeat(np.arange(len(polylines)), lengths)
+	pos = np.asarray(pos, dtype=np.float64)
+
+	# Distances to the vertices cover single point lines
+	dists = np.full(len(polylines), np.inf)
+	np.minimum.at(dists, line, np.hypot(*(xy - pos).T))
+
+	# Distances to the segments joining consecutive vertices of the same line
+	same_line = line[1:] == line[:-1]
+	starts, ends, line = xy[:-1][same_line], xy[1:][same_line], line[1:][same_line]
+	d = ends - starts
+	d2 = (d**2).sum(axis=1)
+	t = np.divide(((pos - starts) * d).sum(axis=1), d2, out=np.zeros(len(d2)), where=d2 > 0)
+	closest = starts + np.clip(t, 0, 1)[:, None] * d
+	np.minimum.at(dists, line, np.hypot(*(closest - pos).T))
+	return dists
@@ -4,25 +4,38 @@ import pygame
 from pygame.locals import *
 import numpy as np
 from numpy.linalg import norm, inv, LinAlgError
-import osmnx as ox
+import shapely
 from random import randint
+from collections import Counter
 from shapely.geometry import LineString
-from networkx.exception import NetworkXError
+
+from spatialindex import GridIndex
+from undolog import GraphDiff, UndoLog
+from graphcoords import PackedCoords, edge_geometries, pack_geometries, window_matrix, apply_affine, \
+						points_in_polygon, polyline_distances
+from jobs import Job
+from deadhead import estimate_deadhead
+from routeartifact import traversal_color
+from trackmatch import is_covered
+from consolidate import consolidate_intersections
 
 DELETE = 'delete'
 ZOOM = 'zoom'
 ADD_NODES = 'add nodes'
 ADD_EDGES = 'add edges'
 START_NODE = 'set starting node'
+INSPECT = 'inspect'
 UNDO = 'undo'
 CONSOLIDATE_GRAPH = 'consolidate_graph'
 DISPLAY_HELP = 'display_help'
 TOGGLE_BACKGROUND = 'toggle_background'
+TOGGLE_TRAVERSALS = 'toggle_traversals'
 ZOOM_IDENTITY = np.array([[1,0,0], [0,1,0]])
+STATS_EVENT = USEREVENT  # Posted by the worker thread when a deadhead estimate finishes
 
 class GraphEdit:
 
-	def __init__(self, G, surface, window_size, img_data=None):
+	def __init__(self, G, surface, window_size, tiles=None, undo_limit=None, traversals=None):
 
 		self.G = G
 		self.surface = surface
@@ -30,6 +43,7 @@ class GraphEdit:
 		self.close_clicked = False
 		self.buffer = 10  # Sets a boarder of this many pixels in the visualization
 		self.line_color = pygame.Color('white')
+		self.covered_color = pygame.Color(40, 140, 255)
 		self.bg_color = pygame.Color('black')
 		self.main_node_color = pygame.Color('white')
 		self.node_delete_color = pygame.Color(255, 0, 0)
@@ -38,9 +52,11 @@ class GraphEdit:
 		self.message_bg_color = pygame.Color(200, 200, 200)
 		self.mode_color = pygame.Color(186, 15, 18)
 		self.node_radius = 4
-		self.orig_x_bounds = self.get_x_bounds(self.G)
-		self.orig_y_bounds = self.get_y_bounds(self.G)
-		self.nodes_to_delete = []
+		self.index_cell_size = 16  # Cell size in pixels of the spatial index over node window coordinates
+		self.lod_scales = (1, 2, 4, 8)  # Zoom scales at which simplified edge geometry is precomputed
+		self.orig_x_bounds, self.orig_y_bounds = self.get_bounds(self.G)
+		self.nodes_to_delete = set()
+		self.edges_to_delete = set()
 		self.mode = ZOOM
 		self.mode_dict = {K_z:ZOOM, 
 						  K_d:DELETE, 
@@ -50,15 +66,18 @@ class GraphEdit:
 						  K_c:CONSOLIDATE_GRAPH,
 						  K_u:UNDO,
 						  K_h:DISPLAY_HELP,
-						  K_b:TOGGLE_BACKGROUND}
+						  K_b:TOGGLE_BACKGROUND,
+						  K_t:TOGGLE_TRAVERSALS,
+						  K_i:INSPECT}
 		self.zoom_box_on = False
 		self.zoom_box_click_coords = None
+		self.select_points = None  # Window positions of the selection box corner or lasso dragged in DELETE mode
+		self.lasso = False
 		self.zoom_tlbr = ((0,0), window_size)
 		self.zoom_matrix = ZOOM_IDENTITY
 		self.reverse_zoom_matrix = ZOOM_IDENTITY
 		self.zoomed = False
-		self.graph_list = []
-		self.consolidated = False
+		self.undo_log = UndoLog(max_size=undo_limit)  # Caps the number of nodes and edges kept for undo
 		self.edge_adder_node_id = None
 
 		pygame.font.init()
@@ -69,27 +88,34 @@ class GraphEdit:
 
 		self.message_on = True
 		self.help_message = 'Welcome to Chinese Postman Interactive.\n\n' + \
-							'This program has 5 modes:\nDELETE, ZOOM, ADD NODES, ADD EDGES, and SET STARTING NODE.\n' + \
+							'This program has 6 modes:\nDELETE, ZOOM, ADD NODES, ADD EDGES, SET STARTING NODE, and INSPECT.\n' + \
 							'The current mode is displayed in the upper left corner of the screen.\n' + \
-							'Change modes by pressing the \'d\', \'z\', \'n\', \'e\', and \'s\' keys respectfully.\n' + \
-							'To remove nodes, change to DELETE mode and click to select the nodes\n' + \
-							'you wish to delete.  Then press the delete key to remove them.  Delete edges\n' +\
-							'by selecting two nodes connected by an edge and pressing shift-delete.  To\n' + \
+							'Change modes by pressing the \'d\', \'z\', \'n\', \'e\', \'s\', and \'i\' keys respectfully.\n' + \
+							'To remove nodes or edges, change to DELETE mode and click to select the nodes\n' + \
+							'and edges you wish to delete, or drag a box (or a lasso while holding shift)\n' + \
+							'around them.  Then press the delete key to remove them.  Delete only the edges\n' +\
+							'between the selected nodes by pressing shift-delete.  In INSPECT mode, click\n' + \
+							'an edge to display its attributes.  To\n' + \
 							'zoom, change to ZOOM mode and click and drag over thea area you wish to zoom in\n' + \
 							'on.  Press the \'z\' key again or click to reset the zoom level.  In ADD NODES\n' + \
 							'mode, you may click anywhere to add a node.  To add edges, change to ADD\n' + \
 							'EDGES mode, click on two nodes consecutively, and enter an edge length.\n' + \
 							'To set the starting node, change to SET STARTING NODE mode and click the\n' +\
-							'desired node.  Press the \'u\' key at any time to undo.  Press \'c\' to invoke osmnx\'s\n' + \
-							'consolidate_intersections method.  Press \'b\' to turn the background\n' + \
-							'image on or off.  Press \'h\' to display this message and press any key\n' +\
-							'to close it. Click DONE in the upper right corner when you are finished.'
+							'desired node.  Press the \'u\' key at any time to undo.  Press \'c\' to merge nodes\n' + \
+							'within a tolerance of each other.  Press \'b\' to turn the background\n' + \
+							'image on or off.  Press \'t\' to colour the edges by how many times the last\n' + \
+							'route traversed them: grey never, white once, yellow, orange and red two, three\n' + \
+							'and four or more times.  Press \'h\' to display this message and press any key\n' +\
+							'to close it. Click DONE in the upper right corner when you are finished.\n' + \
+							'The panel in the lower left corner estimates the route length as you edit.\n' + \
+							'Edges covered by recorded tracks are drawn in blue and are only ridden to\n' + \
+							'reach the others.'
 		self.help_message = self.help_message.splitlines()
 		self.message = self.create_message_surface(self.help_message)
 
 		self.font.set_bold(True)
 		self.mode_surfaces = {mode:self.font.render(mode.upper(), True, self.mode_color) \
-							  for mode in (DELETE, ZOOM, ADD_EDGES, ADD_NODES, START_NODE)}
+							  for mode in (DELETE, ZOOM, ADD_EDGES, ADD_NODES, START_NODE, INSPECT)}
 		self.font.set_bold(False)
 
 		self.input_str = ''
@@ -98,30 +124,36 @@ class GraphEdit:
 		self.input_done = False
 		self.bg_img = None
 		self.bg_on = True
+		self.traversals = traversals  # Edge id -> the number of times the last route traversed it, if known
+		self.traversals_on = False
+		self.graph_layer = pygame.Surface(self.window_size)  # Cached rendering of the background and graph
+		self.layer_dirty = True
+		self.tiles = tiles  # A TilePyramid serving the background map, if any
+		self.bg_viewport = None
 		self.starting_node = None
+		self.job = None  # The background job whose progress is being displayed, if any
+		self.job_poll_interval = 100  # Milliseconds between progress redraws while a job runs
+		self.progress_bar_color = pygame.Color(0, 160, 60)
+		self.stats_job = None  # The job estimating the deadhead length, if one is running
+		self.stats_surface = None
+		self.deadhead_estimate = None
 
 		self.update_graph_attr()
 
-		if img_data is not None:
-			self.bg_img, tl_lat_lon, br_lat_lon = img_data
-			self.scale_bg_img(tl_lat_lon, br_lat_lon)
-			self.bg_img = self.img2pygame(self.bg_img)
-			self.bg_img = pygame.transform.smoothscale(self.bg_img, self.window_size)
-			self.orig_bg_img = self.bg_img.copy()
-
 		self.create_done()
 		self.done = False
 
 	@classmethod
-	def get_x_bounds(cls, G, coord='x'):
-		# Return the minimum and maximum x coordinates over all nodes and edges of a graph G
+	def get_bounds(cls, G):
+		# Return the minimum and maximum x and y coordinates over all nodes and edges of a graph G
 
-		index = 0 if coord == 'x' else 1
+		return PackedCoords.from_graph(G).bounds()
 
-		all_xcoords = [G.nodes[id_][coord] for id_ in G.nodes] + \
-					  [xy[index] for e in G.edges for xy in G.edges[e]['geometry'].coords]
+	@classmethod
+	def get_x_bounds(cls, G, coord='x'):
+		# Return the minimum and maximum x coordinates over all nodes and edges of a graph G
 
-		return (min(all_xcoords), max(all_xcoords))
+		return cls.get_bounds(G)[0 if coord == 'x' else 1]
 
 	@classmethod
 	def get_y_bounds(cls, G):
@@ -130,35 +162,260 @@ class GraphEdit:
 		return cls.get_x_bounds(G, coord='y')
 		
 	def update_graph_attr(self):
-		# Update lists and dictionaries specific to the graph
+		# Rebuild the lists and dictionaries specific to the graph.  Edits update these
+		# incrementally; a full rebuild is only needed when the whole graph is replaced.
 
-		self.x_bounds = self.get_x_bounds(self.G)
-		self.y_bounds = self.get_y_bounds(self.G)
-		self.node_ids = list(self.G.nodes)
+		self.coords = PackedCoords.from_graph(self.G)
 		self.nodes = self.G.nodes
-		self.edge_ids = list(self.G.edges)
 		self.edges = self.G.edges
-		self.node_colors = {id_:self.main_node_color for id_ in self.node_ids}
+		self.build_edge_index()
+		self.build_lod()
+		self.node_colors = {}  # Nodes drawn in a color other than main_node_color
 		if self.starting_node:
-			if self.starting_node in self.node_ids:
+			if self.starting_node in self.G:
 				self.node_colors[self.starting_node] = self.start_node_color
 			else:
 				self.starting_node = None
+		self.update_window_coords()
+
+		self.osmids = Counter(osmid for id_ in self.G.edges for osmid in self.edge_osmids(self.G.edges[id_]))
+
+		# Route statistics, kept up to date by the edits
+		self.odd_nodes = {id_ for id_, degree in self.G.degree if degree % 2 == 1}
+		self.total_length = sum(length for _, _, length in self.G.edges(data='length', default=0))
+		self.stats_dirty = True
+
+		self.extreme_ids = {}
+		self.update_extremes()
+
+	def update_window_coords(self):
+		# Update the window coordinates of the graph after the graph or zoom changes
+
+		self.coords.compact()
 		self.node_window_coords = self.get_node_window_coords()
 		self.edge_window_coords = self.get_edge_window_coords()
+		self.draw_edge_coords = self.get_draw_edge_coords()
+		self.node_index = None  # Built on the first hit test
+		self.layer_dirty = True
+
+	def graph_units_per_pixel(self):
+		# Get the size of one unzoomed window pixel in graph coordinates
+
+		return (self.orig_x_bounds[1] - self.orig_x_bounds[0]) / (self.window_size[0] - 2*self.buffer)
+
+	def build_edge_index(self):
+		# Index the bounding boxes of the edges in graph coordinates
+
+		self.edge_index = GridIndex(64 * self.graph_units_per_pixel())
+		for id_, bbox in zip(self.coords.edge_ids, self.coords.edge_bboxes().tolist()):
+			self.edge_index.insert(id_, bbox)
+
+	def build_lod(self):
+		# Precompute Douglas-Peucker simplified edge geometry for each scale in lod_scales.
+		# At each scale the simplified lines are within half a pixel of the originals.
+
+		edge_ids, geoms = edge_geometries(self.G, self.coords.edge_ids)
+		self.lod = [PackedCoords.from_geometries(edge_ids, self.simplify(geoms, scale)) for scale in self.lod_scales]
+
+	def simplify(self, geoms, scale):
+
+		return shapely.simplify(geoms, 0.5 * self.graph_units_per_pixel() / scale, preserve_topology=False)
+
+	def get_view_bounds(self):
+		# Get the (min_x, min_y, max_x, max_y) box of graph coordinates visible in the window
+
+		corners = [self.map_to_window(self.adjust_coord_for_zoom(pos, reverse=True), reverse=True)
+				   for pos in ((0, 0), self.window_size)]
+		(x1, y1), (x2, y2) = corners
+		return (min(x1, x2), min(y1, y2), max(x1, x2), max(y1, y2))
+
+	def get_draw_edge_coords(self):
+		# Get window coordinates of the edges to draw.  When zoomed in, only edges in view are
+		# included, and each edge uses the coarsest geometry which is accurate at the zoom.
+
+		zm = self.zoom_matrix
+		scale = max(abs(zm[0][0]), abs(zm[1][1]))
+		edge_ids = self.edge_index.query_rect(*self.get_view_bounds()) if self.zoomed else self.coords.edge_ids
+
+		levels = [i for i, lod_scale in enumerate(self.lod_scales) if lod_scale >= scale]
+		if not levels:
+			return {id_:self.edge_window_coords[id_] for id_ in edge_ids}
+
+		lod = self.lod[levels[0]]
+		lod.compact()
+		window_xy = apply_affine(self.get_window_matrix(), lod.geom_xy)
+		offsets = lod.offsets.tolist()
+		rows = lod.edge_row
+		return {id_:window_xy[offsets[rows[id_]]:offsets[rows[id_]+1]] for id_ in edge_ids}
+
+	def reset_node_color(self, id_):
+		# Return a node to its normal color
+
+		if id_ is not None and id_ == self.starting_node:
+			self.node_colors[id_] = self.start_node_color
+		else:
+			self.node_colors.pop(id_, None)
+
+	def reset_node_colors(self):
+		# Return all nodes to their normal color
+
+		for id_ in list(self.node_colors):
+			self.reset_node_color(id_)
+
+	def update_extremes(self, added=(), removed=()):
+		# Track the nodes with the minimum and maximum latitude and longitude.  Added nodes are
+		# compared against the current extremes; extremes are only searched for again when
+		# one of them is removed.
 
-		self.osmids = [self.G.edges[i]['osmid'] for i in self.G.edges]
+		keys = {'min_lat':(min, 'lat'), 'max_lat':(max, 'lat'), 'min_lon':(min, 'lon'), 'max_lon':(max, 'lon')}
+		old_ids = dict(self.extreme_ids)
+		removed = set(removed)
 
-		lat_func = lambda id_:self.nodes[id_]['lat']
-		lon_func = lambda id_:self.nodes[id_]['lon']
-		self.node_with_min_lat = self.nodes[min(self.node_ids, key=lat_func)]
-		self.node_with_max_lat = self.nodes[max(self.node_ids, key=lat_func)]
-		self.node_with_min_lon = self.nodes[min(self.node_ids, key=lon_func)]
-		self.node_with_max_lon = self.nodes[max(self.node_ids, key=lon_func)]
+		for name, (func, attr) in keys.items():
+			if name not in self.extreme_ids or self.extreme_ids[name] in removed:
+				self.extreme_ids[name] = func(self.G.nodes, key=lambda id_:self.nodes[id_][attr])
+			for id_ in added:
+				self.extreme_ids[name] = func(self.extreme_ids[name], id_, key=lambda id_:self.nodes[id_][attr])
 
-		if self.bg_img:
+		self.node_with_min_lat = self.nodes[self.extreme_ids['min_lat']]
+		self.node_with_max_lat = self.nodes[self.extreme_ids['max_lat']]
+		self.node_with_min_lon = self.nodes[self.extreme_ids['min_lon']]
+		self.node_with_max_lon = self.nodes[self.extreme_ids['max_lon']]
+
+		# The background is placed using the extreme nodes
+		if self.tiles and self.extreme_ids != old_ids:
+			self.bg_viewport = None
 			self.scale_bg_img_for_zoom()
 
+	@staticmethod
+	def edge_osmids(edge):
+		# Return a list of the osm ids of an edge.  Simplified edges may have several.
+
+		osmid = edge.get('osmid')
+		return list(osmid) if type(osmid) == list else [osmid]
+
+	def edge_id(self, u, v, key):
+		# Return the id of an edge as it is stored in edge_window_coords, which may list the nodes in either order
+
+		return (u, v, key) if (u, v, key) in self.coords.edge_row else (v, u, key)
+
+	def add_node_attr(self, id_):
+		# Add a new node to the graph specific lists and dictionaries
+
+		self.add_nodes_attr([id_])
+
+	def add_nodes_attr(self, node_ids):
+		# Add a batch of new nodes to the graph specific lists and dictionaries
+
+		graph_xy = [(self.nodes[id_]['x'], self.nodes[id_]['y']) for id_ in node_ids]
+		window_xy = apply_affine(self.get_window_matrix(), np.array(graph_xy, dtype=np.float64).reshape(-1, 2))
+		for id_, xy, pos in zip(node_ids, graph_xy, window_xy.tolist()):
+			self.coords.add_node(id_, xy)
+			self.node_window_coords[id_] = pos
+			if self.node_index is not None:
+				self.node_index.insert_point(id_, pos)
+		self.layer_dirty = True
+
+	def remove_node_attr(self, id_):
+		# Remove a node from the graph specific lists and dictionaries
+
+		self.coords.remove_node(id_)
+		del self.node_window_coords[id_]
+		self.node_colors.pop(id_, None)
+		self.layer_dirty = True
+		self.odd_nodes.discard(id_)
+		if self.node_index is not None:
+			self.node_index.remove(id_)
+		if self.starting_node == id_:
+			self.starting_node = None
+
+	def add_edge_attr(self, id_):
+		# Add a new edge to the graph specific lists and dictionaries
+
+		self.add_edges_attr([id_])
+
+	def add_edges_attr(self, edge_ids):
+		# Add a batch of new edges to the graph specific lists and dictionaries.  The
+		# geometries are transformed and simplified together.
+
+		edge_ids, geoms = edge_geometries(self.G, edge_ids)
+		geom_xy, offsets = pack_geometries(geoms)
+		window_xy = apply_affine(self.get_window_matrix(), geom_xy)
+		bboxes = PackedCoords.from_geometries(edge_ids, geoms).edge_bboxes().tolist()
+		offsets = offsets.tolist()
+		for i, id_ in enumerate(edge_ids):
+			start, stop = offsets[i], offsets[i+1]
+			self.coords.add_edge(id_, geom_xy[start:stop])
+			self.edge_window_coords[id_] = window_xy[start:stop]
+			self.draw_edge_coords[id_] = self.edge_window_coords[id_]
+			self.edge_index.insert(id_, bboxes[i])
+			self.osmids.update(self.edge_osmids(self.edges[id_]))
+			self.update_edge_stats(id_, 1)
+		for scale, lod in zip(self.lod_scales, self.lod):
+			simple_xy, simple_offsets = pack_geometries(self.simplify(geoms, scale))
+			simple_offsets = simple_offsets.tolist()
+			for i, id_ in enumerate(edge_ids):
+				lod.add_edge(id_, simple_xy[simple_offsets[i]:simple_offsets[i+1]])
+		self.layer_dirty = True
+
+	def remove_edge_attr(self, id_):
+		# Remove an edge from the graph specific lists and dictionaries
+
+		self.coords.remove_edge(id_)
+		del self.edge_window_coords[id_]
+		self.draw_edge_coords.pop(id_, None)
+		self.edges_to_delete.discard(id_)
+		self.edge_index.remove(id_)
+		for lod in self.lod:
+			lod.remove_edge(id_)
+		self.layer_dirty = True
+		for osmid in self.edge_osmids(self.edges[id_]):
+			self.osmids[osmid] -= 1
+			if self.osmids[osmid] <= 0:
+				del self.osmids[osmid]
+		self.update_edge_stats(id_, -1)
+
+	def update_edge_stats(self, id_, sign):
+		# Update the route statistics for an edge being added (sign 1) or removed (sign -1).
+		# Each end of the edge changes the parity of its node's degree.
+
+		for node_id in id_[:2]:
+			if node_id in self.odd_nodes:
+				self.odd_nodes.remove(node_id)
+			else:
+				self.odd_nodes.add(node_id)
+		self.total_length += sign * self.edges[id_].get('length', 0)
+		self.stats_dirty = True
+
+	def update_stats(self):
+		# Start estimating the deadhead length on a worker thread after the graph changes.
+		# A running estimate for an outdated graph is cancelled, and a new one is started
+		# once it has stopped.
+
+		if self.stats_job is not None:
+			if not self.stats_job.done():
+				if self.stats_dirty:
+					self.stats_job.cancel()
+				return
+			if not self.stats_job.cancelled and self.stats_job.error is None:
+				self.deadhead_estimate = self.stats_job.result
+			self.stats_job = None
+			self.stats_surface = None
+
+		if self.stats_dirty:
+			self.stats_dirty = False
+			self.stats_surface = None
+			odd_xy = [(self.nodes[id_]['x'], self.nodes[id_]['y']) for id_ in self.odd_nodes]
+			self.stats_job = Job(lambda job: estimate_deadhead(odd_xy, check=job.check),
+								 on_done=self.post_stats_event).start()
+
+	@staticmethod
+	def post_stats_event(job):
+		# Wake the event loop to display a finished estimate
+
+		if pygame.display.get_init():
+			pygame.event.post(pygame.event.Event(STATS_EVENT))
+
 	def create_done(self):
 		# Create the done surface and rect in the bottom right corner of the screen
 
@@ -168,62 +425,41 @@ class GraphEdit:
 		self.done_loc = (self.window_size[0] - self.done_rect.width - 2, 2)
 		self.done_rect.move_ip(self.done_loc)
 
-	def scale_bg_img(self, img_tl_gps, img_br_gps):
-		# Scale the background image
-
-		img_width, img_height = self.bg_img.size
-
-		tl_y = self.coord_transform(self.node_with_max_lat['lat'], 
-									img_tl_gps[0], 
-									img_br_gps[0], 
-									0, 
-									img_height)
-		tl_x = self.coord_transform(self.node_with_min_lon['lon'], 
-									img_tl_gps[1], 
-									img_br_gps[1], 
-									0, 
-									img_width)
-		br_y = self.coord_transform(self.node_with_min_lat['lat'], 
-									img_tl_gps[0], 
-									img_br_gps[0], 
-									0, 
-									img_height)
-		br_x = self.coord_transform(self.node_with_max_lon['lon'], 
-									img_tl_gps[1], 
-									img_br_gps[1], 
-									0, 
-									img_width)
-
-		x_buffer = self.coord_transform(self.buffer, 0, self.window_size[0], 0, img_width)
-		y_buffer = self.coord_transform(self.buffer, 0, self.window_size[1], 0, img_height)
-
-		self.bg_img = self.bg_img.crop((tl_x-x_buffer, tl_y-y_buffer, br_x+x_buffer, br_y+y_buffer))
-
 	def scale_bg_img_for_zoom(self):
-		# Adjust the background image for zoom
+		# Render the background for the current zoom from the tiles covering the window
 
-		if not self.zoomed:
-			self.bg_img = self.orig_bg_img
+		viewport = (self.zoom_tlbr, self.zoomed)
+		if viewport == self.bg_viewport:
 			return
+		self.bg_viewport = viewport
 
-		width = self.zoom_tlbr[1][0] - self.zoom_tlbr[0][0]
-		height = self.zoom_tlbr[1][1] - self.zoom_tlbr[0][1]
-
-		zoom_rect = pygame.Rect(*self.zoom_tlbr[0], width, height)
-
-		orig_copy = self.orig_bg_img.copy()
-		self.bg_img = orig_copy.subsurface(zoom_rect)
-
-		self.bg_img = pygame.transform.smoothscale(self.bg_img, self.window_size)
+		self.bg_img = self.tiles.render(self.window_size, self.window_to_lat_lon, self.lat_lon_to_window)
+		self.layer_dirty = True
 
-	@staticmethod
-	def img2pygame(img):
-
-		mode = img.mode
-		size = img.size
-		data = img.tobytes()
+	def window_to_lat_lon(self, pos):
+		# Get the latitude and longitude at a window position
 
-		return pygame.image.fromstring(data, size, mode)
+		unzoomed_window_coord = self.adjust_coord_for_zoom(pos, reverse=True)
+		graph_coord = self.map_to_window(unzoomed_window_coord, reverse=True)
+		return self.retrieve_lat_lon(graph_coord)
+
+	def lat_lon_to_window(self, lats, lons):
+		# Get window coordinates of arrays of latitudes and longitudes
+
+		x = self.coord_transform(lons,
+								 self.node_with_min_lon['lon'],
+								 self.node_with_max_lon['lon'],
+								 self.node_with_min_lon['x'],
+								 self.node_with_max_lon['x'])
+		y = self.coord_transform(lats,
+								 self.node_with_min_lat['lat'],
+								 self.node_with_max_lat['lat'],
+								 self.node_with_min_lat['y'],
+								 self.node_with_max_lat['y'])
+		x = self.map_to_window(x, coord='x')
+		y = self.map_to_window(y, coord='y')
+		zm = self.zoom_matrix
+		return (zm[0][0]*x + zm[0][1]*y + zm[0][2], zm[1][0]*x + zm[1][1]*y + zm[1][2])
 
 	def map_to_window(self, coords, coord=None, reverse=False, ws=None, x_bounds=None, y_bounds=None, edge_buffer=None):
 		# Map a graph coordinate to window coordinates or vice versa
@@ -272,47 +508,77 @@ class GraphEdit:
 
 		return (x*(b2-b1) - b2*a1 + b1*a2)/(a2-a1)
 
+	def get_window_matrix(self):
+		# Get the affine matrix mapping graph coordinates to zoomed window coordinates
+
+		return window_matrix(self.window_size, self.orig_x_bounds, self.orig_y_bounds, self.buffer, self.zoom_matrix)
+
 	def get_node_window_coords(self):
 		# Get window coordinates of all nodes in the graph
 		# Returns a dictionary with the node id as the key and window coords as the value
 
-		node_window_coords = {}
-		for id_ in self.node_ids:
-			node = self.nodes[id_]
-			node_coords = self.map_to_window((node['x'], node['y']))
-			node_window_coords[id_] = self.adjust_coord_for_zoom(node_coords)
-		return node_window_coords
+		window_xy = apply_affine(self.get_window_matrix(), self.coords.node_xy)
+		return dict(zip(self.coords.node_ids, window_xy.tolist()))
 
 	def get_edge_window_coords(self):
 		# Get window coordinates of all edge points in the graph
 		# Returns a dictionary with the edge id as the key and window coords list as the value
 
-		edge_window_coords = {}
-		for id_ in self.edge_ids:
-			edge_coords = []
-			for coords in self.edges[id_]['geometry'].coords:
-				coords_before_zoom = self.map_to_window(coords)
-				edge_coords.append(self.adjust_coord_for_zoom(coords_before_zoom))
-			edge_window_coords[id_] = edge_coords
-		return edge_window_coords
+		window_xy = apply_affine(self.get_window_matrix(), self.coords.geom_xy)
+		return dict(zip(self.coords.edge_ids, self.coords.split(window_xy)))
 
 	def draw(self):
-		# Draw the graph
-
-		if self.bg_img and self.bg_on:
-			self.surface.blit(self.bg_img, (0,0))
-		else:
-			self.surface.fill(self.bg_color)
-		self.draw_edges()
-		self.draw_nodes()
+		# Draw the graph.  The background and graph are redrawn only when they have changed;
+		# otherwise the cached layer is blitted and the overlays are drawn on top.
+
+		if self.layer_dirty:
+			self.render_layer()
+		self.surface.blit(self.graph_layer, (0,0))
+		self.draw_selected_edges()
+		self.draw_colored_nodes()
 		self.draw_mode()
 		self.draw_done()
+		self.draw_stats()
 		if self.zoom_box_on:
 			self.draw_zoom_box()
+		if self.select_points:
+			self.draw_selection()
 		if self.message_on:
 			self.draw_message()
 		if self.input_on:
 			self.draw_input()
+		if self.job:
+			self.draw_progress()
+
+	def draw_stats(self):
+		# Draw the route statistics in the bottom left corner of the window
+
+		if self.stats_surface is None:
+			if self.stats_job is not None or self.deadhead_estimate is None:
+				deadhead = route = 'updating...'
+			else:
+				deadhead = '%.2f km' % (self.deadhead_estimate / 1000)
+				route = '%.2f km' % ((self.total_length + self.deadhead_estimate) / 1000)
+			self.stats_surface = self.create_message_surface(['Odd nodes: %d' % len(self.odd_nodes),
+															  'Total length: %.2f km' % (self.total_length / 1000),
+															  'Estimated deadhead: ' + deadhead,
+															  'Estimated route: ' + route])
+		self.surface.blit(self.stats_surface, (2, self.window_size[1] - self.stats_surface.get_height() - 2))
+
+	def draw_progress(self):
+		# Draw the message and progress bar of the running job
+
+		message = self.create_message_surface([self.job.message, '', 'Press escape to cancel.'])
+		ws = self.window_size
+		ms = message.get_size()
+		bar_height = self.font_size
+		bar = pygame.Rect(self.text_buffer, ms[1] - bar_height - 2*self.text_buffer,
+						  ms[0] - 2*self.text_buffer, bar_height)
+		pygame.draw.rect(message, self.text_color, bar, width=1)
+		fill = bar.inflate(-4, -4)
+		fill.width = int(fill.width * self.job.progress)
+		pygame.draw.rect(message, self.progress_bar_color, fill)
+		self.surface.blit(message, (ws[0]//2-ms[0]//2, ws[1]//2-ms[1]//2))
 
 	def draw_input(self):
 		# Draw the input message
@@ -344,18 +610,61 @@ class GraphEdit:
 
 		self.surface.blit(self.done_surf, self.done_loc)
 
-	def draw_edges(self):
-		# Draw the edges of the graph
+	def render_layer(self):
+		# Render the background and graph into the cached layer
+
+		if self.bg_img and self.bg_on:
+			self.graph_layer.blit(self.bg_img, (0,0))
+		else:
+			self.graph_layer.fill(self.bg_color)
+		self.draw_edges(self.graph_layer)
+		self.draw_nodes(self.graph_layer)
+		self.layer_dirty = False
+
+	def draw_edges(self, surface):
+		# Draw the edges of the graph which are in view
+
+		if self.traversals_on and self.traversals:
+			return self.draw_traversals(surface)
+		# Edges already ridden in recorded tracks are read from the graph, so edits keep them up to date
+		for id_, coord_list in self.draw_edge_coords.items():
+			pygame.draw.lines(surface, self.covered_color if is_covered(self.edges[id_]) else self.line_color, False, coord_list)
+
+	def draw_traversals(self, surface):
+		# Draw the edges which are in view coloured by how many times the last route traversed
+		# them.  Edges which were added since are drawn in the line color.
+
+		for id_, coord_list in self.draw_edge_coords.items():
+			count = self.traversals.get(id_)
+			color = self.line_color if count is None else traversal_color(count)
+			pygame.draw.lines(surface, color, False, coord_list, 1 if count is None or count < 2 else 2)
+
+	def draw_nodes(self, surface):
+		# Draw the nodes of the graph which are in view in the main node color
+
+		if self.zoomed:
+			r = self.node_radius
+			node_ids = self.get_node_index().query_rect(-r, -r, self.window_size[0] + r, self.window_size[1] + r)
+		else:
+			node_ids = self.node_window_coords
+		for id_ in node_ids:
+			pygame.draw.circle(surface, 
+							   self.main_node_color, 
+							   self.node_window_coords[id_],
+							   self.node_radius)
 
-		for coord_list in self.edge_window_coords.values():
-			pygame.draw.lines(self.surface, self.line_color, False, coord_list)
+	def draw_selected_edges(self):
+		# Draw the edges selected for deletion over the cached layer
 
-	def draw_nodes(self):
-		# Draw the nodes of the graph
+		for id_ in self.edges_to_delete:
+			pygame.draw.lines(self.surface, self.node_delete_color, False, self.edge_window_coords[id_], width=3)
 
-		for id_ in self.node_window_coords:
+	def draw_colored_nodes(self):
+		# Draw the selected and starting nodes over the cached layer
+
+		for id_, color in self.node_colors.items():
 			pygame.draw.circle(self.surface, 
-							   self.node_colors[id_], 
+							   color, 
 							   self.node_window_coords[id_],
 							   self.node_radius)
 
@@ -377,21 +686,63 @@ class GraphEdit:
 		zoom_box = pygame.Rect(tl, np.abs(dims))
 		pygame.draw.rect(self.surface, pygame.Color(140, 140, 140), zoom_box, width=2)
 
+	def draw_selection(self):
+		# Draw the selection box or lasso while the mouse is pressed
+
+		mouse_pos = pygame.mouse.get_pos()
+		color = pygame.Color(140, 140, 140)
+		if self.lasso:
+			if len(self.select_points) > 1:
+				pygame.draw.lines(self.surface, color, True, self.select_points + [mouse_pos], width=2)
+			return
+		(x1, y1), (x2, y2) = self.select_points[0], mouse_pos
+		box = pygame.Rect(min(x1, x2), min(y1, y2), abs(x2 - x1), abs(y2 - y1))
+		pygame.draw.rect(self.surface, color, box, width=2)
+
 	def edit_graph(self):
-		# View the graph
+		# View the graph.  The loop sleeps until there is an event to handle.
 
+		self.update_stats()
 		self.draw()
+		pygame.display.update()
 		while not self.close_clicked:
 			self.handle_event()
 			if self.done:
 				break
+			self.update_stats()
+			self.draw()
+			pygame.display.update()
+
+	def wait_for_events(self, timeout=None):
+		# Block until an event arrives, then return it along with any others in the queue.
+		# Returns an empty list if timeout milliseconds pass without an event.
+
+		event = pygame.event.wait() if timeout is None else pygame.event.wait(timeout)
+		if event.type == NOEVENT:
+			return []
+		return [event] + pygame.event.get()
+
+	def run_job(self, job):
+		# Start a Job on a worker thread and display its progress until it finishes.  The
+		# window stays responsive, and pressing escape cancels the job.  Returns the job.
+
+		self.job = job.start()
+		while not job.done() and not job.cancelled:
 			self.draw()
 			pygame.display.update()
+			for event in self.wait_for_events(self.job_poll_interval):
+				if event.type == QUIT:
+					self.close_clicked = True
+					job.cancel()
+				elif event.type == KEYDOWN and event.key == K_ESCAPE:
+					job.cancel()
+		self.job = None
+		return job
 
 	def handle_event_for_input(self):
 		# Handle user events while getting input
 
-		for event in pygame.event.get():
+		for event in self.wait_for_events():
 			if event.type == QUIT:
 				self.close_clicked = True
 
@@ -414,7 +765,7 @@ class GraphEdit:
 	def handle_event(self):
 		# Handle each user event by changing the simulation state appropriately.
 
-		for event in pygame.event.get():
+		for event in self.wait_for_events():
 			if event.type == QUIT:
 				self.close_clicked = True
 
@@ -435,12 +786,12 @@ class GraphEdit:
 					self.close_clicked = True
 
 				# Change the mode
-				elif key in (K_z, K_d, K_n, K_e, K_s, K_c, K_u, K_h, K_b):
+				elif key in self.mode_dict:
 					self.change_mode(key)
 
 				# Remove highlighted nodes (or edge) when delete is pressed in DELETE mode
 				elif key == K_BACKSPACE and self.mode == DELETE:
-					if event.mod and KMOD_SHIFT:
+					if event.mod & KMOD_SHIFT:
 						self.delete_edge()
 					else:
 						self.delete_nodes()
@@ -448,6 +799,9 @@ class GraphEdit:
 			elif event.type == MOUSEBUTTONDOWN and not self.message_on:
 				self.handle_mousebuttondown(event)
 
+			elif event.type == MOUSEMOTION and self.select_points and self.lasso:
+				self.select_points.append(event.pos)
+
 			elif event.type == MOUSEBUTTONUP:
 				self.handle_mousebuttonup(event)
 
@@ -461,14 +815,16 @@ class GraphEdit:
 			collided_node_id = self.check_collide_with_node(event.pos)
 			if collided_node_id:
 				if collided_node_id in self.nodes_to_delete:
-					if collided_node_id == self.starting_node:
-						self.node_colors[collided_node_id] = self.start_node_color
-					else:
-						self.node_colors[collided_node_id] = self.main_node_color
 					self.nodes_to_delete.remove(collided_node_id)
+					self.reset_node_color(collided_node_id)
 				else:
 					self.node_colors[collided_node_id] = self.node_delete_color
-					self.nodes_to_delete.append(collided_node_id)
+					self.nodes_to_delete.add(collided_node_id)
+			else:
+				# Start a selection box, or a lasso if shift is held.  If the mouse is released
+				# without moving, the click selects an edge instead.
+				self.select_points = [event.pos]
+				self.lasso = bool(pygame.key.get_mods() & KMOD_SHIFT)
 
 		elif self.mode == ZOOM:
 			if np.array_equal(self.zoom_matrix, ZOOM_IDENTITY):
@@ -486,18 +842,30 @@ class GraphEdit:
 		elif self.mode == START_NODE:
 			collided_node_id = self.check_collide_with_node(event.pos)
 			if collided_node_id:
-				if self.starting_node:
-					self.node_colors[self.starting_node] = self.main_node_color
-				if self.starting_node == collided_node_id:
-					self.starting_node = None
-				else:
+				old_starting_node, self.starting_node = self.starting_node, None
+				if old_starting_node:
+					self.reset_node_color(old_starting_node)
+				if old_starting_node != collided_node_id:
 					self.starting_node = collided_node_id
 					self.node_colors[self.starting_node] = self.start_node_color
 
 	def handle_mousebuttonup(self, event):
 		# Handle mouse releases on the window
 
-		if self.mode == ZOOM and np.array_equal(self.zoom_matrix, ZOOM_IDENTITY) \
+		if self.mode == DELETE and self.select_points:
+			if self.select_points[0] == event.pos:
+				self.toggle_edge_selection(event.pos)
+			else:
+				self.select_region(self.select_points + [event.pos])
+			self.select_points = None
+
+		elif self.mode == INSPECT:
+			collided_edge_id = self.check_collide_with_edge(event.pos)
+			if collided_edge_id:
+				self.message_on = True
+				self.message = self.create_message_surface(self.describe_edge(collided_edge_id))
+
+		elif self.mode == ZOOM and np.array_equal(self.zoom_matrix, ZOOM_IDENTITY) \
 			and self.zoom_box_click_coords is not None:
 			p1, p2 = self.zoom_box_click_coords, event.pos
 			self.reset_zoom_params()
@@ -530,10 +898,10 @@ class GraphEdit:
 
 		# If we exit DELETE mode, return the highlighted nodes to normal
 		if self.mode == DELETE and new_mode != DELETE:
-			self.node_colors = {id_:self.main_node_color for id_ in self.node_ids}
-			if self.starting_node and self.starting_node in self.node_ids:
-				self.node_colors[self.starting_node] = self.start_node_color
-			self.nodes_to_delete = []
+			self.reset_node_colors()
+			self.nodes_to_delete = set()
+			self.edges_to_delete = set()
+			self.select_points = None
 
 		# If we exit ZOOM mode, reset the zoom parameters
 		# This does not reset the zoom of the graph in the window
@@ -542,9 +910,7 @@ class GraphEdit:
 
 		# If we exit ADD_EDGES mode, reset nodes to original color
 		if self.mode == ADD_EDGES and new_mode != ADD_EDGES:
-			self.node_colors = {id_:self.main_node_color for id_ in self.node_ids}
-			if self.starting_node and self.starting_node in self.node_ids:
-				self.node_colors[self.starting_node] = self.start_node_color
+			self.reset_node_colors()
 			self.edge_adder_node_id = None
 
 		# Reset the zoom if the z key is pressed while zoomed in
@@ -552,8 +918,7 @@ class GraphEdit:
 			self.set_zoom_matrix(reset=True)
 
 		# Consolidate intersections in the graph
-		# This can only be done once
-		if new_mode == CONSOLIDATE_GRAPH and not self.consolidated:
+		if new_mode == CONSOLIDATE_GRAPH:
 			self.consolidate_intersections()
 
 		# Undo the last move
@@ -568,54 +933,73 @@ class GraphEdit:
 		# Turn the background image on or off
 		if new_mode == TOGGLE_BACKGROUND:
 			self.bg_on = False if self.bg_on else True
+			self.layer_dirty = True
+
+		# Colour the edges by how many times the last route traversed them
+		if new_mode == TOGGLE_TRAVERSALS and self.traversals:
+			self.traversals_on = not self.traversals_on
+			self.layer_dirty = True
 
 		# Change the mode
-		if new_mode in (ZOOM, DELETE, ADD_NODES, ADD_EDGES, START_NODE):
+		if new_mode in (ZOOM, DELETE, ADD_NODES, ADD_EDGES, START_NODE, INSPECT):
 			self.mode = new_mode
 
 	def undo(self):
 		# Undo the last graph-affecting change
 
-		if self.graph_list:
-			if self.graph_list[-1][1] == 'c':
-				self.consolidated = False
-			self.G = self.graph_list[-1][0]
-			del self.graph_list[-1]
+		diff = self.undo_log.pop()
+		if diff is None:
+			return
+
+		# Clear any selection, since the selected nodes may not survive the undo
+		for id_ in list(self.nodes_to_delete) + [self.edge_adder_node_id]:
+			self.reset_node_color(id_)
+		self.nodes_to_delete = set()
+		self.edges_to_delete = set()
+		self.edge_adder_node_id = None
+
+		if diff.snapshot is not None:
+			self.G = diff.snapshot
 			self.update_graph_attr()
+			return
+
+		for u, v, key in diff.added_edges:
+			self.remove_edge_attr(self.edge_id(u, v, key))
+		for id_ in diff.added_nodes:
+			self.remove_node_attr(id_)
+		diff.revert(self.G)
+		self.add_nodes_attr([id_ for id_, _ in diff.removed_nodes])
+		self.add_edges_attr([(u, v, key) for u, v, key, _ in diff.removed_edges])
+		self.update_extremes(added=[id_ for id_, _ in diff.removed_nodes], removed=diff.added_nodes)
 
 	def consolidate_intersections(self):
-		# Run the osmnx function osmnx.simplification.consolidate_intersections()
+		# Merge nodes within a tolerance of each other using consolidate.consolidate_intersections()
 
 		tol = self.get_input('Enter consolidation tolerance:')
 		try:
-			tol = int(float(tol))
+			tol = float(tol)
 		except ValueError:
+			tol = 0
+		if tol <= 0:
 			self.message_on = True
 			self.message = self.create_message_surface('Unable to decode tolerance input.')
 			return
-		self.graph_list.append((self.G.copy(), 'c'))
-		self.G = ox.simplification.consolidate_intersections(self.G, 
-															 tolerance=tol,
-															 rebuild_graph=True,
-															 dead_ends=True)
-		self.add_missing_attr()
+
+		# The consolidated graph is built on a worker thread and only replaces the current
+		# graph once it is complete, so a cancelled job leaves the graph untouched
+		G = self.G
+		job = self.run_job(Job(lambda job: consolidate_intersections(G, tol, progress=job.report),
+							   'Consolidating intersections...'))
+		if job.error is not None:
+			self.message_on = True
+			self.message = self.create_message_surface('Unable to consolidate intersections: %s' % job.error)
+			return
+		if job.cancelled:
+			return
+
+		self.undo_log.push(GraphDiff('c', snapshot=self.G))
+		self.G = job.result
 		self.update_graph_attr()
-		self.consolidated = True  # Can only do this once
-
-	def add_missing_attr(self):
-		# Add missing attributes after we consolidate the graph
-
-		for id_ in self.G.nodes:
-			node = self.G.nodes[id_]
-			try:
-				node['street_count']
-			except KeyError:
-				node['street_count'] = len(self.G.edges(id_))
-			try:
-				node['lat']
-			except KeyError:
-				lat_lon = self.retrieve_lat_lon((node['x'], node['y']))
-				node['lat'], node['lon'] = lat_lon
 
 	def set_zoom_matrix(self, reset=False):
 		# Set the zoom
@@ -624,7 +1008,7 @@ class GraphEdit:
 			self.zoom_matrix = ZOOM_IDENTITY
 			self.reverse_zoom_matrix = ZOOM_IDENTITY
 			self.zoomed = False
-			self.update_graph_attr()
+			self.update_zoom()
 			return
 
 		zoomed_coords = np.array([[0, self.window_size[0], self.window_size[0]],
@@ -646,7 +1030,14 @@ class GraphEdit:
 		self.zoom_matrix = np.matmul(zoomed_coords, inverse)
 		self.reverse_zoom_matrix = np.matmul(init_coords_for_reverse, inverse_for_reverse)
 		self.zoomed = True
-		self.update_graph_attr()
+		self.update_zoom()
+
+	def update_zoom(self):
+		# Update the window coordinates and background after the zoom changes
+
+		self.update_window_coords()
+		if self.tiles:
+			self.scale_bg_img_for_zoom()
 
 	def adjust_coord_for_zoom(self, coord, reverse=False):
 		# Adjust coordinates for the zoom
@@ -661,39 +1052,132 @@ class GraphEdit:
 		self.zoom_box_on = False
 		self.zoom_box_click_coords = None
 					
+	def get_node_index(self):
+		# Get the spatial index over node window coordinates, building it if needed
+
+		if self.node_index is None:
+			self.node_index = GridIndex.from_points(list(self.node_window_coords), 
+													list(self.node_window_coords.values()),
+													self.index_cell_size)
+		return self.node_index
+
 	def check_collide_with_node(self, pos):
-		# Check if a point collides with a node on the graph
+		# Check if a point collides with a node on the graph.  Returns the closest such node.
 		
-		for node_id in self.node_window_coords:
-			if norm(np.subtract(self.node_window_coords[node_id], pos)) < self.node_radius:
-				return node_id
-		return None
+		candidates = self.get_node_index().query_point(pos, self.node_radius)
+		closest_id, closest_dist = None, self.node_radius
+		for node_id in candidates:
+			dist = norm(np.subtract(self.node_window_coords[node_id], pos))
+			if dist < closest_dist:
+				closest_id, closest_dist = node_id, dist
+		return closest_id
+
+	def check_collide_with_edge(self, pos):
+		# Check if a point is within node_radius pixels of an edge.  Returns the closest such edge.
+
+		zm = self.zoom_matrix
+		scale = min(abs(zm[0][0]), abs(zm[1][1]))
+		graph_pos = self.map_to_window(self.adjust_coord_for_zoom(pos, reverse=True), reverse=True)
+		candidates = list(self.edge_index.query_point(graph_pos, self.node_radius * self.graph_units_per_pixel() / scale))
+		if not candidates:
+			return None
+		dists = polyline_distances(pos, [self.edge_window_coords[id_] for id_ in candidates])
+		closest = int(np.argmin(dists))
+		return candidates[closest] if dists[closest] <= self.node_radius else None
+
+	def toggle_edge_selection(self, pos):
+		# Select or deselect the edge at a window position in DELETE mode
+
+		collided_edge_id = self.check_collide_with_edge(pos)
+		if collided_edge_id is None:
+			return
+		if collided_edge_id in self.edges_to_delete:
+			self.edges_to_delete.remove(collided_edge_id)
+		else:
+			self.edges_to_delete.add(collided_edge_id)
+
+	def describe_edge(self, id_):
+		# Get lines of text describing an edge for INSPECT mode
+
+		edge = self.edges[id_]
+		name = edge.get('name', 'unknown')
+		lines = ['Name: %s' % (', '.join(name) if type(name) == list else name),
+				 'Nodes: %s - %s' % id_[:2],
+				 'OSM id: %s' % ', '.join(str(osmid) for osmid in self.edge_osmids(edge)),
+				 'Highway: %s' % edge.get('highway', 'unknown'),
+				 'Length: %.1fm' % edge.get('length', 0)]
+		if 'ascent' in edge:
+			lines.append('Ascent: %.1fm  Descent: %.1fm' % (edge['ascent'], edge['descent']))
+		return lines
+
+	def select_region(self, points):
+		# Select the nodes inside a box with opposite corners at the first and last points, or
+		# inside the lasso through all the points.  Candidates come from the node index.
+
+		xy = np.array(points, dtype=np.float64)
+		(min_x, min_y), (max_x, max_y) = xy.min(axis=0), xy.max(axis=0)
+		if min_x == max_x or min_y == max_y:
+			return
+		node_ids = list(self.get_node_index().query_rect(min_x, min_y, max_x, max_y))
+		if not node_ids:
+			return
+		node_xy = np.array([self.node_window_coords[id_] for id_ in node_ids])
+
+		if self.lasso:
+			inside = points_in_polygon(node_xy, xy)
+		else:
+			inside = ((node_xy >= (min_x, min_y)) & (node_xy <= (max_x, max_y))).all(axis=1)
+
+		for id_, selected in zip(node_ids, inside.tolist()):
+			if selected:
+				self.nodes_to_delete.add(id_)
+				self.node_colors[id_] = self.node_delete_color
 
 	def delete_nodes(self):
-		# Delete highlighted nodes in DELETE mode
+		# Delete highlighted nodes, with their edges, and highlighted edges in DELETE mode
 
-		if len(self.nodes_to_delete) == 0:
+		if not self.nodes_to_delete and not self.edges_to_delete:
 			return
-		self.graph_list.append((self.G.copy(), 'd'))
-		for id_ in self.nodes_to_delete:
-			self.G.remove_node(id_)
-		self.nodes_to_delete = []
-		self.update_graph_attr()
+		edges = {self.edge_id(u, v, key) for u, v, key in self.G.edges(self.nodes_to_delete, keys=True)}
+		self.delete_selection(edges | self.edges_to_delete, self.nodes_to_delete)
 
 	def delete_edge(self):
-		# Delete highlighted nodes in DELETE mode
-
-		if len(self.nodes_to_delete) != 2:
-			return
-		orig_G = self.G.copy()
-		try:
-			self.G.remove_edge(*self.nodes_to_delete)
-		except NetworkXError:
+		# Delete highlighted edges and the edges between highlighted nodes in DELETE mode.  With
+		# two nodes selected one edge between them is deleted; with more, every edge joining
+		# two of them is.
+
+		edges = set(self.edges_to_delete)
+		if len(self.nodes_to_delete) == 2:
+			u, v = self.nodes_to_delete
+			if self.G.has_edge(u, v):
+				edges.add(self.edge_id(u, v, list(self.G[u][v])[-1]))  # The edge networkx would remove
+		elif len(self.nodes_to_delete) > 2:
+			edges.update(self.edge_id(u, v, key) for u, v, key in self.G.edges(self.nodes_to_delete, keys=True)
+						 if u in self.nodes_to_delete and v in self.nodes_to_delete)
+		if not edges:
 			return
+		self.delete_selection(edges)
+
+	def delete_selection(self, edges, nodes=()):
+		# Remove edges and nodes from the graph as one undoable change, and clear the selection
+
+		diff = GraphDiff('d')
+		for u, v, key in edges:
+			diff.remove_edge(self.G, u, v, key)
+			self.remove_edge_attr((u, v, key))
+		self.G.remove_edges_from(edges)
+		for id_ in nodes:
+			diff.remove_node(self.G, id_)
+			self.remove_node_attr(id_)
+		self.undo_log.push(diff)
+		self.G.remove_nodes_from(nodes)
+		if nodes:
+			self.update_extremes(removed=nodes)
 
-		self.graph_list.append((orig_G, 'd'))
-		self.nodes_to_delete = []
-		self.update_graph_attr()
+		for id_ in self.nodes_to_delete:
+			self.reset_node_color(id_)
+		self.nodes_to_delete = set()
+		self.edges_to_delete = set()
 
 	def add_node(self, pos):
 		# Add a node a window coordinate pos
@@ -703,16 +1187,19 @@ class GraphEdit:
 		lat_lon = self.retrieve_lat_lon(graph_coord)
 
 		id_ = randint(1000000000, 9999999999)
-		while id_ in self.node_ids:
+		while id_ in self.G:
 			id_ = randint(1000000000, 9999999999)
 
-		self.graph_list.append((self.G.copy(), 'n'))
+		diff = GraphDiff('n')
+		diff.add_node(id_)
+		self.undo_log.push(diff)
 		self.G.add_nodes_from([(id_, {'y':graph_coord[1], 
 									  'x':graph_coord[0], 
 									  'street_count':0,
 									  'lon':lat_lon[1],
 									  'lat':lat_lon[0]})])
-		self.update_graph_attr()
+		self.add_node_attr(id_)
+		self.update_extremes(added=[id_])
 
 	def add_edge(self, node_id):
 		# Add an edge between nodes
@@ -736,22 +1223,31 @@ class GraphEdit:
 		except ValueError:
 			self.message_on = True
 			self.message = self.create_message_surface('Unable to decode length input.')
-			self.edge_adder_node_id = None
-			self.update_graph_attr()
+			self.reset_edge_adder_node()
 			return
 		geometry = LineString([(start_node['x'], start_node['y']), (end_node['x'], end_node['y'])])
 
-		self.graph_list.append((self.G.copy(), 'e'))
-		self.G.add_edges_from([(self.edge_adder_node_id, node_id, {'osmid':osmid,
-															'highway':highway,
-															'oneway':oneway,
-															'length':length,
-															'geometry':geometry})])
+		diff = GraphDiff('e')
+		key = self.G.add_edge(self.edge_adder_node_id, node_id, **{'osmid':osmid,
+																  'highway':highway,
+																  'oneway':oneway,
+																  'length':length,
+																  'geometry':geometry})
+		diff.add_edge(self.edge_adder_node_id, node_id, key)
 		for id_ in (self.edge_adder_node_id, node_id):
+			diff.change_node(self.G, id_, 'street_count')
 			self.G.nodes[id_]['street_count'] += 1
+		self.undo_log.push(diff)
+
+		self.add_edge_attr((self.edge_adder_node_id, node_id, key))
+		self.reset_edge_adder_node()
+
+	def reset_edge_adder_node(self):
+		# Return the first node selected in ADD_EDGES mode to its original color
 
+		if self.edge_adder_node_id is not None:
+			self.reset_node_color(self.edge_adder_node_id)
 		self.edge_adder_node_id = None
-		self.update_graph_attr()
 
 	def get_input(self, text):
 		# Get user input
@@ -762,8 +1258,8 @@ class GraphEdit:
 		self.input_on = True
 		while not self.input_done and not self.close_clicked:
 			self.draw()
-			self.handle_event_for_input()
 			pygame.display.update()
+			self.handle_event_for_input()
 			self.input_message = self.create_input_surface()
 		self.input_done = False
 		self.input_on = False
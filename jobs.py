@@ -0,0 +1,69 @@
+import threading
+
+
+class JobCancelled(Exception):
+	pass
+
+
+class Job:
+	# Run a function on a worker thread.  The function is called with the job as its only
+	# argument, and may call job.report() to publish its progress and job.check() to stop
+	# early once the job has been cancelled.  If given, on_done is called with the job on the
+	# worker thread once it has finished.
+
+	def __init__(self, target, description='', on_done=None):
+
+		self.target = target
+		self.on_done = on_done
+		self.description = description
+		self.progress = 0.0  # Fraction complete, in [0, 1]
+		self.message = description
+		self.result = None
+		self.error = None
+		self.cancelled = False
+		self.finished = threading.Event()
+		self.thread = threading.Thread(target=self.run, daemon=True)
+
+	def start(self):
+
+		self.thread.start()
+		return self
+
+	def run(self):
+
+		try:
+			self.result = self.target(self)
+		except JobCancelled:
+			self.cancelled = True
+		except Exception as e:
+			self.error = e
+		self.finished.set()
+		if self.on_done:
+			self.on_done(self)
+
+	def report(self, progress, message=None):
+		# Publish progress from the worker, stopping if the job has been cancelled
+
+		self.progress = min(max(progress, 0.0), 1.0)
+		if message is not None:
+			self.message = message
+		self.check()
+
+	def check(self):
+
+		if self.cancelled:
+			raise JobCancelled()
+
+	def cancel(self):
+		# Ask the worker to stop.  Work which does not check for cancellation runs to the
+		# end, but its result is discarded.
+
+		self.cancelled = True
+
+	def done(self):
+
+		return self.finished.is_set()
+
+	def wait(self, timeout=None):
+
+		return self.finished.wait(timeout)
@@ -2,14 +2,172 @@
 from PIL import Image
 import math
 import requests
+import sqlite3
 import shutil
 import os
+from abc import ABC, abstractmethod
+
+API_KEY = None  # YOUR MAPBOX API KEY HERE
+
+TILESET_IDS = {'satellite':'mapbox.satellite',
+			   'elevation':'mapbox.terrain-rgb',
+			   'terrain':'mapbox.mapbox-terrain-v2',
+			   'streets':'mapbox.mapbox-streets-v8'}
+
+
+class TileSource(ABC):
+	# Base class for anything that can supply raw (encoded) map tiles
+
+	@abstractmethod
+	def get_tiles(self, z, tiles):
+		# Return a dictionary mapping each (x, y) in tiles to its encoded image bytes,
+		# or to None if the source has no such tile
+		pass
+
+	def get_tile(self, z, x, y):
+
+		return self.get_tiles(z, [(x, y)])[(x, y)]
+
+	def close(self):
+		pass
+
+
+class XYZDirectorySource(TileSource):
+	# Read tiles from a local directory laid out as {z}/{x}/{y}.png
+
+	def __init__(self, root, ext='png'):
+
+		self.root = root
+		self.ext = ext
+
+	def tile_path(self, z, x, y):
+
+		return os.path.join(self.root, str(z), str(x), str(y) + '.' + self.ext)
+
+	def get_tiles(self, z, tiles):
+
+		# List each column directory once rather than probing the disk for every missing tile
+		listings = {}
+		found = {}
+		for x, y in tiles:
+			if x not in listings:
+				try:
+					listings[x] = set(os.listdir(os.path.join(self.root, str(z), str(x))))
+				except FileNotFoundError:
+					listings[x] = set()
+			if str(y) + '.' + self.ext not in listings[x]:
+				found[(x, y)] = None
+				continue
+			with open(self.tile_path(z, x, y), 'rb') as f:
+				found[(x, y)] = f.read()
+		return found
+
+	def put_tiles(self, z, tiles):
+		# Write a dictionary of (x, y):bytes into the directory
+
+		for (x, y), data in tiles.items():
+			if data is None:
+				continue
+			path = self.tile_path(z, x, y)
+			os.makedirs(os.path.dirname(path), exist_ok=True)
+			with open(path, 'wb') as f:
+				f.write(data)
+
+
+class MBTilesSource(TileSource):
+	# Read tiles from an MBTiles SQLite database
+
+	def __init__(self, path):
+
+		assert os.path.exists(path), 'MBTiles file %s does not exist.' % path
+		self.path = path
+		self.conn = sqlite3.connect('file:' + path + '?mode=ro', uri=True, check_same_thread=False)
+
+	def get_tiles(self, z, tiles):
+
+		found = {tile:None for tile in tiles}
+		if not tiles:
+			return found
+
+		# MBTiles stores rows in TMS order, counted from the bottom of the map
+		flip = 2 ** z - 1
+		xs = [x for x, _ in tiles]
+		rows = [flip - y for _, y in tiles]
+
+		# Fetch the whole bounding range in one query and keep the tiles that were asked for
+		cursor = self.conn.execute('SELECT tile_column, tile_row, tile_data FROM tiles '
+								   'WHERE zoom_level = ? AND tile_column BETWEEN ? AND ? '
+								   'AND tile_row BETWEEN ? AND ?',
+								   (z, min(xs), max(xs), min(rows), max(rows)))
+		for x, row, data in cursor:
+			if (x, flip - row) in found:
+				found[(x, flip - row)] = bytes(data)
+		return found
+
+	def close(self):
+		self.conn.close()
+
+
+class MapboxTileSource(TileSource):
+	# Download tiles from the Mapbox API, optionally keeping a local {z}/{x}/{y}.png copy of each tile
+
+	def __init__(self, tileset, api_key=None, cache_dir=None):
+
+		self.tileset = TILESET_IDS.get(tileset, tileset)
+		self.api_key = api_key if api_key else API_KEY
+		assert self.api_key, 'A Mapbox API key is required to download tiles.'
+		self.cache = XYZDirectorySource(cache_dir) if cache_dir else None
+		self.session = requests.Session()
+
+	def get_tiles(self, z, tiles):
+
+		found = self.cache.get_tiles(z, tiles) if self.cache else {tile:None for tile in tiles}
+
+		downloaded = {}
+		failed = {}  # status code -> tiles which were not downloaded
+		for x, y in tiles:
+			if found[(x, y)] is not None:
+				continue
+			r = self.session.get('https://api.mapbox.com/v4/' + self.tileset + \
+								 '/' + str(z) + '/' + str(x) + '/' + str(y) + \
+								 '@2x.pngraw?access_token=' + self.api_key)
+			if r.status_code == 200:
+				downloaded[(x, y)] = r.content
+			elif r.status_code in (401, 403):
+				# Every other tile would be refused too, so stop rather than draw a blank map
+				raise requests.HTTPError('Mapbox refused tile %s/%d/%d/%d with status %d. Check the API key.' %
+										 (self.tileset, z, x, y, r.status_code), response=r)
+			else:
+				failed.setdefault(r.status_code, []).append((x, y))
+
+		for status, missing in failed.items():
+			print('Mapbox returned status %d for %d %s tile(s) at zoom %d, e.g. %s' % (status, len(missing), self.tileset, z, missing[0]))
+
+		if self.cache:
+			self.cache.put_tiles(z, downloaded)
+		found.update(downloaded)
+		return found
+
+	def close(self):
+		self.session.close()
+
+
+def open_tile_source(source, img_type='satellite', api_key=None, cache_dir=None):
+	# Return a TileSource for an MBTiles file, a tile directory, or (if source is None) the Mapbox API
+
+	if isinstance(source, TileSource):
+		return source
+	if source is None:
+		return MapboxTileSource(img_type, api_key=api_key, cache_dir=cache_dir)
+	if source.endswith('.mbtiles'):
+		return MBTilesSource(source)
+	assert os.path.isdir(source), 'Tile source %s is neither an MBTiles file nor a directory.' % source
+	return XYZDirectorySource(source)
 
-API_KEY = #YOUR MAPBOX API KEY HERE
 
 class MapboxLoader:
 
-	def __init__(self, top_left, bottom_right, zoom=15, verbose=False, api_key=None):
+	def __init__(self, top_left, bottom_right, zoom=15, verbose=False, api_key=None, source=None):
 
 		self.tl = top_left  # Top left lat-lon coords
 		self.br = bottom_right  # Bottom right lat-lon coords
@@ -24,15 +182,11 @@ class MapboxLoader:
 		self.y_tile_range = (self.tl_tile[1], self.br_tile[1])
 
 		self.api_key = api_key if api_key else API_KEY
+		self.source = source  # An MBTiles file, a {z}/{x}/{y}.png directory, or a TileSource
 
 		self.img_id = str(sum((sum(top_left), sum(bottom_right))) + zoom)
 
-	def generate_data(self, img_type='satellite'):
-
-		tileset_ids = {'satellite':'mapbox.satellite',
-					   'elevation':'mapbox.terrain-rgb',
-					   'terrain':'mapbox.mapbox-terrain-v2',
-					   'streets':'mapbox.mapbox-streets-v8'}
+	def generate_data(self, img_type='satellite', batch_size=256):
 
 		dirname = './' + img_type + '/'
 
@@ -41,19 +195,22 @@ class MapboxLoader:
 		n_imgs = (self.br_tile[0]-self.tl_tile[0]+1) * (self.br_tile[1]-self.tl_tile[1]+1)
 		if self.verbose: print('    Retrieving %i images...' % n_imgs)
 
-		# Loop over the tile ranges
-		for i,x in enumerate(range(self.x_tile_range[0], self.x_tile_range[1]+1)):
-			for j,y in enumerate(range(self.y_tile_range[0], self.y_tile_range[1]+1)):
-
-				#Call the URL to get the terrain image back
-				r = requests.get('https://api.mapbox.com/v4/' + tileset_ids[img_type] + \
-								 '/' + str(self.z) + '/' + str(x) + '/' + str(y) + \
-							 	 '@2x.pngraw?access_token=' + self.api_key, stream=True)
-
-				# Write the raw content to an image
+		source = open_tile_source(self.source, img_type, api_key=self.api_key, cache_dir='./tiles/' + img_type)
+
+		# Each tile is written to i.j.png, where i and j are its offsets within the tile ranges
+		tiles = [(x, y) for x in range(self.x_tile_range[0], self.x_tile_range[1]+1)
+						for y in range(self.y_tile_range[0], self.y_tile_range[1]+1)]
+		for k in range(0, len(tiles), batch_size):
+			batch = source.get_tiles(self.z, tiles[k:k+batch_size])
+			for (x, y), data in batch.items():
+				if data is None:
+					continue
+				i, j = x - self.x_tile_range[0], y - self.y_tile_range[0]
 				with open(dirname + str(i) + '.' + str(j) + '.png', 'wb') as f:
-					r.raw.decode_content = True
-					shutil.copyfileobj(r.raw, f) 
+					f.write(data)
+
+		if source is not self.source:
+			source.close()
 
 	def compose_image(self, dirname, remove_temp=False, save=False):
 
@@ -106,8 +263,11 @@ class MapboxLoader:
 			x_offset = 0
 			for j in range(edge_length_y):
 				# Open up the image file and paste it into the composed image at the given offset position
-				tmp_img = Image.open(dirname + str(i) + '.' + str(j) + '.png')
-				composite.paste(tmp_img, (y_offset, x_offset))
+				# Tiles missing from a local source are left blank
+				tile_file = dirname + str(i) + '.' + str(j) + '.png'
+				if os.path.exists(tile_file):
+					tmp_img = Image.open(tile_file)
+					composite.paste(tmp_img, (y_offset, x_offset))
 				x_offset += width # Update the width
 			y_offset += height # Update the height
 
@@ -0,0 +1,137 @@
+import numpy as np
+import json
+import os
+
+from graphcoords import PackedCoords
+
+
+# Colours for edges traversed 0, 1, 2, 3 and 4 or more times in heatmaps of a route
+TRAVERSAL_COLORS = ((90, 90, 90), (255, 255, 255), (255, 210, 0), (255, 120, 0), (230, 0, 0))
+
+
+def traversal_color(count):
+	# Return the heatmap colour of an edge traversed count times
+
+	return TRAVERSAL_COLORS[min(count, len(TRAVERSAL_COLORS) - 1)]
+
+
+class RouteArtifact:
+	# A graph and a route over it stored as flat arrays.  Saved artifacts are a directory
+	# of .npy files, which are memory mapped when loaded, and a small meta.json.
+	#
+	#   node_ids      (n,) int64     node ids
+	#   node_xy       (n, 2) float64 projected coordinates
+	#   node_lat_lon  (n, 2) float64 latitudes and longitudes
+	#   edge_nodes    (m, 2) int64   rows of the nodes at the ends of each edge
+	#   edge_keys     (m,) int64     multigraph keys of the edges
+	#   edge_length   (m,) float64   edge lengths in meters
+	#   edge_name     (m,) int64     index of each edge's name in meta['names'], or -1
+	#   geom_xy       (k, 2) float64 edge geometry coordinates
+	#   geom_offsets  (m+1,) int64   the geometry of edge i is geom_xy[geom_offsets[i]:geom_offsets[i+1]]
+	#   route_nodes   (r+1,) int64   rows of the nodes visited by the route, in order
+	#   route_edges   (r,) int64     rows of the edges traversed by the route, in order
+
+	arrays = ('node_ids', 'node_xy', 'node_lat_lon', 'edge_nodes', 'edge_keys', 'edge_length', 'edge_name',
+			  'geom_xy', 'geom_offsets', 'route_nodes', 'route_edges')
+	version = 1
+
+	def __init__(self, meta, **arrays):
+
+		self.meta = meta
+		for name in self.arrays:
+			setattr(self, name, arrays[name])
+
+	@classmethod
+	def from_route(cls, G, circuit, graph_fingerprint=None):
+		# Build an artifact from a graph and an Eulerian circuit of (u, v, edge data by key)
+		# tuples as returned by cppsolver.solve_cpp.  graph_fingerprint identifies the graph
+		# the route was planned on, so later sessions can tell whether the route is theirs.
+
+		packed = PackedCoords.from_graph(G)
+		node_row = packed.node_row
+		edge_row = packed.edge_row
+
+		names = {}
+		edge_name = []
+		for id_ in packed.edge_ids:
+			name = G.edges[id_].get('name')
+			if type(name) == list:
+				name = name[0]
+			edge_name.append(-1 if name is None else names.setdefault(name, len(names)))
+
+		route_nodes = [node_row[circuit[0][0]]] + [node_row[v] for _, v, _ in circuit]
+		route_edges = []
+		for u, v, data in circuit:
+			key = next(iter(data))
+			route_edges.append(edge_row[(u, v, key)] if (u, v, key) in edge_row else edge_row[(v, u, key)])
+
+		meta = {'version':cls.version,
+				'crs':str(G.graph.get('crs')),
+				'names':list(names)}
+		if graph_fingerprint is not None:
+			meta['graph_fingerprint'] = graph_fingerprint
+		return cls(meta,
+				   node_ids=np.array(packed.node_ids, dtype=np.int64),
+				   node_xy=packed.node_xy,
+				   node_lat_lon=np.array([(G.nodes[id_]['lat'], G.nodes[id_]['lon']) for id_ in packed.node_ids],
+										 dtype=np.float64).reshape(-1, 2),
+				   edge_nodes=np.array([(node_row[u], node_row[v]) for u, v, _ in packed.edge_ids],
+									   dtype=np.int64).reshape(-1, 2),
+				   edge_keys=np.array([key for _, _, key in packed.edge_ids], dtype=np.int64),
+				   edge_length=np.array([G.edges[id_].get('length', 0) for id_ in packed.edge_ids], dtype=np.float64),
+				   edge_name=np.array(edge_name, dtype=np.int64),
+				   geom_xy=packed.geom_xy,
+				   geom_offsets=packed.offsets,
+				   route_nodes=np.array(route_nodes, dtype=np.int64),
+				   route_edges=np.array(route_edges, dtype=np.int64))
+
+	def save(self, path):
+		# Write the artifact to the directory path
+
+		os.makedirs(path, exist_ok=True)
+		for name in self.arrays:
+			np.save(os.path.join(path, name + '.npy'), getattr(self, name))
+		with open(os.path.join(path, 'meta.json'), 'w') as meta_file:
+			json.dump(self.meta, meta_file)
+
+	@classmethod
+	def load(cls, path, mmap=True):
+		# Open an artifact saved in the directory path.  The arrays are memory mapped unless
+		# mmap is False, so only the parts which are used are read from disk.
+
+		with open(os.path.join(path, 'meta.json')) as meta_file:
+			meta = json.load(meta_file)
+		if meta.get('version') != cls.version:
+			raise ValueError('Unsupported route artifact version: %s' % meta.get('version'))
+		mmap_mode = 'r' if mmap else None
+		return cls(meta, **{name:np.load(os.path.join(path, name + '.npy'), mmap_mode=mmap_mode)
+							for name in cls.arrays})
+
+	def bounds(self):
+		# Return the x and y bounds over all nodes and edge geometries
+
+		lo = np.minimum(self.node_xy.min(axis=0), self.geom_xy.min(axis=0))
+		hi = np.maximum(self.node_xy.max(axis=0), self.geom_xy.max(axis=0))
+		return ((lo[0], hi[0]), (lo[1], hi[1]))
+
+	def traversal_counts(self):
+		# Return the number of times the route traverses each edge, indexed by edge row
+
+		return np.bincount(self.route_edges, minlength=len(self.edge_length))
+
+	def edge_traversals(self):
+		# Return a dictionary of the number of times the route traverses each edge, keyed by
+		# (u, v, key) edge ids with the nodes in both orders
+
+		us, vs = self.node_ids[self.edge_nodes].T.tolist()
+		counts = self.traversal_counts().tolist()
+		keys = self.edge_keys.tolist()
+		traversals = dict(zip(zip(vs, us, keys), counts))
+		traversals.update(zip(zip(us, vs, keys), counts))
+		return traversals
+
+	def edge_name_of(self, row):
+		# Return the name of the edge in a row, or 'unknown'
+
+		index = int(self.edge_name[row])
+		return self.meta['names'][index] if index >= 0 else 'unknown'
@@ -0,0 +1,85 @@
+import os
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')  # Render without a display
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+
+def frame_distances(total, frames):
+	# Return the distance along a route of total meters shown by each of a number of frames
+
+	if frames == 1:
+		return [total]
+	return [total * i / (frames - 1) for i in range(frames)]
+
+
+def save_frame(surface, path, compress_level=3):
+	# Save a surface as a PNG file.  Encoding takes most of the time of a frame, and PIL at a
+	# low compression level is about twice as fast as pygame.image.save.
+
+	import pygame
+	from PIL import Image
+
+	Image.frombytes('RGB', surface.get_size(), pygame.image.tobytes(surface, 'RGB')).save(path, compress_level=compress_level)
+
+
+def render_range(path, out_dir, frames, start, stop, max_size=(1440, 848), overlay=True, compress_level=3):
+	# Render the frames start:stop of a route artifact's playback to PNG files in out_dir.
+	# Frames are drawn in order, so the traversed part of the route is only drawn once.
+	# Returns the number of frames written.
+
+	import pygame
+	from routeartifact import RouteArtifact
+	from routeviewer import RouteViewer
+
+	viewer = RouteViewer(RouteArtifact.load(path), max_size)
+	viewer.overlay = overlay
+	viewer.playing = True
+	distances = frame_distances(viewer.distances[-1], frames)
+	for i in range(start, stop):
+		viewer.seek_distance(distances[i])
+		viewer.draw()
+		save_frame(viewer.surface, os.path.join(out_dir, 'frame_%05d.png' % i), compress_level)
+	pygame.quit()
+	return stop - start
+
+
+def render_route(path, out_dir, frames=300, workers=None, max_size=(1440, 848), overlay=True, compress_level=3):
+	# Render frames of a route artifact's playback to out_dir across a process pool.  Each
+	# worker draws one contiguous range of frames, so it only draws the route up to the
+	# start of its range once.
+
+	os.makedirs(out_dir, exist_ok=True)
+	workers = min(workers or os.cpu_count() or 1, frames)
+	bounds = [frames * i // workers for i in range(workers + 1)]
+	with ProcessPoolExecutor(max_workers=workers) as pool:
+		futures = [pool.submit(render_range, path, out_dir, frames, start, stop, max_size, overlay, compress_level)
+				   for start, stop in zip(bounds[:-1], bounds[1:]) if stop > start]
+		return sum(future.result() for future in futures)
+
+
+def parse_args(args=None):
+	# Parse arguments from user
+
+	parser = argparse.ArgumentParser(description='Render the playback of a route to PNG frames without a display.')
+	parser.add_argument('artifact', type=str, help='The route artifact directory written by cpp_interactive.py or batch.py.')
+	parser.add_argument('out_dir', type=str, help='The directory to write frame_00000.png, frame_00001.png, ... to.')
+	parser.add_argument('--frames', type=int, default=300, help='The number of frames to spread evenly along the route.')
+	parser.add_argument('--workers', type=int, default=None, help='The number of processes to render with. Defaults to the number of CPUs.')
+	parser.add_argument('--max_width', type=int, default=1440, help='The largest frame width.')
+	parser.add_argument('--max_height', type=int, default=848, help='The largest frame height.')
+	parser.add_argument('--compress_level', type=int, default=3, help='The PNG compression level from 0 to 9. Higher levels give smaller files but render more slowly.')
+	parser.add_argument('--no_overlay', action='store_true', help='Leave out the progress bar and status line.')
+	return parser.parse_args(args)
+
+
+def main(args):
+
+	start = time.perf_counter()
+	count = render_route(args.artifact, args.out_dir, args.frames, args.workers, (args.max_width, args.max_height), not args.no_overlay,
+						 args.compress_level)
+	print('Rendered %d frames to %s in %.1fs' % (count, args.out_dir, time.perf_counter() - start))
+
+
+if __name__ == '__main__':
+	main(parse_args())
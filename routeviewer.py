@@ -2,31 +2,36 @@ import os
 os.environ['PYGAME_HIDE_SUPPORT_PROMPT'] = "hide"
 import pygame
 from pygame.locals import *
-import networkx as nx
-import pickle
+import numpy as np
+import sys
 
-from graphedit import GraphEdit as ge
+from graphcoords import window_matrix, apply_affine
+from routeartifact import RouteArtifact, traversal_color
 
 class RouteViewer:
-
-	def __init__(self, graph, route):
-
-		self.G = graph
-		self.route = route
-		self.window_size = self.get_window_size()
+	# The network is drawn once onto a base surface.  The traversed part of the route is drawn
+	# onto a copy of it as the cursor moves forward, with snapshots every keyframe_steps
+	# steps so moving backward only redraws from the nearest snapshot.  Each frame blits
+	# that surface and draws the cursor, scrub bar and status line on top.  The heatmap of how
+	# many times each edge is traversed is drawn once, the first time it is shown.
+
+	def __init__(self, artifact, max_size=(1440, 848)):
+
+		self.artifact = artifact  # A RouteArtifact holding the graph and route
+		self.route = artifact.route_nodes  # Rows of the nodes visited by the route
+		self.route_edges = np.asarray(artifact.route_edges)
+		self.orig_x_bounds, self.orig_y_bounds = artifact.bounds()
+		self.window_size = self.get_window_size(*max_size)
 		self.surface = self.create_window(self.window_size, 'Route Viewer')
-
-		self.orig_x_bounds = ge.get_x_bounds(self.G)
-		self.orig_y_bounds = ge.get_y_bounds(self.G)
 		self.buffer = 10
 
-		self.nodes = self.G.nodes
-		self.node_ids = list(self.nodes)
-		self.edges = self.G.edges
-		self.edge_ids = list(self.edges)
 		self.node_window_coords = self.get_node_window_coords()
 		self.edge_window_coords = self.get_edge_window_coords()
 
+		# distances[i] is the length of the route up to its i-th node
+		self.distances = np.zeros(len(self.route))
+		np.cumsum(artifact.edge_length[self.route_edges], out=self.distances[1:])
+
 		self.close_clicked = False
 
 		self.bg_color = pygame.Color('black')
@@ -34,15 +39,39 @@ class RouteViewer:
 		self.edge_color = pygame.Color('white')
 		self.selected_color = pygame.Color('red')
 		self.selected_node_color = pygame.Color('green')
+		self.traversed_color = pygame.Color(255, 140, 0)
+		self.bar_color = pygame.Color(60, 60, 60)
+		self.text_color = pygame.Color('white')
+		self.text_bg_color = pygame.Color(0, 0, 0, 180)
 		self.node_radius = 2
+		self.cursor_radius = 5
+		self.traversed_width = 2
+		self.bar_height = 10
+
+		pygame.font.init()
+		self.font = pygame.font.SysFont('arial', 14)
 
 		self.selected_index = 0
+		self.position = 0.0  # Meters along the route, which may lie past the selected node
+		self.fps = 60
+		self.playing = False
+		self.speed = max(self.distances[-1] / 60, 10.0)  # Meters of route per second of playback
+		self.scrubbing = False
+		self.km_input = None  # The kilometer being typed after pressing g, or None
+		self.overlay = True  # Whether to draw the scrub bar and status line
+
+		self.base = self.draw_base()
+		self.trail = self.base.copy()
+		self.trail_index = 0  # The number of steps drawn on trail
+		self.keyframe_steps = max(len(self.route_edges) // 16, 256)
+		self.keyframes = {0:self.base}  # Step -> copy of trail with that many steps drawn
+		self.heatmap = None  # The network coloured by traversal count, drawn when first shown
+		self.heatmap_on = False
 
 	def get_window_size(self, max_width=1440, max_height=848):
 		# Get the window size which matches the proportions of the graph G
 
-		x_bounds = ge.get_x_bounds(self.G)
-		y_bounds = ge.get_y_bounds(self.G)
+		x_bounds, y_bounds = self.orig_x_bounds, self.orig_y_bounds
 		width = int( max_height*(x_bounds[1] - x_bounds[0])/(y_bounds[1] - y_bounds[0]) )
 		if width <= max_width:
 			return (width, max_height)
@@ -59,119 +88,237 @@ class RouteViewer:
 
 	def get_node_window_coords(self):
 		# Get window coordinates of all nodes in the graph
-		# Returns a dictionary with the node id as the key and window coords as the value
-
-		node_window_coords = {}
-		for id_ in self.node_ids:
-			node = self.nodes[id_]
-			node_window_coords[id_] = ge.map_to_window(ge, 
-													   (node['x'], node['y']), 
-													   ws=self.window_size,
-													   x_bounds=self.orig_x_bounds,
-													   y_bounds=self.orig_y_bounds,
-													   edge_buffer=self.buffer)
-		return node_window_coords
+		# Returns a list of window coords indexed by node row
+
+		matrix = window_matrix(self.window_size, self.orig_x_bounds, self.orig_y_bounds, self.buffer)
+		return apply_affine(matrix, self.artifact.node_xy).tolist()
 
 	def get_edge_window_coords(self):
 		# Get window coordinates of all edge points in the graph
-		# Returns a dictionary with the edge id as the key and window coords list as the value
-
-		edge_window_coords = {}
-		for id_ in self.edge_ids:
-			edge_coords = []
-			for coords in self.edges[id_]['geometry'].coords:
-				edge_coords.append(ge.map_to_window(ge, 
-													coords,
-													ws=self.window_size,
-													x_bounds=self.orig_x_bounds,
-													y_bounds=self.orig_y_bounds,
-													edge_buffer=self.buffer))
-			edge_window_coords[id_] = edge_coords
-		return edge_window_coords
+		# Returns a list of window coords lists indexed by edge row
+
+		matrix = window_matrix(self.window_size, self.orig_x_bounds, self.orig_y_bounds, self.buffer)
+		window_xy = apply_affine(matrix, self.artifact.geom_xy).tolist()
+		offsets = self.artifact.geom_offsets.tolist()
+		return [window_xy[a:b] for a, b in zip(offsets[:-1], offsets[1:])]
 
 	def view_route(self):
+		# Run the viewer.  The loop runs at up to fps frames per second while the route is
+		# playing or being scrubbed, and otherwise sleeps until an event arrives.
 
+		clock = pygame.time.Clock()
 		self.draw()
+		pygame.display.update()
 		while not self.close_clicked:
-			self.handle_event()
+			if self.playing or self.scrubbing:
+				events = pygame.event.get()
+			else:
+				events = self.wait_for_events()
+			for event in events:
+				self.handle_event(event)
+
+			dt = min(clock.tick(self.fps) / 1000, 0.1)
+			if self.playing:
+				self.advance(dt)
 			self.draw()
 			pygame.display.update()
 		pygame.quit()
 
+	def wait_for_events(self):
+		# Block until an event arrives, then return it along with any others in the queue
+
+		return [pygame.event.wait()] + pygame.event.get()
+
+	def draw_base(self):
+		# Draw the network onto a new surface
+
+		base = pygame.Surface(self.window_size)
+		base.fill(self.bg_color)
+		for coord_list in self.edge_window_coords:
+			pygame.draw.lines(base, self.edge_color, False, coord_list)
+		for pos in self.node_window_coords:
+			pygame.draw.circle(base, self.node_main_color, pos, self.node_radius)
+		pygame.draw.circle(base, self.selected_node_color, self.node_window_coords[self.route[0]], self.node_radius + 1)
+		return base
+
+	def draw_heatmap(self):
+		# Draw the network onto a new surface with each edge coloured by the number of times the
+		# route traverses it.  Edges are drawn in order of their count so repeats are on top.
+
+		counts = self.artifact.traversal_counts()
+		heatmap = pygame.Surface(self.window_size)
+		heatmap.fill(self.bg_color)
+		for row in np.argsort(counts, kind='stable').tolist():
+			count = int(counts[row])
+			pygame.draw.lines(heatmap, traversal_color(count), False, self.edge_window_coords[row], 1 if count < 2 else self.traversed_width)
+		pygame.draw.circle(heatmap, self.selected_node_color, self.node_window_coords[self.route[0]], self.node_radius + 1)
+		return heatmap
+
+	def update_trail(self):
+		# Bring the traversed part of the route on the trail surface up to the selected node
+
+		# Start from the nearest snapshot when moving back or when it is further along
+		step = max(step for step in self.keyframes if step <= self.selected_index)
+		if self.selected_index < self.trail_index or step > self.trail_index:
+			self.trail = self.keyframes[step].copy()
+			self.trail_index = step
+
+		coords = self.edge_window_coords
+		for step in range(self.trail_index, self.selected_index):
+			pygame.draw.lines(self.trail, self.traversed_color, False, coords[self.route_edges[step]], self.traversed_width)
+			if (step + 1) % self.keyframe_steps == 0 and step + 1 not in self.keyframes:
+				self.keyframes[step + 1] = self.trail.copy()
+		self.trail_index = max(self.trail_index, self.selected_index)
+
 	def draw(self):
 		# Draw the window objects
 
-		self.surface.fill(self.bg_color)
-		self.draw_edges()
-		self.draw_nodes()
+		if self.heatmap_on:
+			if self.heatmap is None:
+				self.heatmap = self.draw_heatmap()
+			self.surface.blit(self.heatmap, (0, 0))
+		else:
+			self.update_trail()
+			self.surface.blit(self.trail, (0, 0))
 		self.draw_selected()
-
-	def draw_edges(self):
-		# Draw the edges of the graph on the window
-
-		for coord_list in self.edge_window_coords.values():
-			pygame.draw.lines(self.surface, self.edge_color, False, coord_list)
-
-	def draw_nodes(self):
-		# Draw the graph nodes on the window
-
-		for id_ in self.node_window_coords:
-			if id_ == self.route[0]:
-				pygame.draw.circle(self.surface, 
-								   self.selected_node_color, 
-								   self.node_window_coords[id_],
-								   self.node_radius)
-			else:
-				pygame.draw.circle(self.surface, 
-								   self.node_main_color, 
-								   self.node_window_coords[id_],
-								   self.node_radius)
+		if self.overlay:
+			self.draw_scrub_bar()
+			self.draw_status()
 
 	def draw_selected(self):
-		# Highlight the selected node
-
-		selected_id = self.route[self.selected_index]
+		# Highlight the selected node and the edge the route takes next from it
 
+		if self.selected_index < len(self.route_edges):
+			pygame.draw.lines(self.surface, self.selected_color, False,
+							  self.edge_window_coords[self.route_edges[self.selected_index]], self.traversed_width + 1)
 		pygame.draw.circle(self.surface,
 						   self.selected_color,
-						   self.node_window_coords[selected_id],
-						   self.node_radius)
-
-	def handle_event(self):
-		# Handle user events
-
-		for event in pygame.event.get():
-			if event.type == QUIT:
+						   self.node_window_coords[self.route[self.selected_index]],
+						   self.cursor_radius)
+
+	def scrub_bar_rect(self):
+
+		return pygame.Rect(self.buffer, self.window_size[1] - self.bar_height - 4, self.window_size[0] - 2*self.buffer, self.bar_height)
+
+	def draw_scrub_bar(self):
+		# Draw a bar along the bottom of the window showing how far along the route the cursor is
+
+		bar = self.scrub_bar_rect()
+		pygame.draw.rect(self.surface, self.bar_color, bar)
+		filled = bar.copy()
+		filled.width = int(bar.width * self.position / max(self.distances[-1], 1e-9))
+		pygame.draw.rect(self.surface, self.traversed_color, filled)
+		pygame.draw.rect(self.surface, self.text_color, bar, width=1)
+
+	def draw_status(self):
+		# Draw the position along the route in the top left corner of the window
+
+		name = self.artifact.edge_name_of(self.route_edges[self.selected_index]) if self.selected_index < len(self.route_edges) else ''
+		line = 'Step %d/%d   %.2f/%.2f km   %s   %s %.0f m/s' % (self.selected_index, len(self.route_edges),
+																self.distances[self.selected_index] / 1000, self.distances[-1] / 1000,
+																name, 'Playing' if self.playing else 'Paused', self.speed)
+		if self.km_input is not None:
+			line = 'Go to km: %s_' % self.km_input
+		text = self.font.render(line, True, self.text_color)
+		background = pygame.Surface((text.get_width() + 8, text.get_height() + 4), SRCALPHA)
+		background.fill(self.text_bg_color)
+		background.blit(text, (4, 2))
+		self.surface.blit(background, (2, 2))
+
+	def handle_event(self, event):
+		# Handle a user event
+
+		if event.type == QUIT:
+			self.close_clicked = True
+
+		elif event.type == KEYDOWN and self.km_input is not None:
+			self.handle_km_input(event)
+
+		elif event.type == KEYDOWN:
+			shift = event.mod & KMOD_SHIFT
+			if event.key == K_ESCAPE:
 				self.close_clicked = True
-
-			elif event.type == KEYDOWN:
-				if event.key == K_ESCAPE:
-					self.close_clicked = True
-				elif event.key in (K_UP, K_RIGHT):
-					self.increment_index()
-				elif event.key in (K_DOWN, K_LEFT):
-					self.increment_index(-1)
+			elif event.key in (K_UP, K_RIGHT):
+				self.increment_index(100 if shift else 1)
+			elif event.key in (K_DOWN, K_LEFT):
+				self.increment_index(-100 if shift else -1)
+			elif event.key == K_PAGEUP:
+				self.seek_distance(self.position + 1000)
+			elif event.key == K_PAGEDOWN:
+				self.seek_distance(self.position - 1000)
+			elif event.key == K_HOME:
+				self.seek_distance(0)
+			elif event.key == K_END:
+				self.seek_distance(self.distances[-1])
+			elif event.key == K_SPACE:
+				self.playing = not self.playing
+				if self.position >= self.distances[-1]:
+					self.seek_distance(0)
+			elif event.key in (K_EQUALS, K_PLUS, K_KP_PLUS, K_f):
+				self.speed *= 2
+			elif event.key in (K_MINUS, K_KP_MINUS, K_s):
+				self.speed /= 2
+			elif event.key == K_t:
+				self.heatmap_on = not self.heatmap_on
+			elif event.key == K_g:
+				self.km_input = ''
+				self.playing = False
+
+		elif event.type == MOUSEBUTTONDOWN and event.button == 1 and self.scrub_bar_rect().inflate(0, 8).collidepoint(event.pos):
+			self.scrubbing = True
+			self.scrub(event.pos)
+		elif event.type == MOUSEMOTION and self.scrubbing:
+			self.scrub(event.pos)
+		elif event.type == MOUSEBUTTONUP and event.button == 1:
+			self.scrubbing = False
+
+	def handle_km_input(self, event):
+		# Collect the kilometer typed after pressing g, and go to it when enter is pressed
+
+		if event.key in (K_RETURN, K_KP_ENTER):
+			try:
+				self.seek_distance(float(self.km_input) * 1000)
+			except ValueError:
+				pass
+			self.km_input = None
+		elif event.key == K_ESCAPE:
+			self.km_input = None
+		elif event.key == K_BACKSPACE:
+			self.km_input = self.km_input[:-1]
+		elif event.unicode and event.unicode in '0123456789.':
+			self.km_input += event.unicode
 
 	def increment_index(self, amount=1):
 		# Increment the selected node index
 
 		self.selected_index += amount
 		self.selected_index %= len(self.route)
+		self.position = self.distances[self.selected_index]
 
-def main():
+	def seek_distance(self, distance):
+		# Select the last node of the route at most distance meters along it
 
-	with open('graph.pkl', 'rb') as graph_file:
-		graph = pickle.load(graph_file)
-	with open('route.pkl', 'rb') as route_file:
-		route = pickle.load(route_file)
+		self.position = min(max(distance, 0), self.distances[-1])
+		self.selected_index = int(np.searchsorted(self.distances, self.position, side='right')) - 1
 
-	route_viewer = RouteViewer(graph, route)
+	def scrub(self, pos):
+		# Seek to the point along the route under a position on the scrub bar
 
-	route_viewer.view_route()
+		bar = self.scrub_bar_rect()
+		self.seek_distance((pos[0] - bar.left) / bar.width * self.distances[-1])
 
-if __name__ == '__main__':
-	main()
+	def advance(self, dt):
+		# Move the cursor forward by dt seconds of playback, stopping at the end of the route
 
+		self.seek_distance(self.position + self.speed * dt)
+		if self.position >= self.distances[-1]:
+			self.playing = False
 
+def main(path='route'):
 
+	route_viewer = RouteViewer(RouteArtifact.load(path))
 
+	route_viewer.view_route()
+
+if __name__ == '__main__':
+	main(*sys.argv[1:2])
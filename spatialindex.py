@@ -0,0 +1,168 @@
+import numpy as np
+import math
+
+
+class GridIndex:
+	# A uniform grid spatial hash.  Keys are stored in every cell their bounding box overlaps,
+	# so a query only has to look at the keys in the cells it covers.
+
+	def __init__(self, cell_size):
+
+		self.cell_size = cell_size
+		self.cells = {}  # (i, j) cell -> set of keys
+		self.key_cells = {}  # key -> sequence of cells the key was inserted into
+
+	@classmethod
+	def from_points(cls, keys, points, cell_size):
+		# Build an index of points from a list of keys and an (n, 2) array of coordinates
+
+		index = cls(cell_size)
+		points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+		cells = np.floor(points / cell_size).astype(np.int64)
+		cells = list(zip(cells[:, 0].tolist(), cells[:, 1].tolist()))
+		for key, cell in zip(keys, cells):
+			found = index.cells.get(cell)
+			if found is None:
+				index.cells[cell] = {key}
+			else:
+				found.add(key)
+		index.key_cells = dict(zip(keys, zip(cells)))
+		return index
+
+	def cell_range(self, min_x, min_y, max_x, max_y):
+		# Return the cells overlapping a box
+
+		size = self.cell_size
+		return [(i, j) for i in range(math.floor(min_x / size), math.floor(max_x / size) + 1)
+					   for j in range(math.floor(min_y / size), math.floor(max_y / size) + 1)]
+
+	def insert(self, key, bbox):
+		# Insert a key with bounding box (min_x, min_y, max_x, max_y), replacing any previous entry
+
+		if key in self.key_cells:
+			self.remove(key)
+		cells = self.cell_range(*bbox)
+		for cell in cells:
+			self.cells.setdefault(cell, set()).add(key)
+		self.key_cells[key] = cells
+
+	def insert_point(self, key, pos):
+
+		self.insert(key, (pos[0], pos[1], pos[0], pos[1]))
+
+	def remove(self, key):
+
+		for cell in self.key_cells.pop(key, ()):
+			keys = self.cells[cell]
+			keys.discard(key)
+			if not keys:
+				del self.cells[cell]
+
+	def query_rect(self, min_x, min_y, max_x, max_y):
+		# Return the set of keys in cells overlapping a box.  Keys near the box may be included,
+		# so callers should check the exact geometry of the candidates.
+
+		found = set()
+		for cell in self.cell_range(min_x, min_y, max_x, max_y):
+			keys = self.cells.get(cell)
+			if keys:
+				found.update(keys)
+		return found
+
+	def query_point(self, pos, radius):
+		# Return the set of keys which may lie within radius of pos
+
+		return self.query_rect(pos[0] - radius, pos[1] - radius, pos[0] + radius, pos[1] + radius)
+
+	def __contains__(self, key):
+
+		return key in self.key_cells
+
+	def __len__(self):
+
+		return len(self.key_cells)
+
+
+class SegmentIndex:
+	# A static grid index over line segments, queried for many points at once.  Segment i
+	# runs from starts[i] to ends[i] and is listed in every cell its bounding box overlaps.
+	# The listing is sorted by cell, so the segments in a cell are one slice of an array.
+
+	def __init__(self, starts, ends, cell_size):
+
+		self.starts = np.asarray(starts, dtype=np.float64).reshape(-1, 2)
+		self.ends = np.asarray(ends, dtype=np.float64).reshape(-1, 2)
+		self.cell_size = cell_size
+
+		lo = np.floor(np.minimum(self.starts, self.ends) / cell_size).astype(np.int64)
+		hi = np.floor(np.maximum(self.starts, self.ends) / cell_size).astype(np.int64)
+		self.lo = lo.min(axis=0) if len(lo) else np.zeros(2, dtype=np.int64)
+		self.hi = hi.max(axis=0) if len(hi) else np.full(2, -1, dtype=np.int64)
+
+		# List each segment once per overlapped cell
+		widths = hi[:, 1] - lo[:, 1] + 1
+		counts = (hi[:, 0] - lo[:, 0] + 1) * widths
+		segments = np.repeat(np.arange(len(counts)), counts)
+		within = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+		keys = self.cell_keys(lo[segments, 0] + within // widths[segments], lo[segments, 1] + within % widths[segments])
+
+		order = np.argsort(keys, kind='stable')
+		self.keys, first = np.unique(keys[order], return_index=True)
+		self.key_starts = np.append(first, len(keys))
+		self.segments = segments[order]
+
+	def cell_keys(self, i, j):
+		# Return the keys of cells (i, j), or -1 for cells outside the grid
+
+		inside = (i >= self.lo[0]) & (i <= self.hi[0]) & (j >= self.lo[1]) & (j <= self.hi[1])
+		return np.where(inside, (i - self.lo[0]) * (self.hi[1] - self.lo[1] + 1) + (j - self.lo[1]), -1)
+
+	def candidates(self, points, radius):
+		# Return arrays of point and segment indices pairing each point with the segments
+		# listed in the cells within radius of it.  A pair may appear more than once.
+
+		size = self.cell_size
+		lo = np.floor((points - radius) / size).astype(np.int64)
+		hi = np.floor((points + radius) / size).astype(np.int64)
+		span = int(np.ceil(2 * radius / size))
+		point_rows, first, count = [], [], []
+		for di in range(span + 1):
+			for dj in range(span + 1):
+				i, j = lo[:, 0] + di, lo[:, 1] + dj
+				keys = np.where((i <= hi[:, 0]) & (j <= hi[:, 1]), self.cell_keys(i, j), -1)
+				pos = np.minimum(np.searchsorted(self.keys, keys), max(len(self.keys) - 1, 0))
+				found = np.flatnonzero((keys >= 0) & (self.keys[pos] == keys)) if len(self.keys) else np.zeros(0, dtype=np.int64)
+				point_rows.append(found)
+				first.append(self.key_starts[pos[found]])
+				count.append(self.key_starts[pos[found] + 1] - self.key_starts[pos[found]])
+
+		point_rows, first, count = np.concatenate(point_rows), np.concatenate(first), np.concatenate(count)
+		within = np.arange(count.sum()) - np.repeat(np.cumsum(count) - count, count)
+		return np.repeat(point_rows, count), self.segments[np.repeat(first, count) + within]
+
+	def nearest(self, points, radius):
+		# Return, for each of an (n, 2) array of points, the index of the nearest segment within
+		# radius of it or -1, the fraction of the way along that segment of the closest point,
+		# and the distance to it
+
+		points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+		nearest = np.full(len(points), -1, dtype=np.int64)
+		fraction = np.zeros(len(points))
+		distance = np.full(len(points), np.inf)
+		rows, segments = self.candidates(points, radius)
+
+		starts = self.starts[segments]
+		d = self.ends[segments] - starts
+		d2 = (d**2).sum(axis=1)
+		t = np.divide(((points[rows] - starts) * d).sum(axis=1), d2, out=np.zeros(len(d2)), where=d2 > 0)
+		np.clip(t, 0, 1, out=t)
+		dist = np.hypot(*(starts + t[:, None] * d - points[rows]).T)
+
+		# Keep the closest candidate of each point
+		close = np.flatnonzero(dist <= radius)
+		order = close[np.lexsort((dist[close], rows[close]))]
+		best = order[np.r_[True, rows[order][1:] != rows[order][:-1]]] if len(order) else order
+		nearest[rows[best]] = segments[best]
+		fraction[rows[best]] = t[best]
+		distance[rows[best]] = dist[best]
+		return nearest, fraction, distance
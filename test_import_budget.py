@@ -0,0 +1,36 @@
+import os
+import sys
+import subprocess
+
+import pytest
+
+
+# The modules each entry point must not load when imported.  Heavy libraries are imported
+# by the functions which use them, so parsing arguments and running headless stay fast.
+FORBIDDEN = {
+	'cpp_interactive': ('pygame', 'osmnx', 'pandas', 'geopandas', 'networkx', 'PIL', 'numpy'),
+	'batch': ('pygame', 'osmnx', 'pandas', 'geopandas', 'networkx', 'PIL', 'numpy'),
+	'routeviewer': ('osmnx', 'pandas', 'geopandas', 'networkx', 'PIL'),
+	'cppsolver': ('osmnx', 'pandas', 'geopandas', 'pygame'),
+	'exporters': ('osmnx', 'pandas', 'geopandas', 'networkx', 'pygame'),
+	'trackmatch': ('osmnx', 'pandas', 'geopandas', 'networkx', 'pygame'),
+}
+
+
+def imported_modules(module):
+	# Import a module in a fresh interpreter with -X importtime and return the names of
+	# every module it loaded
+
+	out = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import ' + module], capture_output=True, text=True,
+						 check=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+	# Lines look like 'import time:       123 |        456 |   package.module'
+	return {line.rsplit('|', 1)[1].strip() for line in out.stderr.splitlines() if line.startswith('import time:') and line.count('|') == 2}
+
+
+@pytest.mark.parametrize('module', sorted(FORBIDDEN))
+def test_entry_point_skips_heavy_modules(module):
+
+	modules = imported_modules(module)
+	assert module in modules
+	loaded = sorted(name for name in FORBIDDEN[module] if name in modules or any(m.startswith(name + '.') for m in modules))
+	assert not loaded, '%s loads %s when imported' % (module, ', '.join(loaded))
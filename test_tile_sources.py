@@ -0,0 +1,98 @@
+import sqlite3
+
+import pytest
+import requests
+
+from mapboxloader import TileSource, MapboxTileSource, MBTilesSource, XYZDirectorySource, MapboxLoader, open_tile_source
+
+
+TILE = (3, 5, 2)  # z, x, y
+DATA = b'tile bytes'
+
+
+def test_default_source_reads_its_cache(tmp_path):
+	# The source used when no tile source is given is the Mapbox API.  The tile is already in
+	# its local cache, so nothing is downloaded.
+
+	cache_dir = str(tmp_path / 'cache')
+	XYZDirectorySource(cache_dir).put_tiles(TILE[0], {TILE[1:]:DATA})
+	source = open_tile_source(None, 'satellite', api_key='test', cache_dir=cache_dir)
+	assert isinstance(source, MapboxTileSource)
+	assert source.tileset == 'mapbox.satellite'
+	assert source.get_tile(*TILE) == DATA
+	source.close()
+
+
+def test_loader_defaults_to_mapbox():
+
+	loader = MapboxLoader((51.05, -114.08), (51.04, -114.05), api_key='test')
+	assert loader.source is None
+
+
+def test_xyz_directory_source(tmp_path):
+
+	XYZDirectorySource(str(tmp_path)).put_tiles(TILE[0], {TILE[1:]:DATA})
+	source = open_tile_source(str(tmp_path))
+	assert isinstance(source, XYZDirectorySource)
+	assert source.get_tile(*TILE) == DATA
+	assert source.get_tile(TILE[0], TILE[1] + 1, TILE[2]) is None
+
+
+def test_mbtiles_source_flips_rows(tmp_path):
+	# MBTiles files number rows from the bottom of the map
+
+	path = str(tmp_path / 'test.mbtiles')
+	conn = sqlite3.connect(path)
+	conn.execute('CREATE TABLE tiles (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_data BLOB)')
+	conn.execute('INSERT INTO tiles VALUES (?, ?, ?, ?)', (TILE[0], TILE[1], 2**TILE[0] - 1 - TILE[2], DATA))
+	conn.commit()
+	conn.close()
+
+	source = open_tile_source(path)
+	assert isinstance(source, MBTilesSource)
+	assert source.get_tiles(TILE[0], [TILE[1:], (TILE[1], TILE[2] + 1)]) == {TILE[1:]:DATA, (TILE[1], TILE[2] + 1):None}
+	assert open_tile_source(source) is source
+	assert isinstance(source, TileSource)
+	source.close()
+
+
+class Response:
+
+	def __init__(self, status_code, content=b''):
+
+		self.status_code = status_code
+		self.content = content
+
+
+def mapbox_source(statuses):
+	# Return a MapboxTileSource whose requests are answered with the status codes of tiles
+	# (x, y) in statuses, instead of going to the network
+
+	source = MapboxTileSource('satellite', api_key='test')
+	source.session.get = lambda url: Response(statuses[tuple(map(int, url.split('@')[0].split('/')[-2:]))], DATA)
+	return source
+
+
+def test_mapbox_failures_are_reported(capsys):
+
+	source = mapbox_source({(1, 1):200, (1, 2):404, (1, 3):429})
+	assert source.get_tiles(TILE[0], [(1, 1), (1, 2), (1, 3)]) == {(1, 1):DATA, (1, 2):None, (1, 3):None}
+	out = capsys.readouterr().out
+	assert 'status 404 for 1 mapbox.satellite tile(s) at zoom 3, e.g. (1, 2)' in out
+	assert 'status 429' in out
+
+
+@pytest.mark.parametrize('status', [401, 403])
+def test_mapbox_refused_key_raises(status):
+
+	with pytest.raises(requests.HTTPError, match='status %d' % status):
+		mapbox_source({(1, 1):status}).get_tiles(TILE[0], [(1, 1)])
+
+
+def test_source_without_get_tiles_fails_when_created():
+
+	class Incomplete(TileSource):
+		pass
+
+	with pytest.raises(TypeError):
+		Incomplete()
@@ -0,0 +1,122 @@
+import os
+os.environ['PYGAME_HIDE_SUPPORT_PROMPT'] = "hide"
+import pygame
+import numpy as np
+import io
+from collections import OrderedDict
+
+from mapboxloader import MapboxLoader
+
+
+class TilePyramid:
+	# Serve a map background for any viewport by loading only the tiles that cover it.
+	# Decoded tiles are kept in an LRU cache, so the full resolution mosaic is never built.
+
+	def __init__(self, source, max_zoom=15, min_zoom=0, tile_size=512, cache_size=128):
+
+		self.source = source  # A mapboxloader.TileSource
+		self.max_zoom = max_zoom
+		self.min_zoom = min_zoom
+		self.tile_size = tile_size  # Pixel size of the tiles served by the source
+		self.cache_size = cache_size
+		self.cache = OrderedDict()  # (z, x, y) -> decoded pygame surface, or None if the source has no tile
+
+	def choose_zoom(self, tl_lat_lon, br_lat_lon, width):
+		# Choose the lowest zoom level whose tiles are at least as detailed as the window
+
+		lon_span = abs(br_lat_lon[1] - tl_lat_lon[1])
+		if lon_span == 0:
+			return self.max_zoom
+		z = int(np.ceil(np.log2(360.0 * width / (lon_span * self.tile_size))))
+		return min(max(z, self.min_zoom), self.max_zoom)
+
+	def tile_range(self, tl_lat_lon, br_lat_lon, z):
+		# Return the x and y tile ranges (inclusive) covering a lat-lon box at zoom level z
+
+		n = 2 ** z - 1
+		tl_tile = MapboxLoader.deg2num(*tl_lat_lon, z)
+		br_tile = MapboxLoader.deg2num(*br_lat_lon, z)
+		x_range = (max(0, min(tl_tile[0], br_tile[0])), min(n, max(tl_tile[0], br_tile[0])))
+		y_range = (max(0, min(tl_tile[1], br_tile[1])), min(n, max(tl_tile[1], br_tile[1])))
+		return x_range, y_range
+
+	def get_tiles(self, z, tiles):
+		# Return a dictionary of decoded tile surfaces, loading cache misses from the source in one batch
+
+		missing = [tile for tile in tiles if (z, *tile) not in self.cache]
+		if missing:
+			for (x, y), data in self.source.get_tiles(z, missing).items():
+				self.cache[(z, x, y)] = self.decode(data)
+
+		surfaces = {}
+		for x, y in tiles:
+			key = (z, x, y)
+			self.cache.move_to_end(key)
+			surfaces[(x, y)] = self.cache[key]
+
+		while len(self.cache) > self.cache_size:
+			self.cache.popitem(last=False)
+		return surfaces
+
+	def prefetch(self, tl_lat_lon, br_lat_lon, width):
+		# Load the tiles for a view ahead of time so the first frame does not wait on them
+
+		z = self.choose_zoom(tl_lat_lon, br_lat_lon, width)
+		x_range, y_range = self.tile_range(tl_lat_lon, br_lat_lon, z)
+		self.get_tiles(z, [(x, y) for x in range(x_range[0], x_range[1]+1)
+								  for y in range(y_range[0], y_range[1]+1)])
+
+	@staticmethod
+	def decode(data):
+
+		if data is None:
+			return None
+		surf = pygame.image.load(io.BytesIO(data), 'tile.png')
+		if pygame.display.get_surface():
+			return surf.convert()
+		if surf.get_bitsize() < 24:
+			# smoothscale needs 24 or 32 bit surfaces
+			rgb = pygame.Surface(surf.get_size(), 0, 32)
+			rgb.blit(surf, (0, 0))
+			return rgb
+		return surf
+
+	def render(self, size, window_to_lat_lon, lat_lon_to_window):
+		# Render the background for a window of the given size.
+		# window_to_lat_lon maps a window position to (lat, lon); lat_lon_to_window maps
+		# arrays of latitudes and longitudes to arrays of window x and y positions.
+
+		tl_lat_lon = window_to_lat_lon((0, 0))
+		br_lat_lon = window_to_lat_lon(size)
+		z = self.choose_zoom(tl_lat_lon, br_lat_lon, size[0])
+		x_range, y_range = self.tile_range(tl_lat_lon, br_lat_lon, z)
+
+		# Window positions of every tile corner, computed in one pass
+		xs = np.arange(x_range[0], x_range[1]+2)
+		ys = np.arange(y_range[0], y_range[1]+2)
+		n = 2.0 ** z
+		lons = xs / n * 360.0 - 180.0
+		lats = np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * ys / n))))
+		win_x, _ = lat_lon_to_window(np.full_like(lons, lats[0]), lons)
+		_, win_y = lat_lon_to_window(lats, np.full_like(lats, lons[0]))
+		win_x = np.rint(win_x).astype(int).tolist()
+		win_y = np.rint(win_y).astype(int).tolist()
+
+		x_tiles = range(x_range[0], x_range[1]+1)
+		y_tiles = range(y_range[0], y_range[1]+1)
+		tiles = self.get_tiles(z, [(x, y) for x in x_tiles for y in y_tiles])
+
+		bg_img = pygame.Surface(size)
+		for i, x in enumerate(x_tiles):
+			for j, y in enumerate(y_tiles):
+				tile = tiles[(x, y)]
+				if tile is None:
+					continue
+				rect = pygame.Rect(win_x[i], win_y[j], win_x[i+1] - win_x[i], win_y[j+1] - win_y[j])
+				if rect.width <= 0 or rect.height <= 0:
+					continue
+				bg_img.blit(pygame.transform.smoothscale(tile, rect.size), rect)
+		return bg_img
+
+	def close(self):
+		self.source.close()
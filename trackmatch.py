@@ -0,0 +1,190 @@
+import os
+import csv
+import time
+import argparse
+import numpy as np
+import xml.etree.ElementTree as ET
+from pyproj import Transformer
+
+from spatialindex import SegmentIndex
+from graphcoords import edge_geometries, pack_geometries
+
+
+LAT_COLUMNS = ('lat', 'latitude')
+LON_COLUMNS = ('lon', 'lng', 'long', 'longitude')
+
+
+def is_covered(data):
+	# Return whether an edge's data flags it as covered.  GraphML files store the flag as text.
+
+	return data.get('covered') in (True, 'True', 'true', '1', 1)
+
+
+def read_track(path):
+	# Read a GPX or CSV track and return a list of (n, 2) arrays of latitudes and longitudes,
+	# one per track segment or route.  CSV files need latitude and longitude columns.
+
+	if os.path.splitext(path)[1].lower() == '.csv':
+		with open(path, newline='') as csvfile:
+			reader = csv.reader(csvfile)
+			header = [name.strip().lower() for name in next(reader)]
+			lat_col = next((header.index(name) for name in LAT_COLUMNS if name in header), None)
+			lon_col = next((header.index(name) for name in LON_COLUMNS if name in header), None)
+			if lat_col is None or lon_col is None:
+				raise ValueError('%s has no latitude and longitude columns' % path)
+			points = [(float(row[lat_col]), float(row[lon_col])) for row in reader if row]
+		return [np.array(points, dtype=np.float64).reshape(-1, 2)]
+
+	segments, points = [], []
+	for _, element in ET.iterparse(path, events=('end',)):
+		tag = element.tag.rsplit('}', 1)[-1]
+		if tag in ('trkpt', 'rtept'):
+			points.append((float(element.get('lat')), float(element.get('lon'))))
+			element.clear()
+		elif tag in ('trkseg', 'rte') and points:
+			segments.append(np.array(points, dtype=np.float64))
+			points = []
+	return segments
+
+
+class TrackMatcher:
+	# Matches recorded tracks onto the edges of a projected graph.  Track points are snapped
+	# to the nearest edge segment within radius meters.  Each edge is split into bins about
+	# bin_length meters long, and an edge's coverage is the fraction of its bins which a
+	# snapped point fell in.  Tracks are densified first so a ride hits every bin it passes.
+
+	def __init__(self, G, radius=15.0, bin_length=10.0, max_gap=200.0):
+
+		self.radius = radius
+		self.bin_length = bin_length
+		self.spacing = bin_length / 2  # Largest distance between points after densifying
+		self.max_gap = max_gap  # Points further apart than this are not joined, e.g. after losing signal
+		self.to_xy = Transformer.from_crs('EPSG:4326', G.graph['crs'], always_xy=True)
+
+		self.edge_ids, geoms = edge_geometries(G, list(G.edges(keys=True)))
+		geom_xy, offsets = pack_geometries(geoms)
+
+		# Segments join consecutive points of the same geometry
+		geom = np.repeat(np.arange(len(self.edge_ids)), np.diff(offsets))
+		joined = np.flatnonzero(geom[1:] == geom[:-1])
+		starts, ends = geom_xy[joined], geom_xy[joined + 1]
+		self.segment_edge = geom[joined]
+		self.segment_length = np.hypot(*(ends - starts).T)
+
+		# Distance along its edge at which each segment starts
+		self.edge_length = np.bincount(self.segment_edge, self.segment_length, minlength=len(self.edge_ids))
+		before = np.cumsum(self.segment_length) - self.segment_length
+		self.segment_start = before - before[np.searchsorted(self.segment_edge, self.segment_edge)]
+
+		self.index = SegmentIndex(starts, ends, max(4 * radius, 50.0))
+
+		self.bins = np.maximum(np.ceil(self.edge_length / bin_length).astype(np.int64), 1)
+		self.bin_offsets = np.zeros(len(self.edge_ids) + 1, dtype=np.int64)
+		np.cumsum(self.bins, out=self.bin_offsets[1:])
+		self.hit = np.zeros(self.bin_offsets[-1], dtype=bool)
+		self.points = 0
+		self.matched = 0
+
+	def densify(self, xy):
+		# Return an (n, 2) array of projected track points with points added along the gaps
+		# longer than spacing and shorter than max_gap
+
+		gaps = np.hypot(*(xy[1:] - xy[:-1]).T)
+		n = np.where(gaps <= self.max_gap, np.ceil(gaps / self.spacing).astype(np.int64) - 1, 0)
+		n = np.maximum(n, 0)
+		if not n.any():
+			return xy
+		pair = np.repeat(np.arange(len(gaps)), n)
+		step = np.arange(n.sum()) - np.repeat(np.cumsum(n) - n, n) + 1
+		t = (step / (n[pair] + 1))[:, None]
+		return np.concatenate([xy, xy[pair] + t * (xy[pair + 1] - xy[pair])])
+
+	def add_track(self, segments, batch_size=65536):
+		# Match the track segments returned by read_track, in batches of batch_size points
+
+		for lat_lon in segments:
+			if not len(lat_lon):
+				continue
+			x, y = self.to_xy.transform(lat_lon[:, 1], lat_lon[:, 0])
+			xy = self.densify(np.stack([x, y], axis=1))
+			self.points += len(lat_lon)
+			for start in range(0, len(xy), batch_size):
+				self.add_points(xy[start:start+batch_size])
+
+	def add_points(self, xy):
+		# Mark the bins hit by an (n, 2) array of projected points
+
+		segments, t, _ = self.index.nearest(xy, self.radius)
+		matched = segments >= 0
+		segments, t = segments[matched], t[matched]
+		edges = self.segment_edge[segments]
+		along = self.segment_start[segments] + t * self.segment_length[segments]
+		length = self.edge_length[edges]
+		fraction = np.divide(along, length, out=np.zeros(len(along)), where=length > 0)
+		bins = np.minimum((fraction * self.bins[edges]).astype(np.int64), self.bins[edges] - 1)
+		self.hit[self.bin_offsets[edges] + bins] = True
+		self.matched += len(segments)
+
+	def coverage(self):
+		# Return the fraction of each edge's bins hit by a track, indexed like edge_ids
+
+		return np.add.reduceat(self.hit, self.bin_offsets[:-1]) / self.bins if len(self.hit) else np.zeros(0)
+
+	def covered_edges(self, min_coverage=0.6):
+		# Return the ids of the edges with at least min_coverage of their length covered
+
+		return [self.edge_ids[row] for row in np.flatnonzero(self.coverage() >= min_coverage).tolist()]
+
+
+def mark_covered(G, paths, radius=15.0, min_coverage=0.6, verbose=False):
+	# Match the GPX or CSV tracks in paths onto the projected graph G and flag the covered
+	# edges with covered=True.  Returns the ids of the covered edges.
+
+	start = time.perf_counter()
+	matcher = TrackMatcher(G, radius)
+	for path in paths:
+		matcher.add_track(read_track(path))
+	covered = matcher.covered_edges(min_coverage)
+	for id_ in covered:
+		G.edges[id_]['covered'] = True
+
+	if verbose:
+		elapsed = time.perf_counter() - start
+		print('Matched %d track points in %.2fs (%.0f points/s)' % (matcher.points, elapsed, matcher.points / max(elapsed, 1e-9)))
+		print('%d of %d edges are covered (%.1f of %.1f km)' % (len(covered), len(matcher.edge_ids),
+																  matcher.edge_length[matcher.coverage() >= min_coverage].sum() / 1000,
+																  matcher.edge_length.sum() / 1000))
+	return covered
+
+
+def parse_args(args=None):
+	# Parse arguments from user
+
+	parser = argparse.ArgumentParser(description='Flag the edges of a GraphML road network covered by recorded GPX or CSV tracks, so later routes only cover the rest.')
+	parser.add_argument('graph', type=str, help='A GraphML file, as written by the --graph option of a batch job.')
+	parser.add_argument('tracks', type=str, nargs='+', help='GPX files, or CSV files with latitude and longitude columns.')
+	parser.add_argument('--out', type=str, default=None, help='The GraphML file to write the flagged graph to. Defaults to overwriting the input graph.')
+	parser.add_argument('--radius', type=float, default=15.0, help='The largest distance in meters from a track point to the edge it is matched to.')
+	parser.add_argument('--min_coverage', type=float, default=0.6, help='The fraction of an edge\'s length which must be ridden for it to count as covered.')
+	parser.add_argument('--verbose', action='store_true', help='Output information as the program runs.')
+	return parser.parse_args(args)
+
+
+def main(args):
+	# Match the tracks onto the projected, undirected graph and copy the flags back onto both
+	# directions of the edges of the graph file.  Edges flagged by earlier runs stay flagged.
+
+	import osmnx as ox
+	from cpp_interactive import ChinesePostmanInteractive
+	G = ox.load_graphml(args.graph)
+	covered = mark_covered(ChinesePostmanInteractive.project_graph(G), args.tracks, args.radius, args.min_coverage, args.verbose)
+	for u, v, key in covered:
+		for id_ in ((u, v, key), (v, u, key)):
+			if G.has_edge(*id_):
+				G.edges[id_]['covered'] = True
+	print('%d edges of %s are now covered' % (sum(is_covered(data) for _, _, data in G.edges(data=True)), args.graph))
+	ox.save_graphml(G, args.out or args.graph)
+
+
+if __name__ == '__main__':
+	main(parse_args())
@@ -0,0 +1,89 @@
+from collections import deque
+
+
+class GraphDiff:
+	# A record of one change to a graph: the nodes and edges it added, the nodes and edges
+	# (with their attributes) it removed, and the old values of node attributes it changed.
+	# Changes which rewrite the whole graph store a full snapshot instead.
+
+	def __init__(self, kind, snapshot=None):
+
+		self.kind = kind
+		self.snapshot = snapshot
+		self.added_nodes = []  # Node ids
+		self.added_edges = []  # (u, v, key) edge ids
+		self.removed_nodes = []  # (id, attributes) pairs
+		self.removed_edges = []  # (u, v, key, attributes) tuples
+		self.changed_nodes = []  # (id, attribute name, old value) tuples
+
+	def add_node(self, id_):
+
+		self.added_nodes.append(id_)
+
+	def add_edge(self, u, v, key):
+
+		self.added_edges.append((u, v, key))
+
+	def remove_node(self, G, id_):
+
+		self.removed_nodes.append((id_, dict(G.nodes[id_])))
+
+	def remove_edge(self, G, u, v, key):
+
+		self.removed_edges.append((u, v, key, dict(G.edges[u, v, key])))
+
+	def change_node(self, G, id_, attr):
+
+		self.changed_nodes.append((id_, attr, G.nodes[id_][attr]))
+
+	def size(self):
+		# Approximate the size of the record as a number of nodes and edges
+
+		if self.snapshot is not None:
+			return self.snapshot.number_of_nodes() + self.snapshot.number_of_edges()
+		return len(self.added_nodes) + len(self.added_edges) + len(self.removed_nodes) + \
+			   len(self.removed_edges) + len(self.changed_nodes)
+
+	def revert(self, G):
+		# Apply the inverse of the change to G in place.  Snapshots are not handled here.
+
+		for u, v, key in self.added_edges:
+			G.remove_edge(u, v, key)
+		G.remove_nodes_from(self.added_nodes)
+		G.add_nodes_from(self.removed_nodes)
+		for u, v, key, data in self.removed_edges:
+			G.add_edge(u, v, key, **data)
+		for id_, attr, value in reversed(self.changed_nodes):
+			G.nodes[id_][attr] = value
+
+
+class UndoLog:
+	# A stack of GraphDiffs.  The oldest records are dropped once the log holds more than
+	# max_entries records or more than max_size nodes and edges in total.
+
+	def __init__(self, max_entries=None, max_size=None):
+
+		self.max_entries = max_entries
+		self.max_size = max_size
+		self.diffs = deque()
+		self.size = 0
+
+	def push(self, diff):
+
+		self.diffs.append(diff)
+		self.size += diff.size()
+		while len(self.diffs) > 1 and ((self.max_entries and len(self.diffs) > self.max_entries) or
+									   (self.max_size and self.size > self.max_size)):
+			self.size -= self.diffs.popleft().size()
+
+	def pop(self):
+
+		if not self.diffs:
+			return None
+		diff = self.diffs.pop()
+		self.size -= diff.size()
+		return diff
+
+	def __len__(self):
+
+		return len(self.diffs)